@@ -0,0 +1,351 @@
+"""
+Benchmark suite for concatenate_scripts.py on reproducible synthetic repositories.
+
+Each scenario generates a tree (deep nesting, a large node_modules, fake virtual
+environments with pyvenv.cfg, many small files, a few multi-MB files, symlink loops,
+or all of them mixed) and runs the pipeline phase by phase in a fresh process:
+scan, collect, structure, distribute and write. For every phase it reports wall time,
+files per second, syscalls and the process's peak RSS so far.
+
+Syscalls are the read/write syscall counts from /proc/self/io (Linux only) plus the file
+opens and directory listings seen by a sys.addaudithook hook and the calls to os.stat,
+os.lstat and os.fstat, which os.path.exists, isdir, isfile, islink and realpath go
+through. DirEntry.stat() is implemented in C and does not go through os.stat, so stats
+made through directory entries are not counted. Results can be saved as a baseline and
+later runs compared against it:
+
+    python benchmarks/bench_concatenator.py --save-baseline benchmarks/baseline.json
+    python benchmarks/bench_concatenator.py --baseline benchmarks/baseline.json
+
+Generated trees are cached under --workdir and reused while their parameters match.
+"""
+
+import os
+import sys
+import io
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+import contextlib
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+SCENARIOS = ['deep', 'node_modules', 'venvs', 'small_files', 'large_files', 'symlinks', 'mixed']
+PHASES = ['scan', 'collect', 'structure', 'distribute', 'write']
+DEFAULT_WORKDIR = os.path.join(tempfile.gettempdir(), 'concatenate_scripts_bench')
+GENERATOR_VERSION = 2
+REGRESSION_THRESHOLD = 0.10
+
+WORDS = ['value', 'result', 'config', 'handler', 'items', 'index', 'layer', 'weights',
+         'update', 'render', 'state', 'props', 'data', 'count', 'error', 'output']
+
+
+# --- Synthetic Trees ---
+
+def source_text(rng, ext, lines):
+    """Returns plausible source text of the given type with roughly this many lines."""
+    out = []
+    for i in range(lines):
+        a, b = rng.choice(WORDS), rng.choice(WORDS)
+        if ext == '.py':
+            out.append(f"{a}_{i} = {b}_{rng.randrange(100)} + {rng.randrange(1000)}")
+        elif ext == '.js':
+            out.append(f"const {a}{i} = {b}.map((x) => x * {rng.randrange(10)});")
+        elif ext == '.css':
+            out.append(f".{a}-{i} {{ margin: {rng.randrange(20)}px; }}")
+        else:
+            out.append(f"The {a} of the {b} is {rng.randrange(1000)}.")
+    return "\n".join(out) + "\n"
+
+def write_file(path, text):
+    """Writes a generated file, creating its directory."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+def make_small_files(root, rng, count):
+    """Many small project files spread over a few hundred directories."""
+    for i in range(count):
+        ext = rng.choice(['.py', '.js', '.css', '.md'])
+        path = os.path.join(root, 'src', f"module{i % 200}", f"part{i % 7}", f"file{i}{ext}")
+        write_file(path, source_text(rng, ext, rng.randrange(5, 80)))
+
+def make_deep(root, rng, depth):
+    """A single chain of directories `depth` levels deep with a few files per level."""
+    path = os.path.join(root, 'deep')
+    for level in range(depth):
+        path = os.path.join(path, f"level{level}")
+        for j in range(3):
+            write_file(os.path.join(path, f"f{j}.py"), source_text(rng, '.py', 10))
+
+def make_node_modules(root, rng, packages):
+    """A node_modules tree with nested packages, which must be pruned unread."""
+    for i in range(packages):
+        package = os.path.join(root, 'node_modules', f"pkg-{i}")
+        write_file(os.path.join(package, 'package.json'), json.dumps({'name': f"pkg-{i}"}))
+        for j in range(15):
+            write_file(os.path.join(package, 'lib', f"m{j}.js"), source_text(rng, '.js', 20))
+        if i % 10 == 0:
+            write_file(os.path.join(package, 'node_modules', 'dep', 'index.js'),
+                       source_text(rng, '.js', 20))
+
+def make_venvs(root, rng, venvs, files_per_venv):
+    """Virtual environments under names that are not in EXCLUDED_DIRS, found by pyvenv.cfg."""
+    for i in range(venvs):
+        venv = os.path.join(root, f"env_{i}")
+        write_file(os.path.join(venv, 'pyvenv.cfg'), "home = /usr/bin\nversion = 3.11.0\n")
+        for j in range(files_per_venv):
+            write_file(os.path.join(venv, 'lib', 'python3.11', 'site-packages', f"pkg{j % 30}",
+                                    f"mod{j}.py"), source_text(rng, '.py', 30))
+
+def make_large_files(root, rng, count, size_mb):
+    """A few multi-MB files, some over the size limit and some only over the line limit."""
+    for i in range(count):
+        # Even files exceed the size limit; odd ones are half as big and only exceed the line limit
+        lines = int(size_mb * (1 if i % 2 == 0 else 0.5) * 1024 * 1024 / 40)
+        name = f"main_generated{i}.py" if i % 2 else f"generated{i}.js"
+        write_file(os.path.join(root, 'large', name),
+                   source_text(rng, os.path.splitext(name)[1], lines))
+
+def make_symlinks(root, rng, loops):
+    """Directories with symlinks back to their ancestors and to each other."""
+    if not hasattr(os, 'symlink'):
+        return
+    for i in range(loops):
+        base = os.path.join(root, 'links', f"group{i}", 'inner')
+        write_file(os.path.join(base, 'code.py'), source_text(rng, '.py', 10))
+        with contextlib.suppress(OSError):
+            os.symlink('../..', os.path.join(base, 'up'))
+            os.symlink(os.path.join('..', 'inner'), os.path.join(base, '..', 'alias'))
+
+def scenario_params(scenario, scale):
+    """Returns the generator parameters of a scenario at a scale."""
+    params = {
+        'small_files': int(5000 * scale) if scenario in ('small_files', 'mixed') else 50,
+        'depth': int(60 * scale) if scenario in ('deep', 'mixed') else 0,
+        'packages': int(300 * scale) if scenario in ('node_modules', 'mixed') else 0,
+        'venvs': 3 if scenario in ('venvs', 'mixed') else 0,
+        'venv_files': int(500 * scale),
+        'large_files': 4 if scenario in ('large_files', 'mixed') else 0,
+        'large_size_mb': 3,
+        'loops': int(20 * scale) if scenario in ('symlinks', 'mixed') else 0,
+    }
+    params['version'] = GENERATOR_VERSION
+    return params
+
+def generate_tree(root, scenario, scale=1.0, seed=0):
+    """
+    Generates the tree for a scenario under root, unless the tree there was already
+    generated with the same parameters. The same seed always yields the same tree.
+    """
+    params = scenario_params(scenario, scale)
+    params['seed'] = seed
+    marker = os.path.join(root, '.bench_params.json')
+    try:
+        with open(marker, 'r', encoding='utf-8') as f:
+            if json.load(f) == params:
+                return params
+    except (OSError, ValueError):
+        pass
+    shutil.rmtree(root, ignore_errors=True)
+    os.makedirs(root)
+
+    rng = random.Random(f"{seed}:{scenario}")
+    make_small_files(root, rng, params['small_files'])
+    make_deep(root, rng, params['depth'])
+    make_node_modules(root, rng, params['packages'])
+    make_venvs(root, rng, params['venvs'], params['venv_files'])
+    make_large_files(root, rng, params['large_files'], params['large_size_mb'])
+    make_symlinks(root, rng, params['loops'])
+    with open(marker, 'w', encoding='utf-8') as f:
+        json.dump(params, f)
+    return params
+
+
+# --- Measurement ---
+
+AUDITED_EVENTS = {'open': 'opens', 'os.scandir': 'listings', 'os.listdir': 'listings'}
+# stat raises no audit event, so these functions are wrapped instead
+STAT_FUNCTIONS = ('stat', 'lstat', 'fstat')
+audit_counts = {'opens': 0, 'listings': 0, 'stats': 0}
+
+def audit_hook(event, args):
+    """Counts the file opens and directory listings made by the code under test."""
+    key = AUDITED_EVENTS.get(event)
+    if key is not None:
+        audit_counts[key] += 1
+
+def count_stat_calls():
+    """
+    Replaces the os.stat family with wrappers that count their calls. os.path looks
+    these functions up on the os module at call time, so its checks are counted too.
+    """
+    for name in STAT_FUNCTIONS:
+        original = getattr(os, name)
+
+        def counted(*args, _original=original, **kwargs):
+            audit_counts['stats'] += 1
+            return _original(*args, **kwargs)
+
+        setattr(os, name, counted)
+
+def read_proc_io():
+    """Returns the read and write syscall counts of this process, or None if unavailable."""
+    try:
+        with open('/proc/self/io', 'r', encoding='ascii') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return int(fields['syscr']), int(fields['syscw'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+def peak_rss_mb():
+    """Returns the peak resident set size of this process in MB, or None if unavailable."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def measure(phase, files, func, results):
+    """Runs one phase with its output silenced and records its cost in results."""
+    io_before = read_proc_io()
+    audit_before = dict(audit_counts)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        value = func()
+    elapsed = time.perf_counter() - start
+    io_after = read_proc_io()
+
+    syscalls = sum(audit_counts[key] - audit_before[key] for key in audit_counts)
+    if io_before is not None and io_after is not None:
+        syscalls += (io_after[0] - io_before[0]) + (io_after[1] - io_before[1])
+    files = files(value) if callable(files) else files
+    results[phase] = {
+        'seconds': round(elapsed, 4),
+        'files': files,
+        'files_per_sec': round(files / elapsed, 1) if elapsed > 0 else None,
+        'syscalls': syscalls,
+        'peak_rss_mb': round(peak_rss_mb(), 1) if resource is not None else None,
+    }
+    return value
+
+def count_tree_files(tree):
+    """Counts the file entries in a scanned tree."""
+    count = 0
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        for child in node['children'] or []:
+            if child['is_dir']:
+                stack.append(child)
+            else:
+                count += 1
+    return count
+
+def run_scenario(root):
+    """Runs every phase on a generated tree in this process and returns the results."""
+    import concatenate_scripts as cs
+
+    sys.addaudithook(audit_hook)
+    count_stat_calls()
+    for name in os.listdir(root):
+        if name.startswith('concatenated_scripts_'):
+            os.remove(os.path.join(root, name))
+
+    results = {}
+    verdict_cache = {}
+    tree = measure('scan', count_tree_files,
+                   lambda: cs.scan_directory_tree(root, verdict_cache), results)
+    files = results['scan']['files']
+    file_blocks, _, _ = measure('collect', files,
+                                lambda: cs.collect_file_contents(root, tree, verdict_cache), results)
+    structure = measure('structure', files,
+                        lambda: cs.generate_directory_structure(root, tree), results)
+    parts = measure('distribute', len(file_blocks),
+                    lambda: cs.distribute_files_across_parts(file_blocks, 3), results)
+    measure('write', len(file_blocks),
+            lambda: cs.write_parts_to_files(parts, root, tree, directory_structure=structure), results)
+    return results
+
+
+# --- Reporting ---
+
+def print_results(all_results, baseline=None, threshold=REGRESSION_THRESHOLD):
+    """Prints one row per scenario and phase, with the change against a baseline if given."""
+    regressions = []
+    header = f"{'scenario':<13} {'phase':<11} {'seconds':>9} {'files/s':>11} {'syscalls':>9} {'peak RSS':>9}"
+    print(header + ('  vs baseline' if baseline else ''))
+    for scenario, results in all_results.items():
+        for phase in PHASES:
+            row = results[phase]
+            line = (f"{scenario:<13} {phase:<11} {row['seconds']:>9.3f} "
+                    f"{row['files_per_sec'] or 0:>11.0f} {row['syscalls']:>9} "
+                    f"{row['peak_rss_mb'] or 0:>7.1f}MB")
+            previous = (baseline or {}).get(scenario, {}).get(phase)
+            if previous and previous['seconds'] > 0:
+                change = row['seconds'] / previous['seconds'] - 1
+                line += f"  {change:+7.1%}"
+                # Very short phases are too noisy to call regressions
+                if change > threshold and row['seconds'] - previous['seconds'] > 0.01:
+                    line += "  REGRESSION"
+                    regressions.append((scenario, phase, change))
+            print(line)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scenario', choices=SCENARIOS, action='append',
+                        help='Scenario to run (repeatable; default: all).')
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiplier for tree sizes (default: 1).')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the generated trees (default: 0).')
+    parser.add_argument('--workdir', default=DEFAULT_WORKDIR, help='Where generated trees are kept.')
+    parser.add_argument('--baseline', help='Compare against results saved with --save-baseline.')
+    parser.add_argument('--save-baseline', help='Save the results as a baseline JSON file.')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help=f'Slowdown that counts as a regression (default: {REGRESSION_THRESHOLD}).')
+    parser.add_argument('--run-tree', help=argparse.SUPPRESS)  # Child process: measure one tree
+    args = parser.parse_args(argv)
+
+    if args.run_tree:
+        json.dump(run_scenario(args.run_tree), sys.stdout)
+        return 0
+
+    all_results = {}
+    for scenario in args.scenario or SCENARIOS:
+        root = os.path.join(args.workdir, scenario)
+        print(f"[INFO] Generating {scenario} tree in {root}", file=sys.stderr)
+        generate_tree(root, scenario, args.scale, args.seed)
+        # A fresh process per scenario keeps peak RSS and caches independent
+        child = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-tree', root],
+                               stdout=subprocess.PIPE, check=True)
+        all_results[scenario] = json.loads(child.stdout)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+    regressions = print_results(all_results, baseline, args.threshold)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump({'scale': args.scale, 'seed': args.seed, 'python': sys.version.split()[0],
+                       'results': all_results}, f, indent=2)
+        print(f"[INFO] Saved baseline to {args.save_baseline}")
+    if regressions:
+        print(f"[WARN] {len(regressions)} phase(s) slower than the baseline by more than {args.threshold:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,86 @@
+"""
+Micro-benchmark for header detection in concatenate_scripts.py.
+
+Compares the previous whole-file implementation of check_for_existing_header
+(kept here as legacy_check_for_existing_header) with the current bounded-prefix
+one on multi-MB Markdown, CSS and Python content, and reports throughput in MB/s.
+
+Usage: python benchmarks/bench_header_detection.py [--size-mb 4] [--repeat 5]
+"""
+
+import os
+import sys
+import re
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from concatenate_scripts import check_for_existing_header  # noqa: E402
+
+
+def legacy_check_for_existing_header(content, relative_path):
+    """
+    The header detection used before it was bounded to a prefix of the file.
+    Runs every pattern over the whole content and splits the whole file into lines.
+    """
+    header_patterns = [
+        r'^\s*(//\s*File:.*?)\n',        # JavaScript style
+        r'^\s*(#\s*File:.*?)\n',         # Python style
+        r'^\s*(/\*\s*File:.*?\*/)',       # CSS style
+        r'^\s*(<!--\s*File:.*?-->)',      # HTML style
+        r'^\s*(--\s*File:.*?)\n',        # SQL style
+    ]
+    clean_content = content
+    for pattern in header_patterns:
+        clean_content = re.sub(f'^{pattern}\\s*', '', clean_content, flags=re.MULTILINE|re.DOTALL)
+    clean_content = re.sub(r'^#{80}\s*\n^#\s*File:.*?\n^#{80}\s*\n\s*', '', clean_content, flags=re.MULTILINE|re.DOTALL)
+    first_lines = content.split('\n')[:10]
+    first_block = '\n'.join(first_lines)
+    has_header = re.search(re.escape(relative_path), first_block) is not None
+    return has_header, clean_content
+
+
+def make_content(kind, size_mb):
+    """Builds roughly size_mb of content of the given kind, with an existing header on top."""
+    samples = {
+        'markdown': ('<!--\nFile: docs/guide.md\n-->\n\n', '## Section\n\nSome *text* with `code` and a [link](http://example.com).\n\n'),
+        'css': ('/*\nFile: src/App.css\n*/\n\n', '.panel > .row:hover {\n  color: #333;\n  margin: 0 auto; /* spacing */\n}\n\n'),
+        'python': ('# File: src/module.py\n\n', 'def handler(event):\n    # process the event\n    return event.get("value", 0) * 2\n\n'),
+    }
+    header, chunk = samples[kind]
+    repeats = int(size_mb * 1024 * 1024 / len(chunk)) + 1
+    return header + chunk * repeats
+
+
+def time_call(func, content, relative_path, repeat):
+    """Returns the best wall time in seconds over repeat calls."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(content, relative_path)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size-mb', type=float, default=4, help='Size of each generated file in MB (default: 4).')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed runs per case; the best is reported (default: 5).')
+    args = parser.parse_args(argv)
+
+    print(f"{'content':<10} {'size':>8} {'before':>12} {'after':>12} {'speedup':>9}")
+    for kind, relative_path in (('markdown', 'docs/guide.md'), ('css', 'src/App.css'), ('python', 'src/module.py')):
+        content = make_content(kind, args.size_mb)
+        if legacy_check_for_existing_header(content, relative_path) != check_for_existing_header(content, relative_path):
+            print(f"[ERROR] Results differ for {kind} content")
+            return 1
+        size_mb = len(content) / (1024 * 1024)
+        before = time_call(legacy_check_for_existing_header, content, relative_path, args.repeat)
+        after = time_call(check_for_existing_header, content, relative_path, args.repeat)
+        print(f"{kind:<10} {size_mb:>6.1f}MB {size_mb / before:>9.1f}MB/s {size_mb / after:>9.1f}MB/s {before / after:>8.1f}x")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,7 +2,51 @@ import os
 import sys
 import datetime
 import re
-import fnmatch
+import time
+import json
+import heapq
+import bisect
+import codecs
+import hashlib
+import stat
+import struct
+import subprocess
+import argparse
+import select
+import ctypes
+import ctypes.util
+import logging
+import contextlib
+import io
+import gzip
+import mmap
+import glob
+import queue
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# Optional exact tokenizer (pip install tiktoken); the built-in heuristic is used when it
+# is not installed
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Optional compressors; a Python build without one only lacks that --compress format
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+# Progress and diagnostics go through this logger. It has no handler of its own, so the
+# module is silent unless the caller configures logging (the command line uses configure_logging)
+logger = logging.getLogger('concatenate_scripts')
+logger.addHandler(logging.NullHandler())
 
 # --- Configuration Constants ---
 
@@ -22,13 +66,72 @@ ALLOWED_FILENAMES = [
 
 # Variables for files and directories to exclude
 OUTPUT_FILENAME_TEMPLATE = 'concatenated_scripts_part{}.txt'
-# Dynamically get the name of the script file itself
-SCRIPT_FILENAME = os.path.basename(sys.argv[0]) 
+# Manifest of the last run, written next to the output parts for incremental re-runs
+MANIFEST_FILENAME = 'concatenated_scripts_manifest.json'
+MANIFEST_VERSION = 1
+# Sidecar index with the byte offset of every block in the parts, for random access
+INDEX_FILENAME = 'concatenated_scripts_index.json'
+INDEX_VERSION = 1
+# Streaming compressors for the output parts: format -> (file suffix, default level, magic bytes)
+COMPRESSION_FORMATS = {
+    'gzip': ('.gz', 6, b'\x1f\x8b'),
+    'bz2': ('.bz2', 9, b'BZh'),
+    'lzma': ('.xz', 6, b'\xfd7zXZ\x00'),
+}
+OUTPUT_FILENAME_REGEX = re.compile(
+    re.escape(OUTPUT_FILENAME_TEMPLATE).replace(r'\{\}', r'\d+')
+    + '(?:' + '|'.join(re.escape(suffix) for suffix, _, _ in COMPRESSION_FORMATS.values()) + ')?'
+)
+# Characters per chunk when a part is streamed back out (see iter_part_text)
+PART_READ_CHUNK_CHARS = 1024 * 1024
+# Incremental runs keep files in their previous part until the largest part exceeds
+# the average part size by more than this fraction; then everything is redistributed
+INCREMENTAL_REBALANCE_TOLERANCE = 0.25
+# Part distribution strategies: 'balanced' packs largest files first for even parts,
+# 'locality' keeps directory subtrees contiguous and in path order
+DISTRIBUTION_STRATEGIES = ['balanced', 'locality']
+# Fraction of the target part size a locality cut may move to land on a directory boundary
+DEFAULT_LOCALITY_TOLERANCE = 0.1
+# Tokens reserved per part with a token budget on top of its measured header and index,
+# for the part and file counts filled in after the parts are cut
+PART_OVERHEAD_MARGIN_TOKENS = 16
+# Budget mode: with a total budget, files are ranked by a priority score and the best
+# set that fits is bundled (see select_files_by_priority). A file's score is the weight
+# of its type, plus a bonus for essential docs and for recent changes (halving every
+# PRIORITY_RECENCY_HALF_LIFE_DAYS before the newest file), minus a penalty per directory level
+PRIORITY_TYPE_WEIGHTS = {
+    '.py': 10, '.js': 9, '.jsx': 9, '.html': 6, '.css': 4, '.md': 6,
+    '.toml': 5, '.yaml': 5, '.yml': 5, '.json': 3, '.gitignore': 1,
+}
+PRIORITY_DEFAULT_TYPE_WEIGHT = 5   # Allowed file names without a listed extension (Dockerfile, ...)
+PRIORITY_ESSENTIAL_BONUS = 50
+PRIORITY_RECENCY_BONUS = 10
+PRIORITY_RECENCY_HALF_LIFE_DAYS = 30
+PRIORITY_DEPTH_PENALTY = 1
+PRIORITY_MIN_SCORE = 1
+# Where the recency of a file comes from: its mtime, or the last commit that touched it
+RECENCY_SOURCES = ['mtime', 'git']
+GIT_LOG_TIMEOUT = 60
+
+# Approximate characters per LLM token used by the heuristic token estimator.
+# Prose packs more characters into a token than code, and dense JSON packs fewer.
+CHARS_PER_TOKEN = {
+    '.md': 4.2, '.txt': 4.2,
+    '.py': 3.6, '.toml': 3.4, '.yaml': 3.2, '.yml': 3.2,
+    '.js': 3.2, '.jsx': 3.2, '.ts': 3.2, '.tsx': 3.2,
+    '.html': 3.0, '.css': 3.0, '.json': 2.6,
+}
+DEFAULT_CHARS_PER_TOKEN = 3.5
+# Encoding used by the exact tokenizer
+TIKTOKEN_ENCODING = 'cl100k_base'
+# The name of the script file itself, taken from the module so importing it has no side effects
+SCRIPT_FILENAME = os.path.basename(__file__)
 
 EXCLUDED_FILES = [
     'concatenated_scripts_part1.txt',
     'concatenated_scripts_part2.txt',
     'concatenated_scripts_part3.txt',
+    MANIFEST_FILENAME,
     SCRIPT_FILENAME, # Exclude the script file itself
     '.env', # Exclude environment variable files
     '.DS_Store', # macOS system file
@@ -284,129 +387,666 @@ ESSENTIAL_DOCS = [
     'settings.py',         # Settings files
 ]
 
-# Additional patterns to identify virtual environments
-VENV_PATTERNS = [
-    'venv', 'virtualenv', 'env', 'python3', 'python', 'city_clerk_rag', 'city-clerk-rag',
-    '.venv', '.env', 'venv_', 'env_'  # Additional common virtual environment patterns
+# Files longer than this are likely generated or library code and are skipped,
+# unless their name contains one of the exempt keywords (our own main project files)
+MAX_FILE_LINES = 2000
+MAX_FILE_SIZE_MB = 2
+LONG_FILE_EXEMPT_KEYWORDS = ['config', 'settings', 'main', 'app', 'index']
+
+# Excerpt mode: instead of being skipped, a file over the limits is cut to its first and
+# last lines around a marker with the number of lines left out. Files over the size limit
+# are memory-mapped and only their ends are touched, so the marker gives the bytes left out
+# and an estimate of their lines. EXCERPT_LIMITS overrides the limits ('max_lines',
+# 'max_size_mb', 'head_lines', 'tail_lines') per extension.
+EXCERPT_HEAD_LINES = 200
+EXCERPT_TAIL_LINES = 50
+EXCERPT_LIMITS = {
+    '.md': {'max_lines': 4000, 'tail_lines': 0},
+    '.json': {'head_lines': 60, 'tail_lines': 20},
+}
+
+# Files are sniffed from their first bytes before the full read: a NUL byte marks a
+# binary file (unless it looks like BOM-less UTF-16), a byte-order mark selects the
+# encoding, and text that is not UTF-8 is decoded with the fallback encoding
+SNIFF_BYTES = 8192
+BOM_ENCODINGS = [
+    (codecs.BOM_UTF32_LE, 'utf-32'),  # Checked before UTF-16, whose LE BOM is a prefix of it
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+FALLBACK_ENCODING = 'cp1252'
+# Control bytes that do not appear in text; a prefix with more than this share is binary
+BINARY_CONTROL_BYTES = bytes(b for b in range(32) if b not in b'\t\n\r\f\b\x1b') + b'\x7f'
+BINARY_CONTROL_RATIO = 0.3
+# Without a BOM, UTF-16 is only guessed for a prefix of at least this many bytes (an even
+# number when it is the whole file) in which this share of the code units has a NUL high
+# byte and at most the stray share has a NUL low byte
+UTF16_MIN_SNIFF_BYTES = 16
+UTF16_NUL_RATIO = 0.6
+UTF16_STRAY_NUL_RATIO = 0.05
+
+# Pipeline mode: stages hand items on in batches, each stage runs at most this many batches
+# ahead of the next one, and a waiting stage checks this often whether the run was abandoned
+PIPELINE_BATCH_SIZE = 32
+PIPELINE_QUEUE_SIZE = 8
+PIPELINE_POLL_SECONDS = 0.1
+
+# Watch mode: changes are collected until none arrive for the debounce period, then the
+# parts are regenerated. inotify is used on Linux; elsewhere the tree is stat-polled.
+WATCH_DEBOUNCE_SECONDS = 0.5
+WATCH_POLL_INTERVAL = 1.0
+INOTIFY_MODIFY = 0x2
+INOTIFY_ATTRIB = 0x4
+INOTIFY_CLOSE_WRITE = 0x8
+INOTIFY_MOVED_FROM = 0x40
+INOTIFY_MOVED_TO = 0x80
+INOTIFY_CREATE = 0x100
+INOTIFY_DELETE = 0x200
+INOTIFY_Q_OVERFLOW = 0x4000
+INOTIFY_IGNORED = 0x8000
+INOTIFY_ONLYDIR = 0x1000000
+INOTIFY_NONBLOCK = os.O_NONBLOCK
+INOTIFY_CLOEXEC = 0o2000000
+INOTIFY_CONTENT_EVENTS = INOTIFY_MODIFY | INOTIFY_ATTRIB | INOTIFY_CLOSE_WRITE
+INOTIFY_LISTING_EVENTS = INOTIFY_MOVED_FROM | INOTIFY_MOVED_TO | INOTIFY_CREATE | INOTIFY_DELETE
+INOTIFY_EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+# Ignore files read in every directory during the walk, in increasing precedence
+# (.git/info/exclude is also applied at the root, below both)
+IGNORE_FILENAMES = ['.gitignore', '.ignore']
+
+# File enumeration: walk the filesystem, or list the files tracked in the git index
+ENUMERATION_MODES = ['walk', 'git']
+GIT_INDEX_SIGNATURE = b'DIRC'
+GIT_SYMLINK_MODE = 0o120000
+GIT_GITLINK_MODE = 0o160000     # Submodule entries, which are directories
+GIT_LS_FILES_TIMEOUT = 30
+
+# Existing headers can only sit at the top of a file, so detection and stripping only
+# look at this many leading characters (extended to the end of the line they stop in)
+HEADER_SCAN_CHARS = 4096
+HEADER_SCAN_LINES = 10
+
+# Marker paths whose presence identifies a directory as a virtual environment
+VENV_MARKERS = [
+    'pyvenv.cfg',
+    os.path.join('bin', 'activate'),
+    os.path.join('Scripts', 'activate.bat'),
+    os.path.join('lib', 'python'),
+]
+
+# Wildcard patterns for excluded files, matched against the lowercased filename
+EXCLUDED_FILE_PATTERNS = [
+    '*.pyc', '*.pyo', '*.pyd', '*.so', '*.dll', '*.dylib', '*.o', '*.obj',
+    '*.exe', '*.out', '*.class', '*.jar', '*.war', '*.swp', '*.swo', '*~',
+    '*.tmp', '*.log', 'npm-debug.log*', 'yarn-debug.log*', 'yarn-error.log*',
+    'lerna-debug.log*', '*.cover', '*.py,cover',
+    # Data and output files
+    '*.csv', '*.parquet', '*.db', '*.sqlite', '*.sqlite3',
+    # GraphRAG specific files
+    'graphrag_*.log', '*_monitor_*.log', '*.lancedb',
+    # Pipeline output files with timestamps or dynamic names
+    '*_extracted.json', '*_processed.json', '*_results.json',
+    '*_output.json', '*_summary.json', '*_report.json',
+    '*_analysis.json', '*_metrics.json', '*_stats.json',
+    'pipeline_*', 'extraction_*', 'processing_*',
+    'graph_*', 'network_*', 'community_*',
+    # GraphRAG workflow files
+    'create_*.parquet', 'final_*.parquet', 'base_*.parquet',
+    # Log files from pipelines
+    '*_pipeline.log', '*_extraction.log', '*_processing.log',
+    '*_indexing.log', '*_graph.log', '*_monitor.log',
+    # Backup and temporary files
+    '*.backup', '*.bak', '*.temp', '*.cache',
+    # Export files
+    '*.gexf', '*.graphml', '*.gml', '*.gephi',
+    # Vector database files
+    '*.faiss', '*.ann', '*.hnsw', '*.ivf',
+    # Archive and compressed files that are likely outputs
+    '*_output.zip', '*_results.tar.gz', '*_export.zip',
+    # Test and debug files
+    'test_*.py', 'debug_*', '*_test.json', '*_debug.log'
+]
+
+# Library names that mark a file as third-party code when found in its filename
+LIBRARY_NAME_PATTERNS = [
+    'jquery', 'bootstrap', 'lodash', 'moment', 'axios', 'react', 'vue', 'angular',
+    'webpack', 'babel', 'eslint', 'prettier', 'typescript', 'd3.js', 'chart.js',
+    'three.js', 'socket.io', 'express', 'mongoose', 'sequelize', 'prisma',
+    'tensorflow', 'pytorch', 'numpy', 'pandas', 'scipy', 'matplotlib',
+    'requests', 'flask', 'django', 'fastapi', 'sqlalchemy', 'celery'
+]
+
+# Version numbers and build markers in filenames (suggests library files)
+LIBRARY_VERSION_PATTERNS = [
+    r'v\d+\.\d+',           # v1.2, v10.1
+    r'_v\d+\.\d+',          # _v1.2
+    r'-v\d+\.\d+',          # -v1.2
+    r'\d+\.\d+\.\d+',       # 1.2.3
+    r'_\d+\.\d+\.\d+',      # _1.2.3
+    r'-\d+\.\d+\.\d+',      # -1.2.3
+    r'\.min\.',             # minified files
+    r'\.bundle\.',          # bundled files
+]
+
+# File types that are typically libraries or unnecessary
+LIBRARY_EXTENSIONS = [
+    '.min.js', '.min.css', '.bundle.js', '.bundle.css',
+    '.map', '.min.map', '.bundle.map'
+]
+
+# Path components that suggest a file belongs to a library
+LIBRARY_PATH_INDICATORS = [
+    'lib', 'libs', 'library', 'libraries', 'vendor', 'vendors',
+    'third-party', 'third_party', 'external', 'dependencies',
+    'modules', 'packages', 'assets', 'static', 'public',
+    'dist', 'build', 'compiled', 'generated'
+]
+
+# Path components that suggest a JSON file is output
+OUTPUT_JSON_PATH_INDICATORS = [
+    'output', 'outputs', 'results', 'processed', 'generated',
+    'extracted', 'cache', 'temp', 'tmp', 'backup', 'export',
+    'reports', 'logs', 'artifacts', 'data', 'json'
+]
+
+# Filename endings that suggest a JSON file is output
+OUTPUT_JSON_SUFFIXES = [
+    '_processed.json', '_extracted.json', '_output.json', '_results.json',
+    '_cache.json', '_temp.json', '_backup.json', '_export.json',
+    '_response.json', '_data.json', '_metadata.json'
+]
+
+# Timestamp patterns in JSON filenames (suggests generated files)
+OUTPUT_JSON_TIMESTAMP_PATTERNS = [
+    r'\d{4}-\d{2}-\d{2}',  # YYYY-MM-DD
+    r'\d{8}',              # YYYYMMDD
+    r'\d{4}\d{2}\d{2}_\d{6}',  # YYYYMMDD_HHMMSS
+    r'_\d{13}\.json$',     # Unix timestamp
 ]
 
+# Metric phases, in pipeline order. 'headers' and 'minify' are done while reading and summed
+# over reader threads, so they are also part of 'read'
+METRIC_PHASES = ['walk', 'filter', 'read', 'headers', 'minify', 'select', 'distribute', 'structure', 'write']
+
+# Log levels accepted by --log-level; 'off' silences everything
+LOG_LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+    'off': logging.CRITICAL + 1,
+}
+
+# --- Logging and Metrics ---
+
+# Metrics of the run in progress (see collecting_metrics), or None when nothing is collecting.
+# A context variable, so concurrent library callers each record into their own report;
+# the stage threads of a pipelined run inherit it (see queue_stage).
+_active_metrics = contextvars.ContextVar('concatenate_scripts_metrics', default=None)
+
+class _LabelFormatter(logging.Formatter):
+    """
+    Formats records as '[LEVEL] message', labelling warnings '[WARN]' like the script's
+    original prints. The label is local to this formatter; the logging module's level names,
+    which the rest of the host process shares, are left alone.
+    """
+
+    def format(self, record):
+        label = 'WARN' if record.levelno == logging.WARNING else record.levelname
+        return f"[{label}] {record.getMessage()}"
+
+def configure_logging(level='info', stream=None):
+    """
+    Sends the module's log messages at or above level (a LOG_LEVELS name) to stream,
+    stdout by default, formatted as '[LEVEL] message'.
+    """
+    handler = logging.StreamHandler(stream if stream is not None else sys.stdout)
+    handler.setFormatter(_LabelFormatter())
+    logger.handlers = [handler]
+    logger.setLevel(LOG_LEVELS[level])
+    logger.propagate = False
+
+def new_metrics():
+    """
+    Creates an empty metrics dict: seconds per phase (METRIC_PHASES), bytes read and written,
+    file counts, rejections per exclusion rule ('category: rule' -> count) and seconds
+    spent in each predicate of should_process_file.
+    """
+    return {
+        'phases': {phase: 0.0 for phase in METRIC_PHASES},
+        'total_seconds': 0.0,
+        'bytes_read': 0,
+        'bytes_written': 0,
+        'bytes_deduplicated': 0,
+        'minify_bytes_saved': {},
+        'compression': [],
+        'files': {'considered': 0, 'included': 0, 'skipped': 0, 'read': 0, 'reused': 0, 'duplicates': 0,
+                  'excerpted': 0, 'over_budget': 0},
+        'rule_hits': {},
+        'predicate_seconds': {},
+    }
+
+@contextlib.contextmanager
+def collecting_metrics(metrics):
+    """Makes metrics the dict that phases, rule hits and predicate times are recorded into."""
+    token = _active_metrics.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _active_metrics.reset(token)
+
+@contextlib.contextmanager
+def timed_phase(phase):
+    """Adds the wall time of the enclosed block to a phase of the active metrics."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase_time(phase, start)
+
+def add_phase_time(phase, start):
+    """Adds the time since start (a time.perf_counter() value) to a phase of the active metrics."""
+    metrics = _active_metrics.get()
+    if metrics is not None:
+        phases = metrics['phases']
+        phases[phase] = phases.get(phase, 0.0) + time.perf_counter() - start
+
+def add_metric(name, amount):
+    """Adds amount to a counter (e.g. 'bytes_read') of the active metrics."""
+    metrics = _active_metrics.get()
+    if metrics is not None:
+        metrics[name] += amount
+
+def count_rule_hit(category, rule=None, count=1):
+    """Counts a file or directory rejected by an exclusion rule."""
+    metrics = _active_metrics.get()
+    if metrics is not None:
+        key = f"{category}: {rule}" if rule else category
+        hits = metrics['rule_hits']
+        hits[key] = hits.get(key, 0) + count
+
+def count_tree_exclusions(tree):
+    """Counts the entries the traversal excluded, by verdict and rule."""
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if node['excluded'] is not None:
+            count_rule_hit(node['excluded'], node.get('excluded_by'))
+        elif node['same_as'] is None:
+            stack.extend(node['children'] or [])
+
+def timed_predicate(name, func, *args):
+    """Calls func(*args), adding its time to the named predicate when metrics are being collected."""
+    metrics = _active_metrics.get()
+    if metrics is None:
+        return func(*args)
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        seconds = metrics['predicate_seconds']
+        seconds[name] = seconds.get(name, 0.0) + time.perf_counter() - start
+
+def write_metrics_report(report_path, metrics):
+    """Writes the metrics as a JSON report."""
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(metrics, f, indent=2, sort_keys=True)
+        f.write('\n')
+
 # --- Helper Functions ---
 
-def is_venv_or_node_modules(path):
+def has_venv_markers(dir_path):
+    """Returns True if the directory contains any of the virtual environment marker paths."""
+    return any(os.path.exists(os.path.join(dir_path, marker)) for marker in VENV_MARKERS)
+
+def is_venv_or_node_modules(path, verdict_cache=None):
     """
     More robust check for virtual environments and node_modules.
     Returns True if the path appears to be a virtual environment or node_modules.
+
+    When a verdict_cache dict is given, each directory is classified only once per run
+    and a directory inside an already flagged directory inherits its parent's verdict.
     """
-    path_lower = path.lower()
-    path_parts = os.path.normpath(path).split(os.sep)
-    
-    # Check for node_modules
-    if 'node_modules' in path_parts:
-        return True
-    
-    # Check if this directory itself has virtual environment indicators
-    if os.path.exists(os.path.join(path, 'pyvenv.cfg')) or \
-       os.path.exists(os.path.join(path, 'bin', 'activate')) or \
-       os.path.exists(os.path.join(path, 'Scripts', 'activate.bat')) or \
-       os.path.exists(os.path.join(path, 'lib', 'python')):
-        return True
-    
-    # Check for common virtual environment patterns, but only if the directory name itself matches
-    directory_name = os.path.basename(path).lower()
-    for pattern in VENV_PATTERNS:
-        if directory_name == pattern or directory_name.startswith(pattern + '_') or directory_name.startswith(pattern + '-'):
-            # Additional check - does it contain typical venv structures?
-            if os.path.exists(os.path.join(path, 'bin', 'activate')) or \
-               os.path.exists(os.path.join(path, 'Scripts', 'activate.bat')) or \
-               os.path.exists(os.path.join(path, 'lib', 'python')):
-                return True
-    
-    return False
+    if verdict_cache is not None:
+        verdict = verdict_cache.get(path)
+        if verdict is not None:
+            return verdict
+    path = os.path.normpath(path)
+    if verdict_cache is not None:
+        verdict = verdict_cache.get(path)
+        if verdict is not None:
+            return verdict
+        if verdict_cache.get(os.path.dirname(path)):
+            verdict_cache[path] = True
+            return True
+
+    # Check for node_modules, then for virtual environment indicators in the directory itself
+    verdict = 'node_modules' in path.split(os.sep) or has_venv_markers(path)
 
-def is_library_or_unnecessary_file(file_path, filename):
+    if verdict_cache is not None:
+        verdict_cache[path] = verdict
+    return verdict
+
+def is_file_in_venv_or_node_modules(file_path, verdict_cache=None):
     """
-    Determines if a file is a library file or unnecessarily long content that should be excluded.
-    Returns True if the file should be excluded.
+    Returns True if a file lives inside a virtual environment or node_modules.
+    Files inherit the verdict of their parent directory, so no probes are made per file.
     """
-    # Check for common library file patterns
-    library_patterns = [
-        'jquery', 'bootstrap', 'lodash', 'moment', 'axios', 'react', 'vue', 'angular',
-        'webpack', 'babel', 'eslint', 'prettier', 'typescript', 'd3.js', 'chart.js',
-        'three.js', 'socket.io', 'express', 'mongoose', 'sequelize', 'prisma',
-        'tensorflow', 'pytorch', 'numpy', 'pandas', 'scipy', 'matplotlib',
-        'requests', 'flask', 'django', 'fastapi', 'sqlalchemy', 'celery'
-    ]
-    
-    filename_lower = filename.lower()
-    
-    # Check if filename contains library patterns
-    if any(lib in filename_lower for lib in library_patterns):
-        return True
-    
-    # Check for version numbers in filename (suggests library files)
-    version_patterns = [
-        r'v\d+\.\d+',           # v1.2, v10.1
-        r'_v\d+\.\d+',          # _v1.2
-        r'-v\d+\.\d+',          # -v1.2
-        r'\d+\.\d+\.\d+',       # 1.2.3
-        r'_\d+\.\d+\.\d+',      # _1.2.3
-        r'-\d+\.\d+\.\d+',      # -1.2.3
-        r'\.min\.',             # minified files
-        r'\.bundle\.',          # bundled files
-    ]
-    
-    if any(re.search(pattern, filename_lower) for pattern in version_patterns):
-        return True
-    
-    # Check for specific file types that are typically libraries or unnecessary
-    unnecessary_extensions = [
-        '.min.js', '.min.css', '.bundle.js', '.bundle.css',
-        '.map', '.min.map', '.bundle.map'
-    ]
-    
-    if any(filename_lower.endswith(ext) for ext in unnecessary_extensions):
-        return True
-    
-    # Check if file is in a path that suggests it's a library
-    path_parts = file_path.lower().split(os.sep)
-    library_path_indicators = [
-        'lib', 'libs', 'library', 'libraries', 'vendor', 'vendors',
-        'third-party', 'third_party', 'external', 'dependencies',
-        'modules', 'packages', 'assets', 'static', 'public',
-        'dist', 'build', 'compiled', 'generated'
-    ]
-    
-    if any(indicator in path_parts for indicator in library_path_indicators):
+    if os.path.basename(file_path) == 'node_modules':
         return True
-    
-    return False
+    if not os.path.isabs(file_path):
+        file_path = os.path.abspath(file_path)
+    return is_venv_or_node_modules(os.path.dirname(file_path), verdict_cache)
+
+def sniff_utf16(prefix, complete=False):
+    """
+    Recognizes BOM-less UTF-16 from the NUL bytes that mostly-ASCII text has in every other position.
+    Returns 'utf-16-le', 'utf-16-be' or None.
+    Short samples, and whole files of odd length, are never taken for UTF-16, so a small
+    binary with a NUL or two is not decoded as text.
+    """
+    if len(prefix) < UTF16_MIN_SNIFF_BYTES or (complete and len(prefix) % 2):
+        return None
+    pairs = len(prefix) // 2
+    even_nuls = prefix[0:pairs * 2:2].count(0)
+    odd_nuls = prefix[1:pairs * 2:2].count(0)
+    if odd_nuls >= pairs * UTF16_NUL_RATIO and even_nuls <= pairs * UTF16_STRAY_NUL_RATIO:
+        return 'utf-16-le'
+    if even_nuls >= pairs * UTF16_NUL_RATIO and odd_nuls <= pairs * UTF16_STRAY_NUL_RATIO:
+        return 'utf-16-be'
+    return None
+
+def sniff_encoding(prefix, complete=False):
+    """
+    Guesses how to decode a file from its first bytes.
+    Returns the encoding to use, or None if the file looks binary.
+    complete says the prefix is the whole file; otherwise a multi-byte character cut
+    off at the end of the prefix is not counted as invalid.
+    """
+    for bom, encoding in BOM_ENCODINGS:
+        if prefix.startswith(bom):
+            return encoding
+    if b'\x00' in prefix:
+        return sniff_utf16(prefix, complete)
+
+    # Control bytes are all ASCII and valid UTF-8, so they are counted before either check
+    control_bytes = len(prefix) - len(prefix.translate(None, BINARY_CONTROL_BYTES))
+    if control_bytes > len(prefix) * BINARY_CONTROL_RATIO:
+        return None
+
+    # Mostly valid UTF-8 is decoded as UTF-8, dropping the odd invalid byte as before
+    if prefix.isascii():
+        return 'utf-8'
+    decoded = codecs.getincrementaldecoder('utf-8')('replace').decode(prefix, final=complete)
+    invalid = decoded.count('\ufffd')
+    non_ascii = len(decoded) - len(decoded.encode('ascii', errors='ignore'))
+    if invalid * 2 < non_ascii:
+        return 'utf-8'
+    return FALLBACK_ENCODING
+
+def read_file_text(file_path):
+    """
+    Reads a file with a single open and returns (text, line_count, encoding, bytes_read).
+    The first SNIFF_BYTES are read on their own to pick the encoding (see sniff_encoding);
+    a binary file returns (None, 0, None, bytes_read) without the rest being read.
+    Lines are counted on the raw bytes, and the text is decoded and newline-normalized
+    the same way as opening the file in text mode with errors='ignore'.
+    """
+    with open(file_path, 'rb') as f:
+        data = f.read(SNIFF_BYTES)
+        complete = len(data) < SNIFF_BYTES
+        encoding = sniff_encoding(data, complete)
+        if encoding is None:
+            return None, 0, None, len(data)
+        if not complete:
+            data += f.read()
+    text = data.decode(encoding, errors='ignore')
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    if encoding.startswith(('utf-16', 'utf-32')):
+        # Newline bytes are wider in these encodings, so count on the decoded text
+        line_count = text.count('\n') + (1 if text and not text.endswith('\n') else 0)
+    else:
+        line_count = count_lines(data)
+    return text, line_count, encoding, len(data)
+
+def count_lines(data):
+    """Counts lines in raw bytes like iterating a text-mode file (\n, \r\n and \r all end a line)."""
+    line_count = data.count(b'\n')
+    if b'\r' in data:
+        line_count += data.count(b'\r') - data.count(b'\r\n')
+    if data and not data.endswith((b'\n', b'\r')):
+        line_count += 1
+    return line_count
+
+def get_excerpt_limits(filename, overrides=None):
+    """
+    Returns the excerpt mode limits for a file: the defaults, updated with the EXCERPT_LIMITS
+    of its extension and then with the given overrides (extension -> limits) for it.
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    limits = {
+        'max_lines': MAX_FILE_LINES,
+        'max_size_mb': MAX_FILE_SIZE_MB,
+        'head_lines': EXCERPT_HEAD_LINES,
+        'tail_lines': EXCERPT_TAIL_LINES,
+    }
+    limits.update(EXCERPT_LIMITS.get(ext, {}))
+    if overrides:
+        limits.update(overrides.get(ext, {}))
+    return limits
+
+def parse_excerpt_limits(specs):
+    """
+    Parses per-extension excerpt limits given as 'EXT:key=value,...' strings (for example
+    '.py:max_lines=5000,tail_lines=100') into the overrides get_excerpt_limits takes.
+    Later specs for the same extension apply on top of earlier ones.
+    Raises ValueError for an unknown key or a value that is not a non-negative number.
+    """
+    overrides = {}
+    for spec in specs:
+        ext, sep, settings = spec.partition(':')
+        ext = ext.strip().lower()
+        if not sep or not ext or not settings:
+            raise ValueError(f"expected EXT:key=value,... but got {spec!r}")
+        if not ext.startswith('.'):
+            ext = '.' + ext
+        limits = overrides.setdefault(ext, {})
+        for setting in settings.split(','):
+            key, _, value = setting.partition('=')
+            key = key.strip()
+            if key not in ('max_lines', 'max_size_mb', 'head_lines', 'tail_lines'):
+                raise ValueError(f"unknown excerpt limit {key!r} in {spec!r}")
+            try:
+                limits[key] = float(value) if key == 'max_size_mb' else int(value)
+            except ValueError:
+                raise ValueError(f"{key} must be a number in {spec!r}") from None
+            if limits[key] < 0 or (key == 'max_size_mb' and limits[key] == 0):
+                raise ValueError(f"{key} must not be negative (or zero, for max_size_mb) in {spec!r}")
+    return overrides
+
+def render_excerpt(head, tail, elided_lines, line_count, elided_bytes=None):
+    """
+    Joins the first and last lines of a file around the marker for the lines left out.
+    With elided_bytes the line counts are estimates and the marker says so.
+    """
+    if head and not head.endswith('\n'):
+        head += '\n'
+    if elided_bytes is not None:
+        marker = f"[EXCERPT: {elided_bytes} bytes elided, about {elided_lines} of {line_count} lines]"
+    else:
+        marker = f"[EXCERPT: {elided_lines} of {line_count} lines elided]"
+    return f"{head}{marker}\n{tail}"
+
+def excerpt_text(text, line_count, head_lines, tail_lines):
+    """Cuts already read text to its first head_lines and last tail_lines lines (see render_excerpt)."""
+    if head_lines + tail_lines >= line_count:
+        return text
+    head_end = 0
+    for _ in range(head_lines):
+        head_end = text.find('\n', head_end) + 1
+    tail_start = len(text) - 1 if text.endswith('\n') else len(text)
+    for _ in range(tail_lines):
+        tail_start = text.rfind('\n', 0, tail_start)
+    tail_start = tail_start + 1 if tail_lines else len(text)
+    return render_excerpt(text[:head_end], text[tail_start:], line_count - head_lines - tail_lines, line_count)
+
+def _excerpt_layout(encoding, prefix):
+    """
+    Returns (newline, tail_encoding) for cutting a file sniffed as encoding at its line
+    boundaries: the encoded newline, whose length is also the code unit width newlines are
+    aligned to, and the codec for a piece of the file after its byte-order mark.
+    """
+    if encoding == 'utf-16':
+        encoding = 'utf-16-le' if prefix.startswith(codecs.BOM_UTF16_LE) else 'utf-16-be'
+    elif encoding == 'utf-32':
+        encoding = 'utf-32-le' if prefix.startswith(codecs.BOM_UTF32_LE) else 'utf-32-be'
+    elif encoding == 'utf-8-sig':
+        encoding = 'utf-8'
+    if encoding.startswith(('utf-16', 'utf-32')):
+        return '\n'.encode(encoding), encoding
+    return b'\n', encoding
+
+def _find_newline(mm, newline, start, end):
+    """Returns the first offset of newline in mm[start:end] aligned to its width, or -1."""
+    position = mm.find(newline, start, end)
+    while position >= 0 and position % len(newline):
+        position = mm.find(newline, position + 1, end)
+    return position
+
+def _rfind_newline(mm, newline, start, end):
+    """Returns the last offset of newline in mm[start:end] aligned to its width, or -1."""
+    position = mm.rfind(newline, start, end)
+    while position >= 0 and position % len(newline):
+        position = mm.rfind(newline, start, position + len(newline) - 1)
+    return position
+
+def read_file_excerpt(file_path, head_lines, tail_lines, max_bytes):
+    """
+    Memory-maps a file over the size limit and returns (text, line_count, encoding, bytes_read,
+    content_hash), where text is its first head_lines and last tail_lines lines around an
+    elision marker (see render_excerpt). Each side is also cut to max_bytes / 2, so a file
+    of a few very long lines stays within the limit.
+    Only the two ends are read: the marker gives the bytes left out, and line_count is
+    estimated from the line length at the ends. content_hash covers the two ends and the
+    file size, which is everything the excerpt shows.
+    Lines are counted on '\n', searched for in the file's encoding, so UTF-16/32 files are
+    cut the same way. A binary file returns (None, 0, None, bytes_read, None).
+    """
+    with open(file_path, 'rb') as f:
+        prefix = f.read(SNIFF_BYTES)
+        encoding = sniff_encoding(prefix, len(prefix) < SNIFF_BYTES)
+        if encoding is None:
+            return None, 0, None, len(prefix), None
+        newline, tail_encoding = _excerpt_layout(encoding, prefix)
+        width = len(newline)
+        size = os.fstat(f.fileno()).st_size
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            side_bytes = max(width, max_bytes // 2 // width * width)
+            # A line whose newline falls just past the cut is still shown whole
+            head_end = 0
+            for _ in range(head_lines):
+                position = _find_newline(mm, newline, head_end, side_bytes + width)
+                if position < 0:
+                    head_end = max(head_end, side_bytes)  # Cut inside a long line
+                    break
+                head_end = position + width
+            last = size - width if size >= width and _rfind_newline(mm, newline, size - width, size) >= 0 else size
+            floor = max(head_end, size - side_bytes) - width
+            tail_start = last
+            cut_tail = False
+            for _ in range(tail_lines):
+                position = _rfind_newline(mm, newline, max(floor, 0), tail_start)
+                if position < 0:
+                    cut_tail = tail_start > floor  # Cut inside a long line
+                    tail_start = floor
+                    break
+                tail_start = position
+            tail_start = max(tail_start + width if tail_lines else size, head_end)
+            cut_tail = cut_tail and tail_start > head_end
+            head = mm[:head_end]
+            tail = mm[tail_start:]
+
+    digest = hashlib.sha1(f"{size}\0".encode('ascii'))
+    digest.update(head)
+    digest.update(b'\0')
+    digest.update(tail)
+    head, head_newlines = _decode_excerpt(head, encoding)
+    tail, tail_newlines = _decode_excerpt(tail, tail_encoding)
+    elided_bytes = tail_start - head_end
+    shown_bytes = size - elided_bytes
+    if not elided_bytes:
+        line_count = head_newlines + tail_newlines + (1 if last == size else 0)
+        return head + tail, line_count, encoding, shown_bytes, digest.hexdigest()
+
+    # The middle is assumed to have lines as long as the ends
+    shown_lines = head_newlines + tail_newlines + (1 if last == size else 0) - (1 if cut_tail else 0)
+    elided_lines = round(elided_bytes * (head_newlines + tail_newlines) / shown_bytes) if shown_bytes else 0
+    line_count = shown_lines + elided_lines
+    text = render_excerpt(head, tail, elided_lines, line_count, elided_bytes)
+    return text, line_count, encoding, shown_bytes, digest.hexdigest()
+
+def _decode_excerpt(data, encoding):
+    """
+    Decodes one end of an excerpt like read_file_text decodes whole files.
+    Returns (text, number of '\n' newlines in it).
+    """
+    text = data.decode(encoding, errors='ignore')
+    newlines = text.count('\n')
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text, newlines
+
+def exceeds_size_limit(size_bytes, max_size_mb=MAX_FILE_SIZE_MB):
+    """Returns True if a file of this size should be skipped without being read."""
+    return size_bytes is not None and size_bytes / (1024 * 1024) > max_size_mb
+
+def exceeds_line_limit(filename, line_count, max_lines=MAX_FILE_LINES):
+    """
+    Returns True if a file with this many lines should be skipped.
+    Our main project files (see LONG_FILE_EXEMPT_KEYWORDS) are kept even if long.
+    """
+    if line_count <= max_lines:
+        return False
+    filename = filename.lower()
+    return not any(keyword in filename for keyword in LONG_FILE_EXEMPT_KEYWORDS)
+
+def get_length_limits(file_node, file_path, excerpts=None):
+    """
+    Makes the size decision for a file whose length is checked, from its scanned size.
+    Returns (max_lines, excerpt) for its read, or None if it is skipped as too long.
+    In excerpt mode (excerpts is a dict of per-extension overrides, possibly empty) no file
+    is skipped: excerpt is the file's limits (see get_excerpt_limits) and the read cuts it.
+    """
+    if excerpts is None:
+        if exceeds_size_limit(file_node['size']):
+            logger.debug("Skipping large file (%.1fMB): %s", file_node['size'] / (1024 * 1024), file_path)
+            return None
+        return MAX_FILE_LINES, None
+    excerpt = get_excerpt_limits(file_node['name'], excerpts)
+    return excerpt['max_lines'], excerpt
 
-def is_file_too_long(file_path, max_lines=2000, max_size_mb=2):
+def is_file_too_long(file_path, max_lines=MAX_FILE_LINES, max_size_mb=MAX_FILE_SIZE_MB):
     """
     Check if a file is too long and likely contains generated or library content.
     Returns True if file should be excluded due to length or size.
+    Content collection makes the same decisions from its own single read of the file.
     """
     try:
         # Check file size first (faster)
-        file_size_mb = os.path.getsize(file_path) / (1024 * 1024)
-        if file_size_mb > max_size_mb:
-            print(f"[DEBUG] Skipping large file ({file_size_mb:.1f}MB): {file_path}")
+        size = os.path.getsize(file_path)
+        if exceeds_size_limit(size, max_size_mb):
+            logger.debug("Skipping large file (%.1fMB): %s", size / (1024 * 1024), file_path)
             return True
         
         # Then check line count
-        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-            line_count = sum(1 for _ in f)
-            
-        # Skip very long files that are likely generated or library code
-        if line_count > max_lines:
-            # Allow some exceptions for our own code
-            filename = os.path.basename(file_path).lower()
-            
-            # Don't exclude our main project files even if long
-            if any(keyword in filename for keyword in ['config', 'settings', 'main', 'app', 'index']):
-                return False
-                
-            print(f"[DEBUG] Skipping long file ({line_count} lines): {file_path}")
+        with open(file_path, 'rb') as f:
+            line_count = count_lines(f.read())
+        if exceeds_line_limit(os.path.basename(file_path), line_count, max_lines):
+            logger.debug("Skipping long file (%d lines): %s", line_count, file_path)
             return True
             
     except Exception:
@@ -414,50 +1054,6 @@ def is_file_too_long(file_path, max_lines=2000, max_size_mb=2):
         
     return False
 
-def is_output_json_file(file_path, filename):
-    """
-    Determines if a JSON file is likely an output/generated file based on path and naming patterns.
-    Returns True if the JSON file should be excluded.
-    """
-    if not filename.lower().endswith('.json'):
-        return False
-    
-    # Skip JSON files in output/generated directories
-    path_parts = file_path.lower().split(os.sep)
-    output_indicators = [
-        'output', 'outputs', 'results', 'processed', 'generated', 
-        'extracted', 'cache', 'temp', 'tmp', 'backup', 'export',
-        'reports', 'logs', 'artifacts', 'data', 'json'
-    ]
-    
-    # Check if file is in a directory that suggests it's output
-    if any(indicator in path_parts for indicator in output_indicators):
-        return True
-    
-    # Check filename patterns that suggest output files
-    filename_lower = filename.lower()
-    output_patterns = [
-        '_processed.json', '_extracted.json', '_output.json', '_results.json',
-        '_cache.json', '_temp.json', '_backup.json', '_export.json',
-        '_response.json', '_data.json', '_metadata.json'
-    ]
-    
-    if any(filename_lower.endswith(pattern) for pattern in output_patterns):
-        return True
-    
-    # Check for timestamp patterns in filename (suggests generated files)
-    timestamp_patterns = [
-        r'\d{4}-\d{2}-\d{2}',  # YYYY-MM-DD
-        r'\d{8}',              # YYYYMMDD
-        r'\d{4}\d{2}\d{2}_\d{6}',  # YYYYMMDD_HHMMSS
-        r'_\d{13}\.json$',     # Unix timestamp
-    ]
-    
-    if any(re.search(pattern, filename_lower) for pattern in timestamp_patterns):
-        return True
-    
-    return False
-
 def get_comment_style(filename):
     """Gets the appropriate comment style based on file extension."""
     _, ext = os.path.splitext(filename)
@@ -497,96 +1093,359 @@ def get_comment_style(filename):
         
     # Default for unknown types
     else:
-        print(f"[WARN] Unknown file type '{ext}' for header comment. Using '# '.")
+        logger.warning("Unknown file type '%s' for header comment. Using '# '.", ext)
         return ('# ', '')
 
-def matches_excluded_pattern(filename):
+# --- Exclusion Rule Engine ---
+
+def _glob_to_regex(pattern):
+    """Translates a shell wildcard pattern into an (unanchored) regular expression."""
+    i, n = 0, len(pattern)
+    parts = []
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            parts.append('.*')
+        elif c == '?':
+            parts.append('.')
+        elif c == '[':
+            j = i
+            if j < n and pattern[j] == '!':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            while j < n and pattern[j] != ']':
+                j += 1
+            if j >= n:
+                parts.append('\\[')
+            else:
+                stuff = pattern[i:j].replace('\\', '\\\\')
+                if stuff.startswith('!'):
+                    stuff = '^' + stuff[1:]
+                elif stuff.startswith('^'):
+                    stuff = '\\' + stuff
+                parts.append(f'[{stuff}]')
+                i = j + 1
+        else:
+            parts.append(re.escape(c))
+    return ''.join(parts)
+
+def _compile_affix_table(affixes):
+    """
+    Groups literal prefixes or suffixes by length, so a name is checked with one dict
+    lookup per distinct length rather than once per affix.
+    Returns a tuple of all affixes (for a fast str.startswith/endswith pre-check)
+    and a list of (length, {affix: rule}) pairs.
+    """
+    table = {}
+    for affix, rule in affixes:
+        table.setdefault(len(affix), {}).setdefault(affix, rule)
+    return tuple(affix for affix, _ in affixes), sorted(table.items())
+
+def _match_suffix(name, table):
+    """Returns the rule of the first suffix in the table that the name ends with."""
+    affixes, by_length = table
+    if not name.endswith(affixes):
+        return None
+    for length, rules in by_length:
+        if length <= len(name):
+            rule = rules.get(name[len(name) - length:])
+            if rule is not None:
+                return rule
+    return None
+
+def _match_prefix(name, table):
+    """Returns the rule of the first prefix in the table that the name starts with."""
+    affixes, by_length = table
+    if not name.startswith(affixes):
+        return None
+    for length, rules in by_length:
+        if length <= len(name):
+            rule = rules.get(name[:length])
+            if rule is not None:
+                return rule
+    return None
+
+def _compile_alternation(patterns):
+    """
+    Combines regular expressions into one alternation with a named group per pattern.
+    Returns (compiled_regex, {group_name: pattern}), or (None, {}) for an empty list.
+    """
+    if not patterns:
+        return None, {}
+    groups = {f'r{i}': pattern for i, pattern in enumerate(patterns)}
+    combined = '|'.join(f'(?P<{name}>{pattern})' for name, pattern in groups.items())
+    return re.compile(combined, re.DOTALL), groups
+
+def _search_alternation(text, compiled):
+    """Returns the source pattern of the alternation branch that matches text, if any."""
+    regex, groups = compiled
+    if regex is None:
+        return None
+    match = regex.search(text)
+    return groups[match.lastgroup] if match else None
+
+def compile_exclusion_rules(excluded_files=None, file_patterns=None, library_names=None,
+                            version_patterns=None, library_extensions=None,
+                            library_path_indicators=None, output_path_indicators=None,
+                            output_suffixes=None, timestamp_patterns=None, excluded_dirs=None,
+                            excluded_paths=None, allowed_extensions=None, allowed_filenames=None,
+                            essential_docs=None):
+    """
+    Compiles the file exclusion lists once into hash, prefix/suffix and combined regex
+    lookups, so per-file filtering cost stays flat as the lists grow.
+    Any list that is not given defaults to the module-level configuration constant.
+    The directory and path exclusions, allowed types and essential docs are part of the
+    rules as well, so a library caller can pass its whole configuration in one value.
+    """
+    excluded_files = EXCLUDED_FILES if excluded_files is None else excluded_files
+    file_patterns = EXCLUDED_FILE_PATTERNS if file_patterns is None else file_patterns
+    library_names = LIBRARY_NAME_PATTERNS if library_names is None else library_names
+    version_patterns = LIBRARY_VERSION_PATTERNS if version_patterns is None else version_patterns
+    library_extensions = LIBRARY_EXTENSIONS if library_extensions is None else library_extensions
+    if library_path_indicators is None:
+        library_path_indicators = LIBRARY_PATH_INDICATORS
+    if output_path_indicators is None:
+        output_path_indicators = OUTPUT_JSON_PATH_INDICATORS
+    output_suffixes = OUTPUT_JSON_SUFFIXES if output_suffixes is None else output_suffixes
+    if timestamp_patterns is None:
+        timestamp_patterns = OUTPUT_JSON_TIMESTAMP_PATTERNS
+    excluded_dirs = EXCLUDED_DIRS if excluded_dirs is None else excluded_dirs
+    excluded_paths = EXCLUDED_PATHS if excluded_paths is None else excluded_paths
+    allowed_extensions = ALLOWED_EXTENSIONS if allowed_extensions is None else allowed_extensions
+    allowed_filenames = ALLOWED_FILENAMES if allowed_filenames is None else allowed_filenames
+    essential_docs = ESSENTIAL_DOCS if essential_docs is None else essential_docs
+
+    # Fingerprint of everything that decides per-file verdicts; incremental runs only
+    # reuse previous verdicts when it is unchanged
+    fingerprint = hash_content(json.dumps([
+        sorted(excluded_files), list(file_patterns), list(library_names), list(version_patterns),
+        list(library_extensions), list(library_path_indicators), list(output_path_indicators),
+        list(output_suffixes), list(timestamp_patterns),
+        list(allowed_extensions), list(allowed_filenames), list(essential_docs),
+    ]))
+
+    # Split wildcard patterns into exact names, pure '*suffix' / 'prefix*' literals and the rest
+    exact_patterns = {}
+    suffix_patterns = []
+    prefix_patterns = []
+    glob_patterns = []
+    for pattern in file_patterns:
+        pattern = pattern.lower()
+        body = pattern.strip('*')
+        if any(c in body for c in '*?['):
+            glob_patterns.append(pattern)
+        elif pattern.startswith('*') and not pattern.endswith('*'):
+            suffix_patterns.append((body, pattern))
+        elif pattern.endswith('*') and not pattern.startswith('*'):
+            prefix_patterns.append((body, pattern))
+        elif '*' in pattern:
+            glob_patterns.append(pattern)
+        else:
+            exact_patterns.setdefault(pattern, pattern)
+
+    return {
+        'excluded_files': frozenset(excluded_files),
+        'pattern_exact': exact_patterns,
+        'pattern_suffixes': _compile_affix_table(suffix_patterns),
+        'pattern_prefixes': _compile_affix_table(prefix_patterns),
+        'pattern_globs': _compile_alternation([_glob_to_regex(p) + r'\Z' for p in glob_patterns]),
+        'pattern_glob_sources': {f'r{i}': p for i, p in enumerate(glob_patterns)},
+        'library_names': _compile_alternation([re.escape(name) for name in library_names]),
+        'library_versions': _compile_alternation(list(version_patterns)),
+        'library_extensions': _compile_affix_table([(ext, ext) for ext in library_extensions]),
+        'library_paths': frozenset(library_path_indicators),
+        'output_paths': frozenset(output_path_indicators),
+        'output_suffixes': _compile_affix_table([(suffix, suffix) for suffix in output_suffixes]),
+        'output_timestamps': _compile_alternation(list(timestamp_patterns)),
+        # Directory entries containing a separator exclude that path relative to the root;
+        # the others exclude every directory with that name
+        'excluded_dirs': frozenset(excluded_dirs),
+        'excluded_dir_paths': tuple(d.replace('\\', '/') for d in excluded_dirs if '/' in d or '\\' in d),
+        'excluded_paths': tuple(excluded_paths),
+        'allowed_extensions': frozenset(allowed_extensions),
+        'allowed_filenames': frozenset(allowed_filenames),
+        'essential_docs': tuple(essential_docs),
+        'fingerprint': fingerprint,
+    }
+
+_default_exclusion_rules = None
+
+def get_default_exclusion_rules():
+    """Returns the exclusion rules compiled from the module configuration, compiling them once."""
+    global _default_exclusion_rules
+    if _default_exclusion_rules is None:
+        _default_exclusion_rules = compile_exclusion_rules()
+    return _default_exclusion_rules
+
+def match_excluded_pattern_rule(filename, rules=None):
+    """Returns the wildcard pattern that excludes filename, or None."""
+    rules = rules or get_default_exclusion_rules()
+    name = filename.lower()
+    rule = rules['pattern_exact'].get(name)
+    if rule is None:
+        rule = _match_suffix(name, rules['pattern_suffixes'])
+    if rule is None:
+        rule = _match_prefix(name, rules['pattern_prefixes'])
+    if rule is None:
+        regex, _ = rules['pattern_globs']
+        match = regex.match(name) if regex is not None else None
+        if match:
+            rule = rules['pattern_glob_sources'][match.lastgroup]
+    return rule
+
+def match_library_rule(file_path, filename, rules=None):
+    """
+    Returns the rule that marks a file as a library file or unnecessarily long content,
+    or None if the file is not excluded by any of them.
+    """
+    rules = rules or get_default_exclusion_rules()
+    filename_lower = filename.lower()
+
+    # Check if filename contains library patterns
+    regex, _ = rules['library_names']
+    match = regex.search(filename_lower) if regex is not None else None
+    if match:
+        return match.group(0)
+
+    # Check for version numbers in filename (suggests library files)
+    rule = _search_alternation(filename_lower, rules['library_versions'])
+    if rule is not None:
+        return rule
+
+    # Check for specific file types that are typically libraries or unnecessary
+    rule = _match_suffix(filename_lower, rules['library_extensions'])
+    if rule is not None:
+        return rule
+
+    # Check if file is in a path that suggests it's a library
+    library_paths = rules['library_paths']
+    for part in file_path.lower().split(os.sep):
+        if part in library_paths:
+            return part + os.sep
+
+    return None
+
+def match_output_json_rule(file_path, filename, rules=None):
+    """Returns the rule that marks a JSON file as output/generated, or None."""
+    filename_lower = filename.lower()
+    if not filename_lower.endswith('.json'):
+        return None
+    rules = rules or get_default_exclusion_rules()
+
+    # Check if file is in a directory that suggests it's output
+    output_paths = rules['output_paths']
+    for part in file_path.lower().split(os.sep):
+        if part in output_paths:
+            return part + os.sep
+
+    # Check filename patterns that suggest output files
+    rule = _match_suffix(filename_lower, rules['output_suffixes'])
+    if rule is not None:
+        return rule
+
+    # Check for timestamp patterns in filename (suggests generated files)
+    return _search_alternation(filename_lower, rules['output_timestamps'])
+
+def match_exclusion_rule(file_path, filename, rules=None):
+    """
+    Runs all compiled file exclusion rules in precedence order.
+    Returns (category, rule) for the first rule that matched, or None if the file passes.
+    """
+    rules = rules or get_default_exclusion_rules()
+    if filename in rules['excluded_files']:
+        return ('excluded file', filename)
+    rule = match_excluded_pattern_rule(filename, rules)
+    if rule is not None:
+        return ('excluded pattern', rule)
+    rule = match_library_rule(file_path, filename, rules)
+    if rule is not None:
+        return ('library', rule)
+    rule = match_output_json_rule(file_path, filename, rules)
+    if rule is not None:
+        return ('output json', rule)
+    return None
+
+def matches_excluded_pattern(filename, rules=None):
     """
     Check if filename matches any of the excluded file patterns (including wildcards).
     """
-    # Files with wildcard patterns that need special handling
-    wildcard_patterns = [
-        '*.pyc', '*.pyo', '*.pyd', '*.so', '*.dll', '*.dylib', '*.o', '*.obj',
-        '*.exe', '*.out', '*.class', '*.jar', '*.war', '*.swp', '*.swo', '*~',
-        '*.tmp', '*.log', 'npm-debug.log*', 'yarn-debug.log*', 'yarn-error.log*',
-        'lerna-debug.log*', '*.cover', '*.py,cover',
-        # Data and output files
-        '*.csv', '*.parquet', '*.db', '*.sqlite', '*.sqlite3',
-        # GraphRAG specific files
-        'graphrag_*.log', '*_monitor_*.log', '*.lancedb',
-        # Pipeline output files with timestamps or dynamic names
-        '*_extracted.json', '*_processed.json', '*_results.json',
-        '*_output.json', '*_summary.json', '*_report.json',
-        '*_analysis.json', '*_metrics.json', '*_stats.json',
-        'pipeline_*', 'extraction_*', 'processing_*',
-        'graph_*', 'network_*', 'community_*',
-        # GraphRAG workflow files
-        'create_*.parquet', 'final_*.parquet', 'base_*.parquet',
-        # Log files from pipelines
-        '*_pipeline.log', '*_extraction.log', '*_processing.log',
-        '*_indexing.log', '*_graph.log', '*_monitor.log',
-        # Backup and temporary files
-        '*.backup', '*.bak', '*.temp', '*.cache',
-        # Export files
-        '*.gexf', '*.graphml', '*.gml', '*.gephi',
-        # Vector database files
-        '*.faiss', '*.ann', '*.hnsw', '*.ivf',
-        # Archive and compressed files that are likely outputs
-        '*_output.zip', '*_results.tar.gz', '*_export.zip',
-        # Test and debug files
-        'test_*.py', 'debug_*', '*_test.json', '*_debug.log'
-    ]
-    
-    return any(fnmatch.fnmatch(filename.lower(), pattern) for pattern in wildcard_patterns)
+    return match_excluded_pattern_rule(filename, rules) is not None
+
+def is_library_or_unnecessary_file(file_path, filename, rules=None):
+    """
+    Determines if a file is a library file or unnecessarily long content that should be excluded.
+    Returns True if the file should be excluded.
+    """
+    return match_library_rule(file_path, filename, rules) is not None
+
+def is_output_json_file(file_path, filename, rules=None):
+    """
+    Determines if a JSON file is likely an output/generated file based on path and naming patterns.
+    Returns True if the JSON file should be excluded.
+    """
+    return match_output_json_rule(file_path, filename, rules) is not None
 
-def should_process_file(file_path, filename):
-    """Checks if a file should be processed based on exclusions and allowed types."""
+def is_essential_doc(file_path, rules=None):
+    """Returns True for essential documentation files that bypass the other exclusions."""
+    rules = rules or get_default_exclusion_rules()
+    # Matching the end of the path gives the same answer as matching the end of the path
+    # relative to the root, without computing relpath for every file
+    return file_path.replace('\\', '/').endswith(rules['essential_docs'])
+
+def should_process_file(file_path, filename, verdict_cache=None, rules=None, check_length=True):
+    """
+    Checks if a file should be processed based on exclusions and allowed types.
+    The optional verdict_cache is shared with the directory traversal of the same run,
+    and rules are the compiled exclusion rules (the module configuration by default).
+    With check_length=False the file is not opened; callers that already know whether
+    the file is too long (e.g. from the manifest) apply that check themselves.
+    """
     # Check if path contains node_modules or virtual environment
-    if is_venv_or_node_modules(file_path):
-        print(f"[DEBUG] Skipping file in node_modules or venv: {file_path}")
+    if timed_predicate('venv/node_modules', is_file_in_venv_or_node_modules, file_path, verdict_cache):
+        logger.debug("Skipping file in node_modules or venv: %s", file_path)
+        count_rule_hit('venv/node_modules')
         return False
     
     # Include essential documentation files regardless of other exclusions
-    relative_path = os.path.relpath(file_path, os.getcwd()).replace('\\', '/')
-    if any(relative_path == doc_path or relative_path.endswith(doc_path) for doc_path in ESSENTIAL_DOCS):
+    if timed_predicate('essential doc', is_essential_doc, file_path, rules):
         return True
     
-    # Check absolute exclusions first
-    if filename in EXCLUDED_FILES:
-        # print(f"[DEBUG] Skipping explicitly excluded file: {filename}")
-        return False
-    
-    # Check wildcard pattern exclusions
-    if matches_excluded_pattern(filename):
-        print(f"[DEBUG] Skipping file matching excluded pattern: {filename}")
-        return False
-    
-    # Check for library files and unnecessary content
-    if is_library_or_unnecessary_file(file_path, filename):
-        print(f"[DEBUG] Skipping library/unnecessary file: {filename}")
-        return False
-    
-    # Check for output JSON files
-    if is_output_json_file(file_path, filename):
-        print(f"[DEBUG] Skipping output JSON file: {filename}")
+    # Check absolute exclusions, wildcard patterns, library files and output JSON files
+    matched = timed_predicate('exclusion rules', match_exclusion_rule, file_path, filename, rules)
+    if matched is not None:
+        category, rule = matched
+        if category == 'excluded pattern':
+            logger.debug("Skipping file matching excluded pattern: %s (%s)", filename, rule)
+        elif category == 'library':
+            logger.debug("Skipping library/unnecessary file: %s (%s)", filename, rule)
+        elif category == 'output json':
+            logger.debug("Skipping output JSON file: %s (%s)", filename, rule)
+        count_rule_hit(category, rule)
         return False
     
     # Check if file is too long (likely generated/library content)
-    if is_file_too_long(file_path):
+    if check_length and timed_predicate('length', is_file_too_long, file_path):
+        count_rule_hit('too long')
         return False
         
-    # Check if it's an allowed specific filename
-    if filename in ALLOWED_FILENAMES:
-        return True
-        
-    # Check if it has an allowed extension
-    _, ext = os.path.splitext(filename)
-    if ext.lower() in ALLOWED_EXTENSIONS:
+    # Check if it's an allowed specific filename or has an allowed extension
+    if timed_predicate('allowed type', is_allowed_type, filename, rules):
         return True
         
-    # print(f"[DEBUG] Skipping file with disallowed type or name: {filename}")
+    # logger.debug("Skipping file with disallowed type or name: %s", filename)
+    count_rule_hit('disallowed type', os.path.splitext(filename)[1].lower() or filename)
     return False
 
+def is_allowed_type(filename, rules=None):
+    """Returns True for the allowed specific filenames and allowed extensions."""
+    rules = rules or get_default_exclusion_rules()
+    if filename in rules['allowed_filenames']:
+        return True
+    _, ext = os.path.splitext(filename)
+    return ext.lower() in rules['allowed_extensions']
+
 def create_file_header(file_path, relative_path):
     """
     Creates a properly formatted header for the file based on its type.
@@ -609,36 +1468,63 @@ def create_file_header(file_path, relative_path):
     
     return header
 
+# Common header patterns with capture groups
+HEADER_PATTERNS = [
+    r'^\s*(//\s*File:.*?)\n',        # JavaScript style
+    r'^\s*(#\s*File:.*?)\n',         # Python style
+    r'^\s*(/\*\s*File:.*?\*/)',       # CSS style
+    r'^\s*(<!--\s*File:.*?-->)',      # HTML style
+    r'^\s*(--\s*File:.*?)\n',        # SQL style
+]
+HEADER_STRIP_REGEXES = [
+    re.compile(f'^{pattern}\\s*', re.MULTILINE | re.DOTALL) for pattern in HEADER_PATTERNS
+] + [
+    # Multiple header blocks with separating lines
+    re.compile(r'^#{80}\s*\n^#\s*File:.*?\n^#{80}\s*\n\s*', re.MULTILINE | re.DOTALL),
+]
+TRAILING_WHITESPACE_REGEX = re.compile(r'\s*')
+
+def split_header_region(content, max_chars=HEADER_SCAN_CHARS):
+    """
+    Splits content into (head, rest), where head is the bounded prefix that may hold headers.
+    The cut is moved to the end of the line and past any whitespace that follows it, so a
+    header ending near the limit is stripped together with the blank lines after it.
+    """
+    if len(content) <= max_chars:
+        return content, ''
+    end = content.find('\n', max_chars)
+    if end == -1:
+        return content, ''
+    end = TRAILING_WHITESPACE_REGEX.match(content, end).end()
+    return content[:end], content[end:]
+
+def leading_lines(content, count=HEADER_SCAN_LINES):
+    """Returns the first count lines of content without splitting the whole string."""
+    end = -1
+    for _ in range(count):
+        end = content.find('\n', end + 1)
+        if end == -1:
+            return content
+    return content[:end]
+
 def check_for_existing_header(content, relative_path):
     """
     Checks if the file already has a header about its path.
     Returns the content with ALL existing headers removed.
+    Only a bounded prefix of the file is inspected (see HEADER_SCAN_CHARS).
     """
-    # Common header patterns with capture groups
-    header_patterns = [
-        r'^\s*(//\s*File:.*?)\n',        # JavaScript style
-        r'^\s*(#\s*File:.*?)\n',         # Python style
-        r'^\s*(/\*\s*File:.*?\*/)',       # CSS style
-        r'^\s*(<!--\s*File:.*?-->)',      # HTML style
-        r'^\s*(--\s*File:.*?)\n',        # SQL style
-    ]
+    head, rest = split_header_region(content)
     
-    # Check for and remove any header pattern at the beginning of the file
-    clean_content = content
-    
-    # First, try looking for headers at the very beginning
-    for pattern in header_patterns:
-        clean_content = re.sub(f'^{pattern}\\s*', '', clean_content, flags=re.MULTILINE|re.DOTALL)
-    
-    # Look for multiple header blocks with separating lines
-    clean_content = re.sub(r'^#{80}\s*\n^#\s*File:.*?\n^#{80}\s*\n\s*', '', clean_content, flags=re.MULTILINE|re.DOTALL)
+    # Check for and remove any header pattern at the beginning of the file.
+    # Every pattern needs 'File:', so most files skip the regex work entirely.
+    if 'File:' in head:
+        for regex in HEADER_STRIP_REGEXES:
+            head = regex.sub('', head)
+    clean_content = head + rest if rest else head
     
     # Check if we have the file path in a header anywhere in the first 10 lines
-    first_lines = content.split('\n')[:10]
-    first_block = '\n'.join(first_lines)
-    
-    file_path_pattern = re.escape(relative_path)
-    has_header = re.search(file_path_pattern, first_block) is not None
+    first_block = leading_lines(content)
+    has_header = relative_path in first_block
     
     return has_header, clean_content
 
@@ -660,115 +1546,951 @@ def prepend_header_if_needed(content, header, relative_path):
     # Add the header to the cleaned content
     return f"{header}\n\n{clean_content}"
 
-def generate_directory_structure(root_dir='.'):
-    """Generates a comprehensive text representation of the directory structure with file details."""
-    print("[DEBUG] Generating directory structure...")
-    structure = ["# Directory Structure", "#" * 80]
-    processed_paths = set() 
-    abs_root = os.path.abspath(root_dir)
-    abs_excluded_dirs = {os.path.join(abs_root, d) for d in EXCLUDED_DIRS}
-
-    def format_file_size(size_bytes):
-        """Convert bytes to human readable format."""
-        if size_bytes == 0:
-            return "0B"
-        size_names = ["B", "KB", "MB", "GB"]
-        i = 0
-        while size_bytes >= 1024 and i < len(size_names) - 1:
-            size_bytes /= 1024.0
-            i += 1
-        return f"{size_bytes:.1f}{size_names[i]}"
+# --- Minification ---
 
-    def get_file_info(file_path):
-        """Get file information including size and type."""
-        try:
-            size = os.path.getsize(file_path)
-            _, ext = os.path.splitext(file_path)
-            ext = ext.lower() if ext else 'no ext'
-            return f" ({format_file_size(size)}, {ext})"
-        except OSError:
-            return " (size unknown)"
+# String literals, comments, and the points where template literals and regex literals may start
+JS_TOKEN_REGEX = re.compile(r"""//[^\n]*|/\*.*?\*/|"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*'|[`/]""", re.DOTALL)
+JS_REGEX_LITERAL = re.compile(r'/(?![*/])(?:[^/\\\[\n]|\\.|\[(?:[^\]\\\n]|\\.)*\])+/[A-Za-z]*')
+JS_TEMPLATE_TOKEN_REGEX = re.compile(r'\\.|`|\$\{', re.DOTALL)
+JS_EXPRESSION_TOKEN_REGEX = re.compile(
+    r"""[{}`]|"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*'|//[^\n]*|/\*.*?\*/""", re.DOTALL
+)
+# A '/' after one of these characters or keywords starts a regex literal, not a division
+JS_REGEX_PRECEDING_CHARS = '(,=:[!&|?{};+-*%<>~^'
+JS_REGEX_PRECEDING_KEYWORDS = {
+    'return', 'typeof', 'instanceof', 'in', 'of', 'new', 'delete', 'void', 'throw',
+    'case', 'do', 'else', 'yield', 'await',
+}
+# A JSX element or fragment where an expression starts; React projects often keep JSX in .js files
+JSX_ELEMENT_REGEX = re.compile(r'(?:[(=,:?&|{]|=>|\breturn)\s*<(?:[A-Za-z][\w.:-]*[\s/>]|>)')
+JS_HORIZONTAL_SPACE = re.compile(r'[ \t\f\v]+')
+JS_LINE_BREAKS = re.compile(r' ?\n\s*')
 
-    def add_directory(path, prefix=""):
-        real_path = os.path.realpath(path)
-        if real_path in processed_paths:
-            structure.append(f"{prefix}[WARN] Symlink loop or duplicate processing: {path}")
-            return
-        processed_paths.add(real_path)
+CSS_TOKEN_REGEX = re.compile(r'"(?:[^"\\\n]|\\.)*"|\'(?:[^\'\\\n]|\\.)*\'|/\*.*?\*/', re.DOTALL)
+CSS_WHITESPACE = re.compile(r'\s+')
+CSS_PUNCTUATION_SPACE = re.compile(r' ?([{};,>]) ?')
 
-        # For the root directory, don't check exclusions - we want to show everything
-        is_root = (real_path == abs_root)
-        
-        if not is_root:
-            # Additional check for node_modules and virtual environments
-            if is_venv_or_node_modules(real_path):
-                structure.append(f"{prefix}[EXCLUDED] Virtual environment or node_modules: {os.path.basename(real_path)}/")
-                return
-                
-            # Check if the current directory is in an excluded path
-            if is_path_excluded(real_path, abs_root):
-                structure.append(f"{prefix}[EXCLUDED] Excluded path: {os.path.basename(real_path)}/")
-                return
-                
-            # Check if the current directory itself is excluded
-            if is_directory_excluded(real_path, abs_root):
-                structure.append(f"{prefix}[EXCLUDED] Excluded directory: {os.path.basename(real_path)}/")
-                return
-        
-        # Check if path is *under* an excluded dir (needed for topdown=False or initial call)
-        if not is_root:
-            is_under_excluded = any(real_path.startswith(excluded + os.path.sep) or real_path == excluded for excluded in abs_excluded_dirs)
-            if is_under_excluded:
-                return
+JSON_TOKEN_REGEX = re.compile(r'"(?:[^"\\]|\\.)*"|\s+')
+
+HTML_TOKEN_REGEX = re.compile(
+    r'\s*<!--(?!\[if).*?-->'                                            # Comments (not conditional ones)
+    r'|<(pre|textarea|script|style)\b.*?</\1\s*>'                       # Elements kept verbatim
+    r'|<[A-Za-z!/?][^>"\']*(?:(?:"[^"]*"|\'[^\']*\')[^>"\']*)*>'        # Tags, with quoted attribute values
+    r'|\s+',
+    re.DOTALL | re.IGNORECASE,
+)
+
+def _compact_js_code(code):
+    """Collapses spaces and drops indentation and blank lines in JS code outside literals."""
+    return JS_LINE_BREAKS.sub('\n', JS_HORIZONTAL_SPACE.sub(' ', code))
+
+def _js_regex_allowed(pieces):
+    """Returns True if a '/' following the already emitted pieces starts a regex literal."""
+    for piece in reversed(pieces):
+        stripped = piece.rstrip()
+        if not stripped:
+            continue
+        last = stripped[-1]
+        if last in JS_REGEX_PRECEDING_CHARS:
+            return True
+        if last.isalnum() or last in '_$':
+            word = re.search(r'[\w$]+$', stripped).group()
+            return word in JS_REGEX_PRECEDING_KEYWORDS
+        return False
+    return True
+
+def _skip_js_template(text, pos):
+    """Returns the index just past the template literal whose backtick is at pos."""
+    while True:
+        match = JS_TEMPLATE_TOKEN_REGEX.search(text, pos + 1)
+        if match is None:
+            return len(text)
+        pos = match.end() - 1
+        if match.group() == '`':
+            return match.end()
+        if match.group() == '${':
+            pos = _skip_js_expression(text, match.end()) - 1
+
+def _skip_js_expression(text, pos):
+    """Returns the index just past the '}' that closes a template substitution starting at pos."""
+    depth = 1
+    while True:
+        match = JS_EXPRESSION_TOKEN_REGEX.search(text, pos)
+        if match is None:
+            return len(text)
+        token = match.group()
+        pos = match.end()
+        if token == '{':
+            depth += 1
+        elif token == '}':
+            depth -= 1
+            if depth == 0:
+                return pos
+        elif token == '`':
+            pos = _skip_js_template(text, match.start())
+
+def minify_js(text, strip_comments=True):
+    """
+    Compacts JavaScript: removes comments, collapses runs of spaces and drops indentation
+    and blank lines. Line breaks are kept, since automatic semicolon insertion depends on
+    them, and string, template and regex literals are copied unchanged.
+    With strip_comments=False comments are kept as well (JSX, where '//' may be text).
+    """
+    pieces = []
+    pending = []
+    pos = 0
+    while True:
+        match = JS_TOKEN_REGEX.search(text, pos)
+        if match is None:
+            pending.append(text[pos:])
+            break
+        pending.append(text[pos:match.start()])
+        token = match.group()
+        start = match.start()
+        if token.startswith(('//', '/*')) and strip_comments:
+            # A removed block comment still separates the tokens around it
+            if token.startswith('/*'):
+                pending.append('\n' if '\n' in token else ' ')
+            pos = match.end()
+            continue
+
+        code = _compact_js_code(''.join(pending))
+        pending = []
+        pieces.append(code)
+        if token == '`':
+            end = _skip_js_template(text, start)
+        elif token == '/':
+            literal = JS_REGEX_LITERAL.match(text, start) if _js_regex_allowed(pieces) else None
+            end = literal.end() if literal else start + 1
+        else:
+            end = match.end()
+        pieces.append(text[start:end])
+        pos = end
+    pieces.append(_compact_js_code(''.join(pending)))
+    return ''.join(pieces).strip()
+
+def minify_jsx(text):
+    """Compacts JSX like minify_js, keeping comments since '//' and '/*' may be JSX text."""
+    return minify_js(text, strip_comments=False)
+
+def minify_js_file(text):
+    """Compacts a .js file with minify_jsx if it contains JSX, and with minify_js otherwise."""
+    if JSX_ELEMENT_REGEX.search(text):
+        return minify_jsx(text)
+    return minify_js(text)
+
+def minify_css(text):
+    """
+    Compacts CSS: removes comments and collapses whitespace, dropping it entirely around
+    braces, semicolons, commas and child combinators. Quoted strings are copied unchanged.
+    Whitespace around ':' is kept, since 'a :hover' and 'a:hover' select different elements.
+    """
+    pieces = []
+    pending = []
+    pos = 0
+    for match in CSS_TOKEN_REGEX.finditer(text):
+        pending.append(text[pos:match.start()])
+        pos = match.end()
+        if match.group().startswith('/*'):
+            pending.append(' ')
+            continue
+        pieces.append(_compact_css_code(''.join(pending)))
+        pending = []
+        pieces.append(match.group())
+    pending.append(text[pos:])
+    pieces.append(_compact_css_code(''.join(pending)))
+    return ''.join(pieces).strip()
+
+def _compact_css_code(code):
+    """Collapses whitespace in CSS outside strings and comments."""
+    return CSS_PUNCTUATION_SPACE.sub(r'\1', CSS_WHITESPACE.sub(' ', code))
+
+def minify_json(text):
+    """
+    Re-serializes JSON without whitespace between tokens. Strings and numbers are copied
+    as written; content that does not parse as JSON (e.g. with comments) is left as it is.
+    """
+    try:
+        json.loads(text)
+    except ValueError:
+        return text
+    return JSON_TOKEN_REGEX.sub(lambda m: m.group() if m.group().startswith('"') else '', text)
+
+def minify_html(text):
+    """
+    Compacts HTML: removes comments (except conditional comments) and collapses whitespace
+    between tags and in text to one space, or one line break if it spanned lines.
+    Tags and their attribute values, and pre, textarea, script and style elements, are
+    copied unchanged.
+    """
+    def replace(match):
+        token = match.group()
+        if token.lstrip().startswith('<!--') and not token.lstrip().startswith('<!--[if'):
+            return ''
+        if token.startswith('<'):
+            return token
+        return '\n' if '\n' in token else ' '
+    return HTML_TOKEN_REGEX.sub(replace, text).strip()
+
+# Minifiers by file extension. Other types, including Python, are never changed.
+MINIFIERS = {
+    '.js': minify_js_file,
+    '.jsx': minify_jsx,
+    '.css': minify_css,
+    '.json': minify_json,
+    '.html': minify_html,
+}
+
+def minify_block_content(content, header, filename):
+    """
+    Minifies a file's content (after prepend_header_if_needed) according to its type,
+    keeping the prepended header as it is. Returns (content, bytes_saved).
+    """
+    minifier = MINIFIERS.get(os.path.splitext(filename)[1].lower())
+    if minifier is None:
+        return content, 0
+    start = len(header) + 2 if header is not None and content.startswith(header + "\n\n") else 0
+    body = content[start:]
+    minified = minifier(body)
+    return content[:start] + minified, len(body) - len(minified)
+
+# --- Token Estimation ---
+
+def heuristic_token_count(text, filename=''):
+    """
+    Estimates the number of LLM tokens in text from a per-file-type characters-per-token ratio.
+    Runs of indentation whitespace are usually a single token, so they count as one character.
+    """
+    _, ext = os.path.splitext(filename)
+    ratio = CHARS_PER_TOKEN.get(ext.lower(), DEFAULT_CHARS_PER_TOKEN)
+    indentation = text.count('    ') * 3
+    return max(1, round((len(text) - indentation) / ratio)) if text else 0
+
+def _build_tiktoken_counter():
+    """Returns a counter using the exact tiktoken encoding."""
+    if tiktoken is None:
+        raise ValueError("The 'tiktoken' tokenizer requires the tiktoken package to be installed")
+    encoding = tiktoken.get_encoding(TIKTOKEN_ENCODING)
+    return lambda text, filename='': len(encoding.encode(text, disallowed_special=()))
+
+# Token counters by name. Each factory returns a callable(text, filename) -> int.
+TOKENIZERS = {
+    'heuristic': lambda: heuristic_token_count,
+    'tiktoken': _build_tiktoken_counter,
+}
+
+_token_counters = {}
+
+def get_token_counter(tokenizer='heuristic'):
+    """
+    Returns (name, counter) for a tokenizer given by name or as a callable(text, filename).
+    'auto' picks tiktoken when it is installed and the heuristic otherwise.
+    """
+    if callable(tokenizer):
+        return getattr(tokenizer, '__name__', 'custom'), tokenizer
+    if tokenizer == 'auto':
+        tokenizer = 'tiktoken' if tiktoken is not None else 'heuristic'
+    if tokenizer not in TOKENIZERS:
+        raise ValueError(f"Unknown tokenizer '{tokenizer}'. Choose from: {', '.join(TOKENIZERS)}")
+    if tokenizer not in _token_counters:
+        _token_counters[tokenizer] = TOKENIZERS[tokenizer]()
+    return tokenizer, _token_counters[tokenizer]
+
+def count_block_tokens(block_content, content_key, filename, token_counter, token_cache=None):
+    """
+    Counts the tokens of a rendered block, caching the result under content_key
+    (the content hash and relative path, which together determine the block).
+    """
+    if token_cache is not None and content_key is not None:
+        tokens = token_cache.get(content_key)
+        if tokens is None:
+            tokens = token_counter(block_content, filename)
+            token_cache[content_key] = tokens
+        return tokens
+    return token_counter(block_content, filename)
+
+# --- Ignore Files ---
+
+def _translate_ignore_segment(segment):
+    """Translates one path segment of an ignore pattern (no '/') into a regex."""
+    regex = []
+    i = 0
+    while i < len(segment):
+        char = segment[i]
+        i += 1
+        if char == '*':
+            regex.append('[^/]*')
+        elif char == '?':
+            regex.append('[^/]')
+        elif char == '\\' and i < len(segment):
+            regex.append(re.escape(segment[i]))
+            i += 1
+        elif char == '[':
+            # A ']' right after the opening bracket (or its negation) is a literal member
+            start = i + 1 if segment[i:i + 1] in ('!', '^') else i
+            end = segment.find(']', start + 1)
+            if end == -1:
+                regex.append('\\[')
+                continue
+            body = segment[i:end]
+            i = end + 1
+            negate = body[:1] in ('!', '^')
+            if negate:
+                body = body[1:]
+            body = body.replace('\\', '\\\\').replace('[', '\\[')
+            regex.append(f"[{'^/' if negate else ''}{body}]")
+        else:
+            regex.append(re.escape(char))
+    return ''.join(regex)
+
+def _ignore_pattern_to_regex(pattern, anchored):
+    """
+    Translates a gitignore pattern (without '!' and trailing '/') into a regex matched
+    against '/'-separated paths relative to the ignore file's directory.
+    '**' segments match any number of directories; unanchored patterns match at any depth.
+    """
+    segments = pattern.split('/')
+    regex = ''
+    for index, segment in enumerate(segments):
+        last = index == len(segments) - 1
+        if segment == '**':
+            regex += '.*' if last else '(?:.*/)?'
+        else:
+            regex += _translate_ignore_segment(segment) + ('' if last else '/')
+    return regex if anchored else '(?:.*/)?' + regex
+
+def parse_ignore_lines(lines):
+    """
+    Parses the lines of a .gitignore-style file into rule dicts with the pattern,
+    negate and dir_only flags and the translated regex, in file order.
+    """
+    rules = []
+    for line in lines:
+        line = line.rstrip('\r\n')
+        while line.endswith(' ') and not line.endswith('\\ '):
+            line = line[:-1]
+        if not line or line.startswith('#'):
+            continue
+        pattern = line
+        negate = pattern.startswith('!')
+        if negate:
+            pattern = pattern[1:]
+        dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        if not pattern:
+            continue
+        # A slash at the start or in the middle anchors the pattern to the ignore file's directory
+        anchored = '/' in pattern
+        pattern = pattern.lstrip('/')
+        rules.append({
+            'pattern': line,
+            'negate': negate,
+            'dir_only': dir_only,
+            'regex': _ignore_pattern_to_regex(pattern, anchored),
+        })
+    return rules
 
+def _compile_ignore_alternation(rules, indexes):
+    """
+    Compiles the given rules into one alternation tried from the last rule to the first,
+    so the group that matches is the rule git would apply (the last match wins).
+    """
+    if not indexes:
+        return None
+    alternatives = [f"(?P<r{index}>{rules[index]['regex']})" for index in reversed(indexes)]
+    return re.compile('|'.join(alternatives), re.DOTALL)
+
+def compile_ignore_rules(lines, base='', source=None):
+    """
+    Compiles the rules of one directory's ignore files into a level of the ignore stack.
+    base is the directory's '/'-separated path relative to the root.
+    Returns None if there are no rules.
+    """
+    rules = parse_ignore_lines(lines)
+    if not rules:
+        return None
+    file_indexes = [i for i, rule in enumerate(rules) if not rule['dir_only']]
+    return {
+        'base': base,
+        'source': source,
+        'rules': rules,
+        'dir_regex': _compile_ignore_alternation(rules, list(range(len(rules)))),
+        'file_regex': _compile_ignore_alternation(rules, file_indexes),
+    }
+
+def load_ignore_rules(dir_path, base='', filenames=IGNORE_FILENAMES, extra_files=()):
+    """
+    Reads and compiles the ignore files of one directory (extra_files first, then
+    filenames in order, so later files take precedence). Returns None if there are no rules.
+    """
+    lines = []
+    sources = []
+    for path in list(extra_files) + [os.path.join(dir_path, name) for name in filenames]:
         try:
-            items = sorted(os.listdir(path))
-        except OSError as e:
-            print(f"[WARN] Could not list directory {path}: {e}")
-            structure.append(f"{prefix}[ERROR] Cannot access directory: {e}")
+            with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+                lines.extend(f.read().splitlines())
+            sources.append(path)
+        except OSError:
+            continue
+    return compile_ignore_rules(lines, base, sources) if lines else None
+
+def match_ignore_rules(ignore_stack, rel_path, is_dir):
+    """
+    Returns the rule that decides whether rel_path ('/'-separated, relative to the root)
+    is ignored, or None if no rule matches. Levels deeper in the tree take precedence.
+    """
+    for level in reversed(ignore_stack):
+        regex = level['dir_regex'] if is_dir else level['file_regex']
+        if regex is None:
+            continue
+        base = level['base']
+        match = regex.fullmatch(rel_path[len(base) + 1:] if base else rel_path)
+        if match:
+            return level['rules'][int(match.lastgroup[1:])]
+    return None
+
+# --- Directory Traversal ---
+
+def _new_tree_node(name, path, rel_path):
+    """Creates an empty tree node. Directories get a list of children once scanned."""
+    return {
+        'name': name,
+        'path': path,
+        'rel_path': rel_path,
+        'is_dir': False,
+        'is_file': False,
+        'is_symlink': False,
+        'size': None,
+        'mtime': None,
+        'excluded': None,   # Exclusion verdict (reason string) or None if included
+        'excluded_by': None,  # The rule behind the verdict (a name, path or ignore pattern)
+        'children': None,   # List of child nodes for scanned directories
+        'error': None,      # Error message if the directory could not be listed
+        'same_as': None,    # First node seen for the same directory (symlink loops/duplicates)
+        'skipped': None,    # Reason a file was skipped during collection (e.g. 'too long')
+        'identity': None,   # (st_dev, st_ino) of a scanned directory
+        'ignore_stack': None,  # Ignore rule levels that apply to a scanned directory's children
+    }
+
+def new_scan_context(root_dir='.', verdict_cache=None, use_ignore_files=True, rules=None):
+    """
+    Creates the state shared by a scan and any later rescans of the same tree:
+    the venv verdict cache, the directories visited by (device, inode), the ignore setup
+    and the compiled exclusion rules (the module configuration by default).
+    An 'on_directory' callback may be set on the context; it is called with each directory
+    node as soon as its children are listed, before its subdirectories are scanned.
+    """
+    abs_root = os.path.abspath(root_dir)
+    # The repository's own exclude file applies at the root, below the root's ignore files
+    root_excludes = ()
+    if use_ignore_files:
+        git_dir = find_git_dir(abs_root)
+        if git_dir is not None:
+            root_excludes = (os.path.join(git_dir, 'info', 'exclude'),)
+    return {
+        'abs_root': abs_root,
+        'verdict_cache': verdict_cache if verdict_cache is not None else {},
+        # Directories are identified by (device, inode) to detect symlink loops and duplicates
+        'visited': {},
+        'use_ignore_files': use_ignore_files,
+        'root_excludes': root_excludes,
+        'rules': rules or get_default_exclusion_rules(),
+        'on_directory': None,
+    }
+
+def _scan_directory(node, identity, ignore_stack, context, previous_children=None):
+    """
+    Lists one directory into node['children'] and recursively scans its included subdirectories.
+    With previous_children (the children of an earlier scan of the same directory), a
+    subdirectory that is still the same directory keeps its scanned subtree instead of
+    being listed again.
+    """
+    visited = context['visited']
+    on_directory = context['on_directory']
+    if identity in visited and visited[identity] is not node:
+        node['same_as'] = visited[identity]
+        if on_directory is not None:
+            on_directory(node)
+        return
+    visited[identity] = node
+    node['identity'] = identity
+    node['same_as'] = None
+    node['error'] = None
+
+    try:
+        with os.scandir(node['path']) as it:
+            entries = sorted(it, key=lambda e: e.name)
+    except OSError as e:
+        logger.warning("Could not list directory %s: %s", node['path'], e)
+        node['error'] = str(e)
+        node['children'] = []
+        if on_directory is not None:
+            on_directory(node)
+        return
+
+    abs_root = context['abs_root']
+    verdict_cache = context['verdict_cache']
+    rules = context['rules']
+    dir_in_venv = is_venv_or_node_modules(node['path'], verdict_cache)
+    rel_prefix = node['rel_path'] + os.sep if node['rel_path'] else ''
+    ignore_prefix = rel_prefix.replace(os.sep, '/')
+    if context['use_ignore_files']:
+        ignore_names = [entry.name for entry in entries if entry.name in IGNORE_FILENAMES]
+        extra_files = context['root_excludes'] if not node['rel_path'] else ()
+        if ignore_names or extra_files:
+            level = load_ignore_rules(node['path'], ignore_prefix.rstrip('/'),
+                                      sorted(ignore_names, key=IGNORE_FILENAMES.index),
+                                      extra_files)
+            if level is not None:
+                ignore_stack = ignore_stack + [level]
+    node['ignore_stack'] = ignore_stack
+    previous = {child['name']: child for child in previous_children or []}
+    # Entries that are gone release their directories first, so one that was renamed
+    # is not mistaken for a duplicate of its old self
+    listed = {entry.name for entry in entries}
+    for name in [name for name in previous if name not in listed]:
+        forget_subtree(previous.pop(name), context)
+
+    children = []
+    subdirectories = []
+    for entry in entries:
+        child = _new_tree_node(entry.name, entry.path, rel_prefix + entry.name)
+        try:
+            child['is_dir'] = entry.is_dir()
+            child['is_file'] = entry.is_file()
+            child['is_symlink'] = entry.is_symlink()
+        except OSError:
+            pass
+        try:
+            st = entry.stat()
+            child['size'] = st.st_size
+            child['mtime'] = st.st_mtime
+            child_identity = (st.st_dev, st.st_ino)
+        except OSError:
+            child_identity = None
+
+        if child['is_dir']:
+            in_venv = is_venv_or_node_modules(entry.path, verdict_cache)
+        else:
+            # Files inherit the verdict of the directory being scanned
+            in_venv = dir_in_venv or entry.name == 'node_modules'
+
+        if in_venv:
+            child['excluded'] = 'venv/node_modules'
+        elif child['is_dir']:
+            if is_directory_excluded(entry.path, abs_root, rules):
+                child['excluded'] = 'excluded dir'
+                child['excluded_by'] = entry.name if entry.name in rules['excluded_dirs'] else child['rel_path']
+            elif is_path_excluded(entry.path, abs_root, rules):
+                child['excluded'] = 'excluded path'
+                child['excluded_by'] = child['rel_path']
+        elif child['is_file'] and (entry.name in rules['excluded_files'] or is_own_output(entry.name)):
+            child['excluded'] = 'excluded file'
+            child['excluded_by'] = entry.name
+        if child['excluded'] is None and ignore_stack:
+            rule = match_ignore_rules(ignore_stack, ignore_prefix + entry.name, child['is_dir'])
+            if rule is not None and not rule['negate']:
+                child['excluded'] = 'ignored'
+                child['excluded_by'] = rule['pattern']
+
+        old = previous.pop(entry.name, None)
+        if (old is not None and child['is_dir'] and child['excluded'] is None
+                and old['is_dir'] and old['excluded'] is None and old['identity'] == child_identity
+                and old['children'] is not None and old['error'] is None):
+            # Same directory as before: keep its scanned subtree
+            old.update(size=child['size'], mtime=child['mtime'], is_symlink=child['is_symlink'])
+            children.append(old)
+            continue
+        if old is not None:
+            forget_subtree(old, context)
+
+        children.append(child)
+        if child['is_dir'] and child['excluded'] is None and child_identity is not None:
+            subdirectories.append((child, child_identity))
+    node['children'] = children
+
+    # The directory is complete before any subdirectory is scanned, so a consumer
+    # of on_directory sees the directories in the order iter_tree_files walks them
+    if on_directory is not None:
+        on_directory(node)
+    for child, child_identity in subdirectories:
+        _scan_directory(child, child_identity, ignore_stack, context)
+
+def forget_subtree(node, context):
+    """Removes the directories of a subtree that is being replaced from the visited map."""
+    visited = context['visited']
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        if current['identity'] is not None and visited.get(current['identity']) is current:
+            del visited[current['identity']]
+        stack.extend(child for child in current['children'] or [] if child['is_dir'])
+
+def scan_directory_tree(root_dir='.', verdict_cache=None, use_ignore_files=True, context=None, rules=None):
+    """
+    Walks the directory tree once with os.scandir and returns an in-memory tree of entries.
+    Each node caches the DirEntry type and stat information together with its exclusion
+    verdict, so the directory structure and the content collection can both be produced
+    without touching the filesystem a second time.
+    With use_ignore_files each directory's .gitignore/.ignore rules are compiled once when
+    it is listed and stacked on its parents' rules; ignored directories are not descended.
+    Pass a context from new_scan_context to rescan parts of the tree later (see rescan_directory);
+    otherwise one is created with the given compiled exclusion rules.
+    """
+    logger.debug("Scanning directory tree: %s", root_dir)
+    if context is None:
+        context = new_scan_context(root_dir, verdict_cache, use_ignore_files, rules)
+    abs_root = context['abs_root']
+    root = _new_tree_node(os.path.basename(abs_root), abs_root, '')
+    root['is_dir'] = True
+
+    # The root itself is always listed; the verdict only matters for content collection
+    if is_venv_or_node_modules(abs_root, context['verdict_cache']):
+        root['excluded'] = 'venv/node_modules'
+
+    try:
+        st = os.stat(abs_root)
+        _scan_directory(root, (st.st_dev, st.st_ino), [], context)
+    except OSError as e:
+        logger.warning("Could not access root directory %s: %s", abs_root, e)
+        root['error'] = str(e)
+        root['children'] = []
+
+    logger.debug("Directory tree scan complete.")
+    return root
+
+def rescan_directory(node, context, recursive=False):
+    """
+    Lists a scanned directory again after entries were added, removed or renamed in it.
+    Unchanged subdirectories keep their subtrees unless recursive is set (for example
+    because the directory's ignore files changed, which affects everything below it).
+    """
+    try:
+        st = os.stat(node['path'])
+        identity = (st.st_dev, st.st_ino)
+    except OSError as e:
+        logger.warning("Could not access directory %s: %s", node['path'], e)
+        forget_subtree(node, context)
+        node['error'] = str(e)
+        node['children'] = []
+        return
+    previous_children = node['children']
+    if recursive:
+        forget_subtree(node, context)
+        previous_children = None
+    # The stored stack ends with this directory's own level, which is read again
+    own_base = node['rel_path'].replace(os.sep, '/')
+    parent_stack = [level for level in node['ignore_stack'] or [] if level['base'] != own_base]
+    _scan_directory(node, identity, parent_stack, context, previous_children)
+
+def find_git_dir(root_dir):
+    """
+    Returns the git directory of a checkout whose top level is root_dir, or None.
+    Follows the 'gitdir:' file that worktrees and submodules use instead of a .git directory.
+    """
+    dot_git = os.path.join(root_dir, '.git')
+    if os.path.isdir(dot_git):
+        return dot_git
+    try:
+        with open(dot_git, 'r', encoding='utf-8') as f:
+            line = f.readline().strip()
+    except OSError:
+        return None
+    if line.startswith('gitdir:'):
+        git_dir = os.path.join(root_dir, line[len('gitdir:'):].strip())
+        if os.path.isdir(git_dir):
+            return git_dir
+    return None
+
+def parse_git_index(index_path, hash_size=20):
+    """
+    Parses a git index file (versions 2 to 4) and returns a list of (path, mode, size, mtime)
+    for the stage-0 entries, using the stat information git cached for each path.
+    hash_size is the object id length: 20 bytes for SHA-1 repositories, 32 for SHA-256.
+    Raises ValueError for indexes this parser does not handle (split or sparse indexes),
+    in which case `git ls-files` is used instead.
+    """
+    with open(index_path, 'rb') as f:
+        data = f.read()
+    if len(data) < 12 or data[:4] != GIT_INDEX_SIGNATURE:
+        raise ValueError("not a git index file")
+    version, count = struct.unpack_from('>II', data, 4)
+    if version not in (2, 3, 4):
+        raise ValueError(f"unsupported index version {version}")
+
+    entries = []
+    pos = 12
+    previous_path = b''
+    for _ in range(count):
+        entry_start = pos
+        mtime_s, mtime_ns = struct.unpack_from('>II', data, pos + 8)
+        mode, = struct.unpack_from('>I', data, pos + 24)
+        size, = struct.unpack_from('>I', data, pos + 36)
+        flags, = struct.unpack_from('>H', data, pos + 40 + hash_size)
+        pos += 42 + hash_size
+        if version >= 3 and flags & 0x4000:
+            pos += 2  # Extended flags
+        if version == 4:
+            # The path is stored as the number of bytes to drop from the previous path
+            # (an offset varint) followed by the new suffix
+            byte = data[pos]
+            pos += 1
+            strip = byte & 0x7f
+            while byte & 0x80:
+                byte = data[pos]
+                pos += 1
+                strip = ((strip + 1) << 7) | (byte & 0x7f)
+            end = data.index(b'\0', pos)
+            path = previous_path[:len(previous_path) - strip] + data[pos:end]
+            pos = end + 1
+        else:
+            end = data.index(b'\0', pos)
+            path = data[pos:end]
+            # Entries are NUL-padded to a multiple of 8 bytes
+            pos = entry_start + ((end - entry_start) // 8 + 1) * 8
+        previous_path = path
+        if (flags >> 12) & 0x3:
+            continue  # Unmerged entries: stage 0 is missing, the conflict stages repeat the path
+        entries.append((path.decode('utf-8', errors='surrogateescape'), mode, size,
+                        mtime_s + mtime_ns / 1e9))
+
+    # A split index keeps most entries in a shared index; a sparse index stores
+    # whole directories as single entries. Neither can be listed from this file alone.
+    while pos + 8 <= len(data) - hash_size:
+        signature = data[pos:pos + 4]
+        if signature in (b'link', b'sdir'):
+            raise ValueError(f"unsupported index extension {signature.decode('ascii')}")
+        ext_size, = struct.unpack_from('>I', data, pos + 4)
+        pos += 8 + ext_size
+    return entries
+
+def run_git_ls_files(root_dir):
+    """
+    Lists the tracked files under root_dir with `git ls-files`.
+    Returns a list of (path, mode, size, mtime) without cached stat information
+    (size and mtime are None), or None if git is unavailable or root_dir is not in a checkout.
+    """
+    try:
+        result = subprocess.run(
+            ['git', 'ls-files', '--cached', '--stage', '-z'], cwd=root_dir,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=GIT_LS_FILES_TIMEOUT
+        )
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning("Could not run git ls-files: %s", e)
+        return None
+    if result.returncode != 0:
+        return None
+
+    entries = []
+    seen = set()
+    for record in result.stdout.split(b'\0'):
+        if not record:
+            continue
+        info, _, path = record.partition(b'\t')
+        mode = int(info.split(b' ', 1)[0], 8)
+        path = path.decode('utf-8', errors='surrogateescape')
+        if path not in seen:  # Unmerged paths are listed once per conflict stage
+            seen.add(path)
+            entries.append((path, mode, None, None))
+    return entries
+
+def git_hash_size(git_dir):
+    """Returns the object id length in bytes from the repository's configured object format."""
+    # Linked worktrees share the config of the main repository
+    try:
+        with open(os.path.join(git_dir, 'commondir'), 'r', encoding='utf-8') as f:
+            git_dir = os.path.join(git_dir, f.read().strip())
+    except OSError:
+        pass
+    try:
+        with open(os.path.join(git_dir, 'config'), 'r', encoding='utf-8', errors='ignore') as f:
+            config = f.read()
+    except OSError:
+        return 20
+    return 32 if re.search(r'objectformat\s*=\s*sha256', config, re.IGNORECASE) else 20
+
+def list_git_files(root_dir):
+    """
+    Returns the files tracked by git under root_dir as (path, mode, size, mtime) tuples,
+    with '/'-separated paths relative to root_dir, or None if root_dir is not in a checkout.
+    The index file is parsed directly when root_dir is the top of the checkout;
+    otherwise, or if the index cannot be parsed, `git ls-files` is used.
+    """
+    git_dir = find_git_dir(root_dir)
+    if git_dir is not None:
+        index_path = os.path.join(git_dir, 'index')
+        try:
+            entries = parse_git_index(index_path, git_hash_size(git_dir))
+            logger.debug("Read %s tracked files from %s", len(entries), index_path)
+            return entries
+        except FileNotFoundError:
+            return []  # A fresh repository with nothing staged yet
+        except (OSError, ValueError, IndexError, struct.error) as e:
+            logger.debug("Could not parse git index %s (%s); using git ls-files", index_path, e)
+    entries = run_git_ls_files(root_dir)
+    if entries is not None:
+        logger.debug("Listed %s tracked files with git ls-files", len(entries))
+    return entries
+
+def scan_git_tree(root_dir='.', verdict_cache=None, rules=None):
+    """
+    Builds the same in-memory tree as scan_directory_tree from the files tracked by git,
+    so untracked trees (node_modules, virtual environments, build output) are never visited.
+    Tracked paths are still checked against the exclusion lists of the compiled rules. Each tracked file is
+    stat'ed so that files changed or deleted since they were staged are reported correctly;
+    the sizes and mtimes cached in the index are only used if that fails.
+    Returns None if root_dir is not in a git checkout, so the caller can walk instead.
+    """
+    entries = list_git_files(root_dir)
+    if entries is None:
+        return None
+    logger.debug("Building directory tree from the git index: %s", root_dir)
+    if verdict_cache is None:
+        verdict_cache = {}
+    rules = rules or get_default_exclusion_rules()
+    abs_root = os.path.abspath(root_dir)
+    root = _new_tree_node(os.path.basename(abs_root), abs_root, '')
+    root['is_dir'] = True
+    root['children'] = []
+    if is_venv_or_node_modules(abs_root, verdict_cache):
+        root['excluded'] = 'venv/node_modules'
+
+    # Directory nodes by relative path, with their children by name until sorted below
+    directories = {'': root}
+    child_maps = {'': {}}
+    pruned = set()
+
+    def get_directory(rel_dir):
+        """Returns the node for a tracked directory, or None if it or a parent is excluded."""
+        if rel_dir in directories:
+            return directories[rel_dir]
+        if rel_dir in pruned:
+            return None
+        parent_rel, _, name = rel_dir.rpartition(os.sep)
+        parent = get_directory(parent_rel)
+        if parent is None:
+            pruned.add(rel_dir)
+            return None
+        node = _new_tree_node(name, os.path.join(abs_root, rel_dir), rel_dir)
+        node['is_dir'] = True
+        if is_venv_or_node_modules(node['path'], verdict_cache):
+            node['excluded'] = 'venv/node_modules'
+        elif is_directory_excluded(node['path'], abs_root, rules):
+            node['excluded'] = 'excluded dir'
+            node['excluded_by'] = name if name in rules['excluded_dirs'] else rel_dir
+        elif is_path_excluded(node['path'], abs_root, rules):
+            node['excluded'] = 'excluded path'
+            node['excluded_by'] = rel_dir
+        child_maps[parent_rel][name] = node
+        if node['excluded'] is not None:
+            pruned.add(rel_dir)
+            return None
+        node['children'] = []
+        directories[rel_dir] = node
+        child_maps[rel_dir] = {}
+        return node
+
+    for path, mode, cached_size, cached_mtime in entries:
+        if mode == GIT_GITLINK_MODE:
+            continue
+        rel_path = os.path.normpath(path)
+        parent_rel, _, name = rel_path.rpartition(os.sep)
+        parent = get_directory(parent_rel)
+        if parent is None:
+            continue
+        node = _new_tree_node(name, os.path.join(abs_root, rel_path), rel_path)
+        node['is_symlink'] = mode & 0o170000 == GIT_SYMLINK_MODE
+        try:
+            st = os.stat(node['path'])
+            node['is_dir'] = stat.S_ISDIR(st.st_mode)
+            node['is_file'] = stat.S_ISREG(st.st_mode)
+            node['size'] = st.st_size
+            node['mtime'] = st.st_mtime
+        except FileNotFoundError:
+            continue  # Deleted from the working tree since it was staged
+        except OSError:
+            node['is_file'] = True
+            node['size'] = cached_size
+            node['mtime'] = cached_mtime
+        if node['is_dir']:
+            node['children'] = []  # A tracked symlink to a directory is listed, not descended
+        elif is_venv_or_node_modules(parent['path'], verdict_cache) or name == 'node_modules':
+            node['excluded'] = 'venv/node_modules'
+        elif name in rules['excluded_files'] or is_own_output(name):
+            node['excluded'] = 'excluded file'
+            node['excluded_by'] = name
+        child_maps[parent_rel][name] = node
+
+    # Children are listed in name order, as scan_directory_tree does
+    for rel_dir, children in child_maps.items():
+        directories[rel_dir]['children'] = [children[name] for name in sorted(children)]
+
+    logger.debug("Git index tree complete.")
+    return root
+
+def format_file_size(size_bytes):
+    """Convert bytes to human readable format."""
+    if size_bytes == 0:
+        return "0B"
+    size_names = ["B", "KB", "MB", "GB"]
+    i = 0
+    while size_bytes >= 1024 and i < len(size_names) - 1:
+        size_bytes /= 1024.0
+        i += 1
+    return f"{size_bytes:.1f}{size_names[i]}"
+
+def generate_directory_structure(root_dir='.', tree=None):
+    """
+    Generates a comprehensive text representation of the directory structure with file details.
+    Uses the scanned tree if one is given, otherwise scans root_dir first.
+    """
+    logger.debug("Generating directory structure...")
+    if tree is None:
+        tree = scan_directory_tree(root_dir)
+    structure = ["# Directory Structure", "#" * 80]
+
+    def get_file_info(node):
+        """Get file information including size and type."""
+        if node['size'] is None:
+            return " (size unknown)"
+        _, ext = os.path.splitext(node['name'])
+        ext = ext.lower() if ext else 'no ext'
+        return f" ({format_file_size(node['size'])}, {ext})"
+
+    def add_directory(node, prefix=""):
+        if node['same_as'] is not None:
+            structure.append(f"{prefix}[WARN] Symlink loop or duplicate processing: {node['path']}")
+            return
+
+        if node['error'] is not None:
+            structure.append(f"{prefix}[ERROR] Cannot access directory: {node['error']}")
             return
 
         entries = []
         excluded_items = []
-        
-        for item in items:
-             item_path = os.path.join(path, item)
-             item_real_path = os.path.realpath(item_path)
-             
-             is_dir = os.path.isdir(item_path)
-             is_file = os.path.isfile(item_path)
-
-             # Track excluded items for summary
-             if is_venv_or_node_modules(item_path):
-                 excluded_items.append((item, "venv/node_modules"))
-                 continue
-
-             # Check directory exclusions
-             if is_dir:
-                 if not is_directory_excluded(item_path, abs_root):
-                     entries.append((item, True, None)) # Mark as directory
-                 else:
-                     excluded_items.append((item, "excluded dir"))
-             # Check file exclusions
-             elif is_file:
-                 if item not in EXCLUDED_FILES:
-                     file_info = get_file_info(item_path)
-                     entries.append((item, False, file_info)) # Mark as file with info
-                 else:
-                     excluded_items.append((item, "excluded file"))
-        
+
+        for child in node['children']:
+            # Track excluded items for summary
+            if child['excluded'] in ('venv/node_modules', 'excluded dir', 'excluded file', 'ignored'):
+                excluded_items.append((child['name'], child['excluded']))
+            elif child['is_dir'] or child['is_file']:
+                entries.append(child)
+
         # Add included entries
-        for i, (entry_name, is_dir_entry, file_info) in enumerate(entries):
+        for i, child in enumerate(entries):
             is_last = (i == len(entries) - 1) and len(excluded_items) == 0
             connector = "└── " if is_last else "├── "
-            
-            if is_dir_entry:
-                 structure.append(f"{prefix}{connector}{entry_name}/")
-                 child_prefix = prefix + ("    " if is_last else "│   ")
-                 add_directory(os.path.join(path, entry_name), child_prefix)
+
+            if child['is_dir']:
+                structure.append(f"{prefix}{connector}{child['name']}/")
+                child_prefix = prefix + ("    " if is_last else "│   ")
+                if child['excluded'] == 'excluded path':
+                    structure.append(f"{child_prefix}[EXCLUDED] Excluded path: {child['name']}/")
+                elif child['children'] is not None or child['same_as'] is not None:
+                    add_directory(child, child_prefix)
             else:
-                 structure.append(f"{prefix}{connector}{entry_name}{file_info}")
-        
+                structure.append(f"{prefix}{connector}{child['name']}{get_file_info(child)}")
+
         # Add summary of excluded items if any
         if excluded_items:
             connector = "└── " if len(entries) == 0 else "├── "
@@ -776,265 +2498,2827 @@ def generate_directory_structure(root_dir='.'):
             if len(excluded_items) > 3:
                 structure.append(f"{prefix}    ... and {len(excluded_items) - 3} more excluded items")
 
-    add_directory(os.path.abspath(root_dir))
-    print("[DEBUG] Directory structure generation complete.")
+    add_directory(tree)
+    logger.debug("Directory structure generation complete.")
     return "\n".join(structure)
 
 
-def is_path_excluded(path, root_dir):
+def is_path_excluded(path, root_dir, rules=None):
     """
     Checks if the given path is in an excluded path.
     """
+    rules = rules or get_default_exclusion_rules()
+    if not rules['excluded_paths']:
+        return False
     rel_path = os.path.relpath(path, root_dir)
-    for excluded_path in EXCLUDED_PATHS:
+    for excluded_path in rules['excluded_paths']:
         # Check if rel_path is or starts with the excluded path
         if rel_path == excluded_path or rel_path.startswith(excluded_path + os.sep):
             return True
     return False
 
-def is_directory_excluded(dir_path, root_dir):
+def is_directory_excluded(dir_path, root_dir, rules=None):
     """
     Checks if a directory should be excluded based on both simple directory names 
     and path-based exclusions.
     """
-    # Get the directory name
-    dir_name = os.path.basename(dir_path)
-    
+    rules = rules or get_default_exclusion_rules()
     # Check if the directory name itself is excluded
-    if dir_name in EXCLUDED_DIRS:
+    if os.path.basename(dir_path) in rules['excluded_dirs']:
         return True
     
-    # Get the relative path from root
+    # Check path-based exclusions (entries with a separator, normalized to '/' when compiled)
+    if not rules['excluded_dir_paths']:
+        return False
     rel_path = os.path.relpath(dir_path, root_dir).replace('\\', '/')
-    
-    # Check path-based exclusions
-    for excluded_dir in EXCLUDED_DIRS:
-        # If excluded_dir contains a path separator, treat it as a path-based exclusion
-        if '/' in excluded_dir:
-            if rel_path == excluded_dir or rel_path.startswith(excluded_dir + '/'):
-                return True
-        # Also handle Windows-style paths
-        elif '\\' in excluded_dir:
-            excluded_dir_normalized = excluded_dir.replace('\\', '/')
-            if rel_path == excluded_dir_normalized or rel_path.startswith(excluded_dir_normalized + '/'):
-                return True
+    for excluded_dir in rules['excluded_dir_paths']:
+        if rel_path == excluded_dir or rel_path.startswith(excluded_dir + '/'):
+            return True
     
     return False
 
-def collect_file_contents(root_dir='.'):
+def iter_tree_files(tree):
     """
-    Collects contents of all files to be processed, returning a list of file blocks
-    where each block contains the file path and content.
+    Yields (file_node, file_path, relative_file_path) for every non-directory entry that
+    content collection should consider, in walk order: a directory's files (sorted) first,
+    then its subdirectories. Like os.walk, symlinked directories are not descended into.
     """
-    print(f"[DEBUG] Starting content collection process. Root: {root_dir}")
-    abs_root = os.path.abspath(root_dir)
-    abs_excluded_dirs = {os.path.join(abs_root, d) for d in EXCLUDED_DIRS}
-    
-    file_blocks = []
-    
-    # --- Walk Directory and Process Files ---
-    print(f"[DEBUG] Walking directory tree from: {abs_root}")
-    processed_files_count = 0
-    skipped_files_count = 0
+    def walk(node, dir_path, relative_root):
+        # A directory first reached through a symlink is collected from its real location;
+        # its nodes carry the symlinked paths, so paths are rebuilt from the walk position
+        aliased = node['same_as'] is not None or dir_path is not None
+        source = node['same_as'] if node['same_as'] is not None else node
+        if aliased and dir_path is None:
+            dir_path, relative_root = node['path'], node['rel_path']
+        children = source['children'] or []
+
+        for child in children:
+            if not child['is_dir']:
+                if aliased:
+                    yield (child, os.path.join(dir_path, child['name']),
+                           os.path.normpath(os.path.join(relative_root, child['name'])))
+                else:
+                    yield child, child['path'], child['rel_path']
+
+        for child in children:
+            if child['is_dir'] and child['excluded'] is None and not child['is_symlink']:
+                if aliased:
+                    yield from walk(child, os.path.join(dir_path, child['name']),
+                                    os.path.join(relative_root, child['name']))
+                else:
+                    yield from walk(child, None, None)
+
+    yield from walk(tree, None, None)
+
+def count_skipped_environments(tree):
+    """Counts the virtual environment and node_modules directories pruned from the tree."""
     skipped_venv_count = 0
     skipped_node_modules_count = 0
-
-    for root, dirs, files in os.walk(abs_root, topdown=True):
-        # Skip this directory and its subdirectories if it's a virtual env or node_modules
-        if is_venv_or_node_modules(root):
-            print(f"[DEBUG] Skipping virtual environment or node_modules directory: {root}")
-            if 'node_modules' in root:
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if node['excluded'] == 'venv/node_modules' and node['is_dir']:
+            if node['name'] == 'node_modules':
                 skipped_node_modules_count += 1
             else:
                 skipped_venv_count += 1
-            dirs[:] = []  # Skip all subdirectories
-            continue
-            
-        # Skip if the current directory is in an excluded path
-        if is_path_excluded(root, abs_root):
-            print(f"[DEBUG] Skipping excluded path directory: {root}")
-            dirs[:] = []  # Skip all subdirectories
-            continue
+        stack.extend(node['children'] or [])
+    return skipped_venv_count, skipped_node_modules_count
 
-        # Filter excluded directories *before* recursion
-        dirs[:] = [d for d in dirs if not is_directory_excluded(os.path.join(root, d), abs_root) and not is_venv_or_node_modules(os.path.join(root, d))]
-        
-        files.sort()
+def hash_content(content):
+    """Returns the hex digest used to detect content changes between runs."""
+    return hashlib.sha1(content.encode('utf-8', errors='surrogatepass')).hexdigest()
+
+def load_file_text(file_path, excerpt=None):
+    """
+    Reads one file for render_file_block, timing the read (see read_file_text).
+    Returns a dict with the text, line count, encoding, bytes read, read latency in seconds
+    and the exception that stopped the read, if any.
+    With excerpt limits a file over their size limit is only read at its ends (see
+    read_file_excerpt); the text is then the excerpt and 'hash' the hash of its ends and size.
+    """
+    start = time.perf_counter()
+    loaded = {'text': None, 'line_count': 0, 'encoding': None, 'bytes_read': 0, 'error': None}
+    try:
+        max_bytes = int(excerpt['max_size_mb'] * 1024 * 1024) if excerpt is not None else None
+        if max_bytes is not None and os.path.getsize(file_path) > max_bytes:
+            (loaded['text'], loaded['line_count'], loaded['encoding'], loaded['bytes_read'],
+             loaded['hash']) = read_file_excerpt(file_path, excerpt['head_lines'], excerpt['tail_lines'], max_bytes)
+        else:
+            loaded['text'], loaded['line_count'], loaded['encoding'], loaded['bytes_read'] = read_file_text(file_path)
+    except Exception as e:
+        loaded['error'] = e
+    loaded['read_time'] = time.perf_counter() - start
+    return loaded
+
+def build_file_block(file_path, relative_file_path, keep_content=True, token_counter=None,
+                     token_cache=None, max_lines=None, minify=False, excerpt=None):
+    """Reads one file and renders its block for the concatenated output (see render_file_block)."""
+    return render_file_block(
+        file_path, relative_file_path, load_file_text(file_path, excerpt), keep_content, token_counter,
+        token_cache, max_lines, minify, excerpt
+    )
+
+def render_file_block(file_path, relative_file_path, loaded, keep_content=True, token_counter=None,
+                      token_cache=None, max_lines=None, minify=False, excerpt=None):
+    """
+    Renders the block of one file read by load_file_text for the concatenated output.
+    Returns a dict with the file path, block content, size, read latency in seconds,
+    bytes read and the seconds spent on header processing.
+    With keep_content=False only the size is kept and the content is rendered again from
+    the source file when the part is written (see get_block_content).
+    With a token_counter the block's token count is added, cached per content hash.
+    With max_lines the line limit is checked on the same read; a file over the limit,
+    or one sniffed as binary, returns a block with 'skipped' set and no content.
+    With minify the content is compacted after the header is added (see minify_block_content)
+    and the block records the bytes saved and the seconds it took.
+    With excerpt limits (see get_excerpt_limits) a file over their line limit, or one loaded
+    as an excerpt, is cut to its first and last lines instead of being skipped; the block
+    keeps the limits under 'excerpt' and its line count under 'line_count'.
+    """
+    bytes_read = loaded['bytes_read']
+    read_time = loaded['read_time']
+    header_time = 0.0
+    minify_saved = 0
+    minify_time = 0.0
+    excerpted = False
+    try:
+        if loaded['error'] is not None:
+            raise loaded['error']
+        content, line_count, encoding = loaded['text'], loaded['line_count'], loaded['encoding']
+        if content is None:
+            return {
+                'path': relative_file_path,
+                'source': file_path,
+                'skipped': 'binary',
+                'read_time': read_time,
+                'bytes_read': bytes_read,
+            }
+        if encoding not in ('utf-8', 'utf-8-sig'):
+            logger.debug("Decoding %s as %s", relative_file_path, encoding)
+        if loaded.get('hash') is not None:
+            content_hash = loaded['hash']
+            excerpted = True
+        elif excerpt is not None and exceeds_line_limit(os.path.basename(file_path), line_count,
+                                                        excerpt['max_lines']):
+            content_hash = hash_content(content)
+            content = excerpt_text(content, line_count, excerpt['head_lines'], excerpt['tail_lines'])
+            excerpted = True
+        elif max_lines is not None and exceeds_line_limit(os.path.basename(file_path), line_count, max_lines):
+            return {
+                'path': relative_file_path,
+                'source': file_path,
+                'skipped': 'too long',
+                'line_count': line_count,
+                'read_time': read_time,
+                'bytes_read': bytes_read,
+            }
+        else:
+            content_hash = hash_content(content)
+        content = content.strip()
+
+        # Create and add a properly formatted header
+        header_start = time.perf_counter()
+        header = create_file_header(file_path, relative_file_path)
+        content_with_header = prepend_header_if_needed(content, header, relative_file_path)
+        header_time = time.perf_counter() - header_start
+        if minify:
+            content_with_header, minify_saved = minify_block_content(
+                content_with_header, header, os.path.basename(file_path)
+            )
+            minify_time = time.perf_counter() - header_start - header_time
+
+        # Create the block for the concatenated output
+        block_content = []
+        block_content.append("#" * 80)
+        block_content.append(f"# File: {relative_file_path}")
+        block_content.append("#" * 80 + "\n")
+        block_content.append(content_with_header)
+        block_content.append("\n\n" + "="*80 + "\n\n")  # Separator
+
+    except Exception as e:
+        logger.warning("Error reading %s for concatenation: %s. Skipping content.", file_path, e)
+        content_hash = None
+        # Add error note as a block
+        block_content = []
+        block_content.append("#" * 80)
+        block_content.append(f"# File: {relative_file_path}")
+        block_content.append("#" * 80 + "\n")
+        block_content.append(f"[ERROR: Could not read file content due to: {e}]\n\n")
+        block_content.append("="*80 + "\n\n")
+
+    content = "\n".join(block_content)
+    block = {
+        'path': relative_file_path,
+        'source': file_path,
+        'content': content if keep_content else None,
+        'size': len(content),
+        'read_time': read_time,
+        'hash': content_hash,
+        'bytes_read': bytes_read,
+        'header_time': header_time,
+    }
+    if minify:
+        block['minify_saved'] = minify_saved
+        block['minify_time'] = minify_time
+    if excerpted:
+        block['excerpt'] = excerpt
+        block['line_count'] = line_count
+    if token_counter is not None:
+        content_key = (content_hash, relative_file_path, minify, excerpted) if content_hash else None
+        block['tokens'] = count_block_tokens(
+            content, content_key, relative_file_path, token_counter, token_cache
+        )
+    return block
+
+def get_block_content(block, minify=False):
+    """
+    Returns the rendered content of a block, re-rendering it from disk if it was not kept
+    (minified if the block was collected with minify, and cut again if it was an excerpt).
+    """
+    if block['content'] is not None:
+        return block['content']
+    # A file that turned binary since it was collected renders as empty
+    rendered = build_file_block(block['source'], block['path'], minify=minify, excerpt=block.get('excerpt'))
+    record_read_metrics([rendered])
+    return rendered.get('content', '')
+
+def record_read_metrics(blocks):
+    """Adds the bytes read and header processing time of freshly read blocks to the active metrics."""
+    add_metric('bytes_read', sum(block['bytes_read'] for block in blocks))
+    metrics = _active_metrics.get()
+    if metrics is not None:
+        metrics['phases']['headers'] += sum(block.get('header_time', 0.0) for block in blocks)
+        metrics['phases']['minify'] += sum(block.get('minify_time', 0.0) for block in blocks)
+
+def read_file_blocks(candidates, jobs=1, keep_content=True, token_counter=None, token_cache=None,
+                     minify=False):
+    """
+    Builds the blocks for a list of (file_path, relative_file_path, max_lines, excerpt)
+    candidates, where max_lines is the line limit to enforce (None for no limit) and excerpt
+    the excerpt limits that replace it in excerpt mode (see get_length_limits).
+    With jobs > 1 the files are read on a bounded thread pool; blocks are returned
+    in the same order as the candidates either way. Per-file read latency is reported.
+    """
+    def build(candidate):
+        file_path, relative_file_path, max_lines, excerpt = candidate
+        return build_file_block(
+            file_path, relative_file_path, keep_content, token_counter, token_cache, max_lines, minify,
+            excerpt
+        )
+
+    start = time.perf_counter()
+    if jobs > 1 and len(candidates) > 1:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            file_blocks = list(executor.map(build, candidates))
+    else:
+        file_blocks = [build(c) for c in candidates]
+    elapsed = time.perf_counter() - start
+    record_read_metrics(file_blocks)
+
+    for block in file_blocks:
+        logger.debug("Read %s in %.2f ms", block['path'], block['read_time'] * 1000)
+
+    if file_blocks:
+        latencies = sorted(block['read_time'] * 1000 for block in file_blocks)
+        p50 = latencies[len(latencies) // 2]
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        logger.info("Read %s files in %.3fs with %s job(s); latency p50 %.2f ms, p95 %.2f ms, max %.2f ms",
+                    len(file_blocks), elapsed, jobs, p50, p95, latencies[-1])
+    return file_blocks
+
+def collect_file_contents(root_dir='.', tree=None, verdict_cache=None, rules=None, jobs=1,
+                          keep_content=True, manifest=None, tokenizer=None, token_cache=None,
+                          block_cache=None, minify=False, excerpts=None):
+    """
+    Collects contents of all files to be processed, returning a list of file blocks
+    where each block contains the file path and content.
+    Uses the scanned tree if one is given, otherwise scans root_dir first.
+    Files are read on a pool of `jobs` threads when jobs > 1. With keep_content=False
+    the blocks only carry their size, which keeps memory independent of the corpus size.
+    Given the manifest of a previous run, files whose size and mtime are unchanged are
+    not read; their blocks carry the recorded hash and size and are rendered on write.
+    With a tokenizer (name or callable, see get_token_counter) each block also gets
+    a 'tokens' count.
+    A block_cache dict keeps the rendered blocks between runs in one process (watch mode):
+    an unchanged file reuses its cached content instead of being rendered again on write.
+    With minify each block is compacted according to its file type (see minify_block_content).
+    With excerpts (a dict of per-extension limit overrides, see get_excerpt_limits) files over
+    the size or line limits are cut to their first and last lines instead of being skipped.
+    """
+    logger.debug("Starting content collection process. Root: %s", root_dir)
+    if verdict_cache is None:
+        verdict_cache = {}
+    if tree is None:
+        tree = scan_directory_tree(root_dir, verdict_cache, rules=rules)
+
+    # --- Walk Directory Tree and Process Files ---
+    logger.debug("Walking directory tree from: %s", tree['path'])
+    processed_files_count = 0
+    skipped_files_count = 0
+
+    # Skip everything if the root itself is a virtual env or node_modules
+    if tree['excluded'] is not None:
+        logger.debug("Skipping virtual environment or node_modules directory: %s", tree['path'])
+        files = []
+    else:
+        files = iter_tree_files(tree)
 
-        relative_root = os.path.relpath(root, abs_root)
-        if relative_root == '.': relative_root = '' 
+    # Files whose size and mtime match the previous manifest are not read again, and if
+    # the rules are unchanged as well, their previous verdict is reused without re-filtering
+    rules = rules or get_default_exclusion_rules()
+    previous_files = manifest['files'] if manifest else {}
+    same_rules = bool(manifest) and manifest.get('rules') == rules['fingerprint']
+    reused_count = 0
 
-        # Safety check: ensure current root isn't inside an excluded dir
-        is_in_excluded_dir = any(root.startswith(excluded + os.path.sep) or root == excluded for excluded in abs_excluded_dirs)
-        if is_in_excluded_dir: 
+    token_counter = None
+    if tokenizer is not None:
+        tokenizer_name, token_counter = get_token_counter(tokenizer)
+        if token_cache is None:
+            token_cache = {}
+    # Recorded token counts are only reusable if they came from the same tokenizer
+    reuse_tokens = token_counter is not None and bool(manifest) and manifest.get('tokenizer') == tokenizer_name
+    # Length verdicts and excerpts recorded under other excerpt settings are made again
+    same_excerpts = bool(manifest) and manifest.get('excerpts') == excerpts
+    # Recorded blocks were rendered with or without minification; only the same setting reuses them
+    same_rendering = same_excerpts and manifest.get('minify', False) == minify
+
+    file_blocks = []
+    file_nodes = []
+    candidates = []
+    candidate_slots = []
+    filter_start = time.perf_counter()
+    for file_node, file_path, relative_file_path in files:
+        # Files the traversal already excluded (e.g. by an ignore file) are not considered again
+        if file_node['excluded'] is not None:
+            skipped_files_count += 1
             continue
+        entry = previous_files.get(relative_file_path)
+        unchanged = (
+            entry is not None
+            and entry.get('size') == file_node['size']
+            and entry.get('mtime') == file_node['mtime']
+        )
 
-        for file in files:
-            file_path = os.path.join(root, file)
-            relative_file_path = os.path.normpath(os.path.join(relative_root, file))
+        # 1. Check if file should be processed at all (type, name, exclusion)
+        if not (unchanged and same_rules) and not should_process_file(
+                file_path, file_node['name'], verdict_cache, rules, check_length=False):
+            skipped_files_count += 1
+            continue
 
-            # 1. Check if file should be processed at all (type, name, exclusion)
-            if not should_process_file(file_path, file):
+        # 2. Check if file is too long, reusing the previous verdict for unchanged files
+        if unchanged and same_excerpts and entry.get('skipped'):
+            file_node['skipped'] = entry['skipped']
+            count_rule_hit(entry['skipped'])
+            skipped_files_count += 1
+            continue
+        #    The size comes from the tree scan; the line count is taken from the content read.
+        #    An excerpt is cut again whenever the file is read.
+        length_known = unchanged and same_excerpts and not entry.get('excerpted')
+        check_length = not length_known and not is_essential_doc(file_path, rules)
+        max_lines, excerpt = None, None
+        if check_length:
+            limits = get_length_limits(file_node, file_path, excerpts)
+            if limits is None:
+                file_node['skipped'] = 'too long'
+                count_rule_hit('too long')
                 skipped_files_count += 1
                 continue
+            max_lines, excerpt = limits
 
-            # 2. Read content for concatenation
-            print(f"[DEBUG] Processing file for concatenation: {relative_file_path}")
-            processed_files_count += 1
-            try:
-                with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    content = f.read().strip()
-                
-                # 3. Create and add a properly formatted header
-                header = create_file_header(file_path, relative_file_path)
-                content_with_header = prepend_header_if_needed(content, header, relative_file_path)
-                
-                # 4. Create the block for the concatenated output
-                block_content = []
-                block_content.append("#" * 80)
-                block_content.append(f"# File: {relative_file_path}")
-                block_content.append("#" * 80 + "\n")
-                block_content.append(content_with_header) 
-                block_content.append("\n\n" + "="*80 + "\n\n")  # Separator
-                
-                file_blocks.append({
-                    'path': relative_file_path,
-                    'content': "\n".join(block_content),
-                    'size': len("\n".join(block_content))
-                })
+        logger.debug("Processing file for concatenation: %s", relative_file_path)
+        processed_files_count += 1
+        reusable = unchanged and same_rendering and entry.get('hash') and (
+            token_counter is None or (reuse_tokens and 'tokens' in entry)
+        )
+        if reusable:
+            reused_count += 1
+            block = {
+                'path': relative_file_path,
+                'source': file_path,
+                'content': None,
+                'size': entry['block_size'],
+                'read_time': 0.0,
+                'hash': entry['hash'],
+            }
+            cached = block_cache.get(relative_file_path) if block_cache else None
+            if keep_content and cached is not None and cached['hash'] == entry['hash']:
+                block['content'] = cached['content']
+            if token_counter is not None:
+                block['tokens'] = entry['tokens']
+            if minify:
+                block['minify_saved'] = entry.get('minify_saved', 0)
+            if entry.get('excerpted'):
+                block['excerpt'] = excerpt
+                block['line_count'] = entry['excerpted']
+            file_blocks.append(block)
+        else:
+            candidate_slots.append(len(file_blocks))
+            candidates.append((file_path, relative_file_path, max_lines, excerpt))
+            file_blocks.append(None)
+        file_nodes.append(file_node)
+    add_phase_time('filter', filter_start)
 
-            except Exception as e:
-                print(f"[WARN] Error reading {file_path} for concatenation: {e}. Skipping content.")
-                # Add error note as a block
-                block_content = []
-                block_content.append("#" * 80)
-                block_content.append(f"# File: {relative_file_path}")
-                block_content.append("#" * 80 + "\n")
-                block_content.append(f"[ERROR: Could not read file content due to: {e}]\n\n")
-                block_content.append("="*80 + "\n\n")
-                
-                file_blocks.append({
-                    'path': relative_file_path,
-                    'content': "\n".join(block_content),
-                    'size': len("\n".join(block_content))
-                })
-
-    print(f"[INFO] Successfully processed {processed_files_count} files")
-    print(f"[INFO] Skipped {skipped_files_count} files (excluded types/names)")
-    print(f"[INFO] Skipped {skipped_venv_count} virtual environment directories")
-    print(f"[INFO] Skipped {skipped_node_modules_count} node_modules directories")
+    # 3. Read content for concatenation, optionally on a bounded thread pool.
+    #    Results come back in submission order, so the output matches the sequential path.
+    with timed_phase('read'):
+        read_blocks = read_file_blocks(candidates, jobs, keep_content, token_counter, token_cache, minify)
+    for slot, block in zip(candidate_slots, read_blocks):
+        file_blocks[slot] = block
+
+    # Drop files found binary or too long on read, and remember the stat info the manifest records
+    kept_blocks = []
+    for block, file_node in zip(file_blocks, file_nodes):
+        if block.get('skipped'):
+            if block['skipped'] == 'binary':
+                logger.debug("Skipping binary file: %s", block['source'])
+            else:
+                logger.debug("Skipping long file (%d lines): %s", block['line_count'], block['source'])
+            file_node['skipped'] = block['skipped']
+            count_rule_hit(block['skipped'])
+            processed_files_count -= 1
+            skipped_files_count += 1
+            continue
+        block['file_size'] = file_node['size']
+        block['mtime'] = file_node['mtime']
+        kept_blocks.append(block)
+    file_blocks = kept_blocks
+    if block_cache is not None and keep_content:
+        block_cache.clear()
+        block_cache.update((block['path'], block) for block in file_blocks if block['hash'] is not None)
+    if excerpts is not None:
+        report_excerpts(file_blocks)
+
+    metrics = _active_metrics.get()
+    if metrics is not None:
+        metrics['files'].update(
+            considered=processed_files_count + skipped_files_count,
+            included=processed_files_count,
+            skipped=skipped_files_count,
+            read=len(candidates),
+            reused=reused_count,
+        )
+
+    logger.info("Successfully processed %s files", processed_files_count)
+    if manifest:
+        logger.info("Reused %s unchanged files from the manifest, read %s", reused_count, len(candidates))
+    logger.info("Skipped %s files (excluded types/names)", skipped_files_count)
+    skipped_venv_count, skipped_node_modules_count = count_skipped_environments(tree)
+    logger.info("Skipped %s virtual environment directories", skipped_venv_count)
+    logger.info("Skipped %s node_modules directories", skipped_node_modules_count)
     return file_blocks, processed_files_count, skipped_files_count
 
+def render_duplicate_block(relative_file_path, original_path):
+    """Renders the short block that stands in for a file identical to an earlier one."""
+    block_content = []
+    block_content.append("#" * 80)
+    block_content.append(f"# File: {relative_file_path}")
+    block_content.append("#" * 80 + "\n")
+    block_content.append(f"[DUPLICATE: identical to {original_path}; its content is not repeated]\n\n")
+    block_content.append("="*80 + "\n\n")
+    return "\n".join(block_content)
 
-def distribute_files_across_parts(file_blocks, num_parts=3):
+def iter_deduplicated_blocks(file_blocks, token_counter=None):
     """
-    Distributes file blocks across multiple parts ensuring roughly equal size
-    and that no file is split across parts.
+    Yields the blocks of an iterable in order, replacing every block whose content hash
+    was already seen with a short reference block to the first file with that content.
+    Only the hashes seen so far are kept, so this works on a lazy stream of blocks.
+    Files so small that the reference would be larger than their own block are kept as they are,
+    and so are excerpted files: the hash of one excerpted for size covers only the ends that
+    were read, so two files that differ in the middle would look identical.
+    The replacements are new dicts with 'duplicate_of' set; they keep the full block's
+    size (and tokens) as 'full_size' ('full_tokens') for the manifest, so the blocks
+    cached for later runs are left untouched.
+    """
+    first_paths = {}
+    for block in file_blocks:
+        content_hash = block['hash']
+        if content_hash is None or block.get('excerpt') is not None:
+            yield block
+            continue
+        original_path = first_paths.setdefault(content_hash, block['path'])
+        if original_path == block['path']:
+            yield block
+            continue
+        content = render_duplicate_block(block['path'], original_path)
+        if len(content) >= block['size']:
+            yield block
+            continue
+        duplicate = dict(block, content=content, size=len(content), duplicate_of=original_path,
+                         full_size=block['size'])
+        if 'tokens' in block:
+            duplicate['full_tokens'] = block['tokens']
+            duplicate['tokens'] = token_counter(content) if token_counter else block['tokens']
+        logger.debug("Deduplicated %s (same content as %s)", block['path'], original_path)
+        yield duplicate
+
+def deduplicate_blocks(file_blocks, token_counter=None):
+    """
+    Replaces duplicate blocks with reference blocks (see iter_deduplicated_blocks),
+    counting the tokens of the references with token_counter if the blocks have tokens.
+    Returns (blocks, duplicate_count, bytes_saved).
+    """
+    deduplicated = list(iter_deduplicated_blocks(file_blocks, token_counter))
+    duplicates = [block for block in deduplicated if block.get('duplicate_of')]
+    bytes_saved = sum(block['full_size'] - block['size'] for block in duplicates)
+    return deduplicated, len(duplicates), bytes_saved
+
+
+def report_minify_savings(file_blocks):
+    """Logs, and records in the active metrics, the bytes minification saved per file type."""
+    saved_by_type = {}
+    for block in file_blocks:
+        if block.get('minify_saved'):
+            ext = os.path.splitext(block['path'])[1].lower()
+            saved_by_type[ext] = saved_by_type.get(ext, 0) + block['minify_saved']
+    for ext, saved in sorted(saved_by_type.items()):
+        logger.info("Minified %s files: %s bytes saved", ext, saved)
+    metrics = _active_metrics.get()
+    if metrics is not None:
+        metrics['minify_bytes_saved'] = saved_by_type
+    return saved_by_type
+
+def report_excerpts(file_blocks):
+    """Logs, and records in the active metrics, the files cut to head/tail excerpts."""
+    excerpted = [block for block in file_blocks if block.get('excerpt')]
+    for block in excerpted:
+        logger.debug("Excerpted long file (%d lines): %s", block['line_count'], block['source'])
+    logger.info("Excerpted %s oversized files", len(excerpted))
+    metrics = _active_metrics.get()
+    if metrics is not None:
+        metrics['files']['excerpted'] = len(excerpted)
+    return len(excerpted)
+
+def balance_parts(file_blocks, num_parts, weight='size'):
+    """
+    Greedily assigns blocks, largest first, to the currently smallest part.
+    The smallest part is kept on a heap, so this is O(files * log(parts)).
+    Returns (parts, part_weights) where weight is the block key to balance on.
     """
-    # Calculate total size
-    total_size = sum(block['size'] for block in file_blocks)
-    target_size_per_part = total_size / num_parts
-    
-    print(f"[DEBUG] Total content size: {total_size} bytes")
-    print(f"[DEBUG] Target size per part: {target_size_per_part} bytes")
-    
     # Sort files by size (largest first) to help balance distribution
-    file_blocks.sort(key=lambda x: x['size'], reverse=True)
+    file_blocks.sort(key=lambda x: x[weight], reverse=True)
     
-    # Initialize parts
+    # Initialize parts; ties go to the lowest part index
     parts = [[] for _ in range(num_parts)]
-    part_sizes = [0] * num_parts
+    heap = [(0, i) for i in range(num_parts)]
     
     # Greedy algorithm to distribute files
     for block in file_blocks:
-        # Find the part with the smallest current size
-        smallest_part_idx = part_sizes.index(min(part_sizes))
-        
-        # Add the file to that part
+        size, smallest_part_idx = heap[0]
         parts[smallest_part_idx].append(block)
-        part_sizes[smallest_part_idx] += block['size']
+        heapq.heapreplace(heap, (size + block[weight], smallest_part_idx))
     
-    # Print the distribution results
+    part_sizes = [0] * num_parts
+    for size, i in heap:
+        part_sizes[i] = size
+    return parts, part_sizes
+
+def _path_key(block):
+    """Sort key that orders blocks by path components, keeping directory subtrees together."""
+    return block['path'].replace('\\', '/').split('/')
+
+def _boundary_depth(left_path, right_path):
+    """
+    Number of leading path components two neighbouring files share. A cut between them
+    splits the deepest common directory, so lower values are cleaner cut points.
+    """
+    left = left_path.replace('\\', '/').split('/')[:-1]
+    right = right_path.replace('\\', '/').split('/')[:-1]
+    depth = 0
+    for a, b in zip(left, right):
+        if a != b:
+            break
+        depth += 1
+    return depth
+
+def locality_parts(file_blocks, num_parts, weight='size', tolerance=DEFAULT_LOCALITY_TOLERANCE):
+    """
+    Splits blocks, sorted by path, into num_parts contiguous runs. Each cut is placed
+    within tolerance (a fraction of the target part size) of its ideal position,
+    preferring the highest-level directory boundary in that window, so a part holds
+    whole modules in path order.
+    Returns (parts, part_weights).
+    """
+    file_blocks.sort(key=_path_key)
+    cumulative = [0]
+    for block in file_blocks:
+        cumulative.append(cumulative[-1] + block[weight])
+    total = cumulative[-1]
+
+    cuts = [0]
+    for k in range(1, num_parts):
+        start = cuts[-1]
+        # Aim for an even split of what remains, so one off-target cut does not skew the rest
+        target = (total - cumulative[start]) / (num_parts - k + 1)
+        ideal = cumulative[start] + target
+        slack = tolerance * target
+        lo = max(start, bisect.bisect_left(cumulative, ideal - slack))
+        hi = min(len(file_blocks), bisect.bisect_right(cumulative, ideal + slack))
+
+        best = None
+        for i in range(max(lo, start + 1), hi + 1):
+            if i >= len(file_blocks):
+                depth = -1
+            else:
+                depth = _boundary_depth(file_blocks[i - 1]['path'], file_blocks[i]['path'])
+            score = (depth, abs(cumulative[i] - ideal))
+            if best is None or score < best[0]:
+                best = (score, i)
+
+        if best is None:
+            # No index inside the window (e.g. one very large file): take the nearest cut
+            i = bisect.bisect_left(cumulative, ideal, lo=start)
+            if i > start and (i > len(file_blocks) or ideal - cumulative[i - 1] < cumulative[i] - ideal):
+                i -= 1
+            best = (None, min(max(i, start), len(file_blocks)))
+        cuts.append(best[1])
+    cuts.append(len(file_blocks))
+
+    parts = [file_blocks[cuts[k]:cuts[k + 1]] for k in range(num_parts)]
+    part_sizes = [cumulative[cuts[k + 1]] - cumulative[cuts[k]] for k in range(num_parts)]
+    return parts, part_sizes
+
+def split_into_parts(file_blocks, num_parts, weight='size', strategy='balanced',
+                     tolerance=DEFAULT_LOCALITY_TOLERANCE):
+    """Splits blocks into num_parts with the given distribution strategy."""
+    if strategy == 'locality':
+        return locality_parts(file_blocks, num_parts, weight, tolerance)
+    if strategy != 'balanced':
+        raise ValueError(f"Unknown distribution strategy '{strategy}'")
+    return balance_parts(file_blocks, num_parts, weight)
+
+def print_part_sizes(parts, part_sizes, weight='size'):
+    """Prints the distribution results."""
+    unit = 'bytes' if weight == 'size' else 'tokens'
     for i, size in enumerate(part_sizes):
-        print(f"[INFO] Part {i+1} size: {size} bytes ({len(parts[i])} files)")
+        logger.info("Part %s size: %s %s (%s files)", i+1, size, unit, len(parts[i]))
+
+def distribute_files_across_parts(file_blocks, num_parts=3, weight='size', strategy='balanced',
+                                  tolerance=DEFAULT_LOCALITY_TOLERANCE):
+    """
+    Distributes file blocks across multiple parts ensuring roughly equal size
+    and that no file is split across parts. weight selects the block measure to
+    balance: 'size' (characters) or 'tokens'. strategy is 'balanced' (largest files
+    first) or 'locality' (contiguous directory subtrees in path order, each part within
+    tolerance of the target size where a directory boundary allows).
+    """
+    # Calculate total size
+    total_size = sum(block[weight] for block in file_blocks)
+    target_size_per_part = total_size / num_parts
+    
+    logger.debug("Total content %s: %s", weight, total_size)
+    logger.debug("Target %s per part: %s", weight, target_size_per_part)
     
+    parts, part_sizes = split_into_parts(file_blocks, num_parts, weight, strategy, tolerance)
+    print_part_sizes(parts, part_sizes, weight)
+    return parts
+
+def distribute_files_by_budget(file_blocks, budget, weight='tokens', overhead=0, first_part_overhead=0,
+                               strategy='balanced', tolerance=DEFAULT_LOCALITY_TOLERANCE):
+    """
+    Splits file blocks into as few balanced parts as possible such that no part exceeds
+    the budget. overhead is reserved in every part (header and file index) and
+    first_part_overhead additionally in part 1 (directory structure).
+    A block larger than the available budget gets a part of its own, after the others;
+    these are set aside before the search below.
+    The part count is found by binary search over the split strategy: O(log files) splits,
+    each O(files * log(parts)). The search assumes that a split that fits keeps fitting
+    with more parts, which needs every block to fit a part on its own (hence setting the
+    oversized ones aside). The split heuristics do not strictly guarantee it, so the count
+    found may not be the smallest possible. If no count fits, parts are filled in order.
+    """
+    capacity = budget - overhead
+    first_capacity = capacity - first_part_overhead
+    unit = 'bytes' if weight == 'size' else 'tokens'
+    if first_capacity <= 0:
+        raise ValueError(
+            f"Budget of {budget} {unit} leaves no room for files after the part overhead "
+            f"({overhead + first_part_overhead} {unit})"
+        )
+
+    oversized = [block for block in file_blocks if block[weight] > capacity]
+    blocks = [block for block in file_blocks if block[weight] <= capacity]
+    total_size = sum(block[weight] for block in blocks)
+    logger.debug("Total content %s: %s; budget per part: %s", weight, total_size, budget)
+
+    def split(num_parts):
+        """Returns (parts, part_sizes, fits) for num_parts, with the part for the structure first."""
+        if strategy == 'balanced':
+            # The structure is balanced like a block of its own, and the part that gets it
+            # becomes part 1, so that part holds correspondingly fewer files
+            structure = {'path': '', weight: first_part_overhead}
+            parts, part_sizes = split_into_parts(blocks + [structure], num_parts, weight, strategy, tolerance)
+            first = next(i for i, part in enumerate(parts) if any(block is structure for block in part))
+            parts[first] = [block for block in parts[first] if block is not structure]
+            part_sizes[first] -= first_part_overhead
+            order = [first] + [i for i in range(num_parts) if i != first]
+            parts = [parts[i] for i in order]
+            part_sizes = [part_sizes[i] for i in order]
+        else:
+            parts, part_sizes = split_into_parts(blocks, num_parts, weight, strategy, tolerance)
+        fits = part_sizes[0] <= first_capacity and all(size <= capacity for size in part_sizes[1:])
+        return parts, part_sizes, fits
+
+    parts, part_sizes = [], []
+    if blocks:
+        # One part more than there are blocks always fits the balanced split: the structure
+        # gets part 1 to itself and every block fits a part on its own
+        low = max(1, -(-(total_size + first_part_overhead) // capacity))
+        high = max(low, len(blocks) + 1)
+        best = split(high)
+        while low < high:
+            middle = (low + high) // 2
+            result = split(middle)
+            if result[2]:
+                best = result
+                high = middle
+            else:
+                low = middle + 1
+        parts, part_sizes, fits = best
+        if not fits:
+            # A locality split can miss at any count; fill parts in path order instead
+            parts, part_sizes = _fill_to_capacity(blocks, weight, first_capacity, capacity)
+
+    if oversized:
+        logger.warning("%s files exceed the budget of %s %s on their own", len(oversized), budget, unit)
+        parts += [[block] for block in oversized]
+        part_sizes += [block[weight] for block in oversized]
+    if not parts:
+        parts, part_sizes = [[]], [0]
+    print_part_sizes(parts, part_sizes, weight)
     return parts
 
+def _fill_to_capacity(blocks, weight, first_capacity, capacity):
+    """
+    Assigns blocks in order to consecutive parts of at most capacity (first_capacity for
+    part 1), leaving part 1 empty if the first block does not fit it.
+    Returns (parts, part_sizes).
+    """
+    parts = [[]]
+    part_sizes = [0]
+    for block in blocks:
+        limit = first_capacity if len(parts) == 1 else capacity
+        if part_sizes[-1] + block[weight] > limit and (parts[-1] or len(parts) == 1):
+            parts.append([])
+            part_sizes.append(0)
+        parts[-1].append(block)
+        part_sizes[-1] += block[weight]
+    return parts, part_sizes
+
+
+def fill_parts(file_blocks, part_size, weight='size'):
+    """
+    Assigns blocks in collection order to consecutive parts, starting a new part when the
+    next block would take the current one over part_size. No later block is needed to
+    place one, so the pipeline (see run_pipeline) cuts its parts the same way as blocks arrive.
+    A block larger than part_size gets a part of its own.
+    """
+    parts = [[]]
+    part_sizes = [0]
+    for block in file_blocks:
+        if parts[-1] and part_sizes[-1] + block[weight] > part_size:
+            parts.append([])
+            part_sizes.append(0)
+        parts[-1].append(block)
+        part_sizes[-1] += block[weight]
+    print_part_sizes(parts, part_sizes, weight)
+    return parts
+
+
+def file_index_line(block, show_tokens=False):
+    """Returns the line that lists one block in the file index."""
+    duplicate_of = block.get('duplicate_of')
+    if show_tokens and duplicate_of:
+        return f"  - {block['path']} (~{block['tokens']} tokens, same as {duplicate_of})"
+    if show_tokens:
+        return f"  - {block['path']} (~{block['tokens']} tokens)"
+    if duplicate_of:
+        return f"  - {block['path']} (same as {duplicate_of})"
+    return f"  - {block['path']}"
 
-def write_parts_to_files(parts, root_dir='.'):
-    """Writes each part to a separate file without duplicating content."""
+def build_file_index(parts, show_tokens=False, over_budget=None, list_over_budget=True, listed_part=None):
+    """
+    Creates the file index showing which files are in which parts.
+    With show_tokens the token count of every file and part is listed as well.
+    over_budget are the blocks left out to fit the total budget (see select_files_by_priority);
+    they are listed only with list_over_budget, and otherwise just counted.
+    With listed_part (a part number) only that part's files are listed and the other parts
+    are counted, so the index of a part grows with its own files alone.
+    """
+    file_index = ["# File Index - Which Files Are in Which Parts", "#" * 80]
+    for i, part in enumerate(parts, 1):
+        if listed_part is not None and i != listed_part:
+            continue
+        if show_tokens:
+            part_tokens = sum(block['tokens'] for block in part)
+            file_index.append(f"\n## Part {i} ({len(part)} files, ~{part_tokens} tokens):")
+        else:
+            file_index.append(f"\n## Part {i} ({len(part)} files):")
+        for block in part:
+            file_index.append(file_index_line(block, show_tokens))
+    if listed_part is not None and len(parts) > 1:
+        file_index.append(f"\n## Other parts: {len(parts) - 1} (each lists its own files)")
+    if over_budget and not list_over_budget:
+        file_index.append(f"\n## Excluded for budget ({len(over_budget)} files, listed in part 1)")
+    elif over_budget:
+        file_index.append(f"\n## Excluded for budget ({len(over_budget)} files):")
+        for block in over_budget:
+            if show_tokens:
+                file_index.append(f"  - {block['path']} (~{block['tokens']} tokens)")
+            else:
+                file_index.append(f"  - {block['path']} ({block['size']} characters)")
+    return "\n".join(file_index)
+
+
+def render_part_header(part_number, num_parts, timestamp, abs_root):
+    """
+    Renders the header lines of a part. With num_parts None the part count is not known
+    yet (see run_pipeline), and the header points to the index at the end of the last part.
+    """
+    if num_parts is None:
+        return (
+            f"# Concatenated Project Code - Part {part_number}\n"
+            f"# Generated: {timestamp}\n"
+            f"# Root Directory: {abs_root}\n"
+            f"# The file index and directory structure follow the last file of the last part\n"
+            f"{'='*80}\n"
+        )
+    return (
+        f"# Concatenated Project Code - Part {part_number} of {num_parts}\n"
+        f"# Generated: {timestamp}\n"
+        f"# Root Directory: {abs_root}\n"
+        f"{'='*80}\n"
+    )
+
+def render_part_prefix(part_number, num_parts, timestamp, abs_root, directory_structure, file_index_content):
+    """
+    Renders what every part starts with: its header, the directory structure (part 1 only)
+    and the file index of all parts.
+    """
+    # Add header
+    prefix = render_part_header(part_number, num_parts, timestamp, abs_root)
+    
+    # Add directory structure only to part 1
+    if part_number == 1:
+        prefix += "\n" + directory_structure
+        prefix += "\n" + "\n\n" + "="*80 + "\n\n"
+    
+    # Add file index to all parts for navigation
+    prefix += "\n" + file_index_content
+    prefix += "\n" + "\n\n" + "="*80 + "\n\n"
+    return prefix
+
+def render_part_trailer(directory_structure, file_index_content):
+    """Renders what run_pipeline appends to its last part: the file index of all parts and the directory structure."""
+    return (
+        "\n" + "="*80 + "\n\n" + file_index_content
+        + "\n" + "\n\n" + "="*80 + "\n\n" + directory_structure + "\n"
+    )
+
+def measure_part_overhead(abs_root, directory_structure, token_counter, over_budget=None):
+    """
+    Returns (overhead, first_part_overhead) in tokens for a token budget: what every part
+    spends on its header and file index besides the index lines of its own files, and what
+    part 1 spends on top of that on the directory structure and the files left out for the
+    total budget. Each includes PART_OVERHEAD_MARGIN_TOKENS for the counts filled in later.
+    """
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    placeholder_parts = [[], []]
+    other_prefix = render_part_prefix(
+        2, 2, timestamp, abs_root, directory_structure,
+        build_file_index(placeholder_parts, True, over_budget, False, listed_part=2)
+    )
+    first_prefix = render_part_prefix(
+        1, 2, timestamp, abs_root, directory_structure,
+        build_file_index(placeholder_parts, True, over_budget, listed_part=1)
+    )
+    overhead = token_counter(other_prefix) + PART_OVERHEAD_MARGIN_TOKENS
+    return overhead, max(0, token_counter(first_prefix) + PART_OVERHEAD_MARGIN_TOKENS - overhead)
+
+def encode_part_text(text):
+    """Encodes text as it is written into a part: UTF-8 with the platform's line endings."""
+    data = text.encode('utf-8')
+    if os.linesep != '\n':
+        data = data.replace(b'\n', os.linesep.encode('ascii'))
+    return data
+
+def write_parts_to_files(parts, root_dir='.', tree=None, part_numbers=None, directory_structure=None,
+                         show_tokens=False, minify=False, compression=None, compression_level=None,
+                         output_dir=None, over_budget=None, own_index=False):
+    """
+    Writes each part to a separate file in output_dir (root_dir by default) without
+    duplicating content.
+    The directory structure is rendered from the scanned tree if one is given.
+    Blocks are written one at a time, and blocks collected without their content
+    are re-rendered from their source file as they are written.
+    If part_numbers is given, only those (1-based) parts are written.
+    With show_tokens the file index lists token counts per file and per part, and
+    over_budget the files left out to fit the total budget. With own_index each part's
+    index lists only its own files (see build_file_index), as a token budget assumes.
+    minify must match the setting the blocks were collected with.
+    With compression (a COMPRESSION_FORMATS name) each part is written through a streaming
+    compressor at compression_level, and its ratio and throughput are reported.
+    Returns the written parts by part number, each with its file name, compression, size
+    on disk and the byte offset, length, line range and hash of every block (see the
+    sidecar index, save_part_index).
+    """
     abs_root = os.path.abspath(root_dir)
+    out_dir = os.path.abspath(output_dir) if output_dir is not None else abs_root
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     
     # Generate directory structure once for part 1 only
-    directory_structure = generate_directory_structure(abs_root)
+    if directory_structure is None:
+        directory_structure = generate_directory_structure(abs_root, tree)
     
-    # Create file index showing which files are in which parts
-    file_index = ["# File Index - Which Files Are in Which Parts", "#" * 80]
-    for i, part in enumerate(parts, 1):
-        file_index.append(f"\n## Part {i} ({len(part)} files):")
-        for block in part:
-            file_index.append(f"  - {block['path']}")
-    file_index_content = "\n".join(file_index)
+    # Create file index showing which files are in which parts; like the directory
+    # structure, the files left out for the budget are only listed in part 1
+    file_index_content = build_file_index(parts, show_tokens, over_budget)
+    short_index_content = build_file_index(parts, show_tokens, over_budget, list_over_budget=False)
+
+    def index_content(part_number):
+        if own_index:
+            return build_file_index(parts, show_tokens, over_budget, part_number == 1, part_number)
+        return file_index_content if part_number == 1 else short_index_content
     
+    # The text is encoded here, so the byte offset of every block is known for the index
+    position = {}
+    
+    def write(text):
+        data = encode_part_text(text)
+        f.write(data)
+        position['offset'] += len(data)
+        position['line'] += text.count('\n')
+    
+    written_parts = {}
     for i, part in enumerate(parts, 1):
-        output_file = OUTPUT_FILENAME_TEMPLATE.format(i)
-        output_path = os.path.join(abs_root, output_file)
-        
-        # Create content
-        all_content = []
+        if part_numbers is not None and i not in part_numbers:
+            continue
+        output_file = part_filename(i, compression)
+        output_path = os.path.join(out_dir, output_file)
         
-        # Add header
-        concatenated_header = (
-            f"# Concatenated Project Code - Part {i} of {len(parts)}\n"
-            f"# Generated: {timestamp}\n"
-            f"# Root Directory: {abs_root}\n"
-            f"{'='*80}\n"
+        # Write the file section by section; block contents are streamed one at a time
+        logger.debug("Writing part %s to: %s", i, output_path)
+        position.update(offset=0, line=1)
+        try:
+            start = time.perf_counter()
+            entries = []
+            with open_part_writer(output_path, compression, compression_level) as f:
+                write(render_part_prefix(i, len(parts), timestamp, abs_root, directory_structure,
+                                         index_content(i)))
+                
+                # Add file contents for this part
+                for block in part:
+                    write("\n")
+                    content = get_block_content(block, minify)
+                    entry = {
+                        'path': block['path'],
+                        'offset': position['offset'],
+                        'first_line': position['line'],
+                        'hash': block['hash'],
+                    }
+                    write(content)
+                    entry['length'] = position['offset'] - entry['offset']
+                    entry['last_line'] = position['line'] - (1 if content.endswith('\n') else 0)
+                    if block.get('duplicate_of'):
+                        entry['duplicate_of'] = block['duplicate_of']
+                    entries.append(entry)
+            written_size = os.path.getsize(output_path)
+            add_metric('bytes_written', written_size)
+            if compression is not None:
+                report_compression(i, position['offset'], written_size, time.perf_counter() - start)
+            written_parts[i] = {
+                'file': output_file,
+                'compression': compression,
+                'size': written_size,
+                'files': entries,
+            }
+            logger.info("Successfully created %s with %s files", output_path, len(part))
+        except Exception as e:
+            logger.error("Critical error writing output file %s: %s", output_path, e)
+    return written_parts
+
+def remove_stale_parts(out_dir, num_parts, compression=None):
+    """
+    Deletes the parts in out_dir that an earlier run wrote and this one did not: those
+    numbered above num_parts, and those written with a different compression.
+    """
+    current = {part_filename(i, compression) for i in range(1, num_parts + 1)}
+    try:
+        names = os.listdir(out_dir)
+    except OSError as e:
+        logger.warning("Could not list %s for stale parts: %s", out_dir, e)
+        return
+    for name in sorted(names):
+        if OUTPUT_FILENAME_REGEX.fullmatch(name) and name not in current:
+            path = os.path.join(out_dir, name)
+            try:
+                os.remove(path)
+                logger.info("Removed stale part %s", path)
+            except OSError as e:
+                logger.warning("Could not remove stale part %s: %s", path, e)
+
+# --- Priority Selection ---
+
+def git_last_commit_times(root_dir):
+    """
+    Returns the time of the last commit that touched each file under root_dir, as a dict
+    of relative paths (os.sep-separated) to Unix timestamps, from one `git log` run.
+    Returns None if git is unavailable or root_dir is not in a checkout.
+    """
+    try:
+        result = subprocess.run(
+            ['git', '-c', 'core.quotepath=off', 'log', '--format=%x00%ct', '--name-only',
+             '--no-renames', '--relative', '.'],
+            cwd=root_dir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=GIT_LOG_TIMEOUT
         )
-        all_content.append(concatenated_header)
-        
-        # Add directory structure only to part 1
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning("Could not run git log: %s", e)
+        return None
+    if result.returncode != 0:
+        return None
+
+    # Commits come newest first, so the first time a path appears is its last change
+    commit_times = {}
+    commit_time = 0
+    for line in result.stdout.decode('utf-8', errors='surrogateescape').split('\n'):
+        if line.startswith('\0'):
+            commit_time = int(line[1:])
+        elif line:
+            commit_times.setdefault(os.path.normpath(line), commit_time)
+    logger.debug("Read the last commit times of %s files from git log", len(commit_times))
+    return commit_times
+
+def score_file_priority(relative_file_path, changed, newest, rules=None):
+    """
+    Returns the priority score of a file for budget mode (see PRIORITY_TYPE_WEIGHTS):
+    its type weight, the essential doc bonus, a recency bonus that halves every
+    PRIORITY_RECENCY_HALF_LIFE_DAYS its last change (a timestamp) is older than newest,
+    and a penalty per directory level. Scores are at least PRIORITY_MIN_SCORE.
+    """
+    name = os.path.basename(relative_file_path).lower()
+    ext = os.path.splitext(name)[1] or name  # '.gitignore' has no extension of its own
+    score = PRIORITY_TYPE_WEIGHTS.get(ext, PRIORITY_DEFAULT_TYPE_WEIGHT)
+    if is_essential_doc(relative_file_path, rules):
+        score += PRIORITY_ESSENTIAL_BONUS
+    age_days = max(0.0, newest - changed) / 86400
+    score += PRIORITY_RECENCY_BONUS * 0.5 ** (age_days / PRIORITY_RECENCY_HALF_LIFE_DAYS)
+    score -= PRIORITY_DEPTH_PENALTY * relative_file_path.count(os.sep)
+    return max(score, PRIORITY_MIN_SCORE)
+
+def select_files_by_priority(file_blocks, budget, weight='size', commit_times=None, rules=None):
+    """
+    Picks the blocks to bundle within a total budget of file content (characters, or
+    tokens with weight='tokens'), maximizing the sum of their priority scores (see
+    score_file_priority). Recency is the block's mtime, or its last commit time from
+    commit_times (see git_last_commit_times) where it has one.
+    This is a 0/1 knapsack, solved greedily: blocks are taken by score per unit of
+    weight, skipping those that no longer fit, and the single best block that fits is
+    taken instead if it alone scores more. That is O(n log n), so 100k candidates take
+    well under a second, and never worse than half the best possible total.
+    Returns (selected, over_budget), both in collection order; every block gets a 'priority'.
+    """
+    rules = rules or get_default_exclusion_rules()
+    commit_times = commit_times or {}
+    changes = [commit_times.get(block['path'], block.get('mtime') or 0) for block in file_blocks]
+    newest = max(changes, default=0)
+    for block, changed in zip(file_blocks, changes):
+        block['priority'] = score_file_priority(block['path'], changed, newest, rules)
+
+    unit = 'tokens' if weight == 'tokens' else 'characters'
+    total = sum(block[weight] for block in file_blocks)
+    if total <= budget:
+        logger.info("All %s files fit the budget of %s %s (%s %s)",
+                    len(file_blocks), budget, unit, total, unit)
+        return list(file_blocks), []
+
+    # Highest score per unit of weight first; ties keep collection order
+    densities = [block['priority'] / max(block[weight], 1) for block in file_blocks]
+    order = sorted(range(len(file_blocks)), key=densities.__getitem__, reverse=True)
+    chosen = set()
+    used = 0
+    score = 0.0
+    for i in order:
+        block_weight = file_blocks[i][weight]
+        if used + block_weight <= budget:
+            chosen.add(i)
+            used += block_weight
+            score += file_blocks[i]['priority']
+    fitting = [i for i in range(len(file_blocks)) if file_blocks[i][weight] <= budget]
+    best = max(fitting, key=lambda i: file_blocks[i]['priority'], default=None)
+    if best is not None and file_blocks[best]['priority'] > score:
+        chosen = {best}
+        used = file_blocks[best][weight]
+
+    selected = [block for i, block in enumerate(file_blocks) if i in chosen]
+    over_budget = [block for i, block in enumerate(file_blocks) if i not in chosen]
+    logger.info("Selected %s of %s files (%s of %s %s) for the budget of %s %s; %s left out",
+                len(selected), len(file_blocks), used, total, unit, budget, unit, len(over_budget))
+    for block in over_budget:
+        logger.debug("Over budget (priority %.1f, %d %s): %s", block['priority'], block[weight], unit,
+                     block['path'])
+    metrics = _active_metrics.get()
+    if metrics is not None:
+        metrics['files']['over_budget'] = len(over_budget)
+    return selected, over_budget
+
+# --- Compressed Output ---
+
+def part_filename(part_number, compression=None):
+    """Returns the file name of an output part, with the suffix of its compression format."""
+    suffix = COMPRESSION_FORMATS[compression][0] if compression else ''
+    return OUTPUT_FILENAME_TEMPLATE.format(part_number) + suffix
+
+def open_part_writer(path, compression=None, level=None):
+    """
+    Opens an output part for writing bytes. With compression the data goes straight into
+    a streaming stdlib compressor, so the part is never buffered whole.
+    gzip parts carry no timestamp, so unchanged parts compress to identical files.
+    """
+    if compression is None:
+        return open(path, 'wb')
+    if level is None:
+        level = COMPRESSION_FORMATS[compression][1]
+    if compression == 'gzip':
+        stream = gzip.GzipFile(path, 'wb', compresslevel=level, mtime=0)
+    elif compression == 'bz2':
+        stream = bz2.BZ2File(path, 'wb', compresslevel=level)
+    else:
+        stream = lzma.LZMAFile(path, 'wb', preset=level)
+    return stream
+
+def detect_compression(path):
+    """Returns the COMPRESSION_FORMATS name a part was written with, or None for plain text."""
+    with open(path, 'rb') as f:
+        prefix = f.read(8)
+    for compression, (_, _, magic) in COMPRESSION_FORMATS.items():
+        if prefix.startswith(magic):
+            return compression
+    return None
+
+def open_part_reader(path, binary=False):
+    """
+    Opens an output part, plain or compressed, for reading text (or bytes with binary).
+    Compressed parts are decompressed as they are read; seeking in them reads forward.
+    """
+    compression = detect_compression(path)
+    if compression == 'gzip':
+        stream = gzip.GzipFile(path, 'rb')
+    elif compression == 'bz2':
+        stream = bz2.BZ2File(path, 'rb')
+    elif compression == 'lzma':
+        stream = lzma.LZMAFile(path, 'rb')
+    else:
+        return open(path, 'rb') if binary else open(path, 'r', encoding='utf-8')
+    return stream if binary else io.TextIOWrapper(stream, encoding='utf-8')
+
+def iter_part_text(path, chunk_size=PART_READ_CHUNK_CHARS):
+    """Yields the text of an output part, plain or compressed, in chunks of up to chunk_size characters."""
+    with open_part_reader(path) as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+def report_compression(part_number, uncompressed_size, compressed_size, seconds):
+    """Logs, and records in the active metrics, the compression ratio and throughput of a part."""
+    ratio = uncompressed_size / compressed_size if compressed_size else 0.0
+    throughput = uncompressed_size / (1024 * 1024) / seconds if seconds > 0 else 0.0
+    logger.info("Part %s: %s bytes compressed to %s (ratio %.1fx, %.1f MB/s)",
+                part_number, uncompressed_size, compressed_size, ratio, throughput)
+    metrics = _active_metrics.get()
+    if metrics is not None:
+        metrics['compression'].append({
+            'part': part_number,
+            'uncompressed_bytes': uncompressed_size,
+            'compressed_bytes': compressed_size,
+            'ratio': ratio,
+            'seconds': seconds,
+        })
+
+# --- Part Index ---
+
+def load_part_index(index_path):
+    """
+    Loads the sidecar index written next to the parts.
+    Returns None if it does not exist, cannot be parsed or has a different format version.
+    """
+    try:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable index %s: %s", index_path, e)
+        return None
+    if index.get('version') != INDEX_VERSION:
+        logger.warning("Ignoring index %s with unsupported version", index_path)
+        return None
+    return index
+
+def save_part_index(index_path, index):
+    """Writes the sidecar index atomically."""
+    tmp_path = index_path + '.tmp'
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f, separators=(',', ':'), sort_keys=True)
+        os.replace(tmp_path, index_path)
+        logger.debug("Wrote index: %s", index_path)
+    except OSError as e:
+        logger.warning("Could not write index %s: %s", index_path, e)
+
+def update_part_index(index, written_parts, part_numbers, num_parts):
+    """
+    Returns the sidecar index after writing part_numbers, given the previous index (or None)
+    and the parts returned by write_parts_to_files. Parts that were not rewritten keep their
+    previous entries; a part that failed to write has None.
+    """
+    previous_parts = index['parts'] if index else []
+    parts = []
+    for i in range(1, num_parts + 1):
+        if i in part_numbers:
+            parts.append(written_parts.get(i))
+        else:
+            parts.append(previous_parts[i - 1] if i <= len(previous_parts) else None)
+    return {'version': INDEX_VERSION, 'parts': parts}
+
+def open_bundle(root_dir='.'):
+    """
+    Opens the parts in root_dir for random access through their sidecar index.
+    Returns a bundle for lookup_block; part files are mapped on first use and stay
+    mapped until close_bundle.
+    """
+    abs_root = os.path.abspath(root_dir)
+    index_path = os.path.join(abs_root, INDEX_FILENAME)
+    index = load_part_index(index_path)
+    if index is None:
+        raise FileNotFoundError(f"No usable index at {index_path}")
+    files = {}
+    for part in index['parts']:
+        for entry in (part or {}).get('files', []):
+            files[entry['path']] = (part, entry)
+    return {'root': abs_root, 'files': files, 'open_parts': {}}
+
+def _open_indexed_part(bundle, part):
+    """Returns the mmap (plain parts) or decompressing reader (compressed parts) of a part."""
+    opened = bundle['open_parts'].get(part['file'])
+    if opened is not None:
+        return opened
+    path = os.path.join(bundle['root'], part['file'])
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size != part['size']:
+            raise ValueError(f"{path} changed since it was indexed; regenerate the parts")
+        if part['compression'] is None:
+            opened = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+    if part['compression'] is not None:
+        opened = open_part_reader(path, binary=True)
+    bundle['open_parts'][part['file']] = opened
+    return opened
+
+def lookup_block(bundle, path):
+    """
+    Returns the rendered block of one file from the parts without reading the rest of its part.
+    Plain parts are sliced through mmap; compressed parts are decompressed up to the block.
+    A deduplicated file returns its reference block; lookup the path it names for the content.
+    Raises KeyError if path is not in the bundle.
+    """
+    part, entry = bundle['files'][path]
+    opened = _open_indexed_part(bundle, part)
+    if part['compression'] is None:
+        data = opened[entry['offset']:entry['offset'] + entry['length']]
+    else:
+        opened.seek(entry['offset'])
+        data = opened.read(entry['length'])
+    return data.decode('utf-8')
+
+def close_bundle(bundle):
+    """Releases the part files a bundle has open."""
+    for opened in bundle['open_parts'].values():
+        if not isinstance(opened, bytes):
+            opened.close()
+    bundle['open_parts'].clear()
+
+
+# --- Incremental Manifest ---
+
+def load_manifest(manifest_path):
+    """
+    Loads the manifest written by a previous run.
+    Returns None if it does not exist, cannot be parsed or has a different format version.
+    """
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable manifest %s: %s", manifest_path, e)
+        return None
+    if manifest.get('version') != MANIFEST_VERSION:
+        logger.warning("Ignoring manifest %s with unsupported version", manifest_path)
+        return None
+    return manifest
+
+def save_manifest(manifest_path, manifest):
+    """Writes the manifest atomically, so an interrupted run never leaves a truncated file."""
+    tmp_path = manifest_path + '.tmp'
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, manifest_path)
+        logger.debug("Wrote manifest: %s", manifest_path)
+    except OSError as e:
+        logger.warning("Could not write manifest %s: %s", manifest_path, e)
+
+def assign_parts_incrementally(file_blocks, manifest, num_parts, weight='size', capacity=None):
+    """
+    Keeps every file that is still present in the part it was assigned to last run,
+    in the same order, and adds new files to the smallest parts.
+    Returns None if the manifest was written for a different number of parts or the
+    result would be too unbalanced (or exceed capacity, the per-part budget), in which
+    case the caller redistributes everything.
+    """
+    previous_parts = manifest.get('parts') or []
+    if manifest.get('num_parts') != num_parts or len(previous_parts) != num_parts:
+        return None
+
+    blocks_by_path = {block['path']: block for block in file_blocks}
+    parts = [[] for _ in range(num_parts)]
+    for i, previous_part in enumerate(previous_parts):
+        for path in previous_part['files']:
+            block = blocks_by_path.pop(path, None)
+            if block is not None:
+                parts[i].append(block)
+
+    # Remaining blocks are new; place them largest first into the smallest part
+    heap = [(sum(block[weight] for block in part), i) for i, part in enumerate(parts)]
+    heapq.heapify(heap)
+    for block in sorted(blocks_by_path.values(), key=lambda x: x[weight], reverse=True):
+        size, smallest_part_idx = heap[0]
+        parts[smallest_part_idx].append(block)
+        heapq.heapreplace(heap, (size + block[weight], smallest_part_idx))
+    part_sizes = [0] * num_parts
+    for size, i in heap:
+        part_sizes[i] = size
+
+    average_size = sum(part_sizes) / num_parts
+    if average_size and max(part_sizes) > average_size * (1 + INCREMENTAL_REBALANCE_TOLERANCE):
+        logger.info("Parts drifted out of balance; redistributing all files")
+        return None
+    if capacity is not None and max(part_sizes) > capacity:
+        logger.info("Parts no longer fit the budget; redistributing all files")
+        return None
+
+    print_part_sizes(parts, part_sizes, weight)
+    return parts
+
+def compute_part_digests(parts, directory_structure, show_tokens=False, over_budget=None, own_index=False):
+    """
+    Returns one digest per part covering everything written into it: the part count,
+    the file index, the directory structure (part 1 only) and each member's content.
+    A part only needs rewriting when its digest changes.
+    """
+    index_digest = hash_content(build_file_index(parts, show_tokens, over_budget))
+    structure_digest = hash_content(directory_structure)
+    digests = []
+    for i, part in enumerate(parts, 1):
+        if own_index:
+            index_digest = hash_content(build_file_index(parts, show_tokens, over_budget, i == 1, i))
+        digest = hashlib.sha1()
+        digest.update(f"{len(parts)}\0{i}\0{index_digest}\0".encode('utf-8'))
         if i == 1:
-            all_content.append(directory_structure)
-            all_content.append("\n\n" + "="*80 + "\n\n")
-        
-        # Add file index to all parts for navigation
-        all_content.append(file_index_content)
-        all_content.append("\n\n" + "="*80 + "\n\n")
-        
-        # Add file contents for this part
+            digest.update(structure_digest.encode('utf-8'))
         for block in part:
-            all_content.append(block['content'])
-        
-        # Write the file
-        print(f"[DEBUG] Writing part {i} to: {output_path}")
+            digest.update(f"\0{block['path']}\0{block['hash']}\0{block['size']}".encode('utf-8'))
+            if block.get('duplicate_of'):
+                digest.update(f"\0{block['duplicate_of']}".encode('utf-8'))
+        digests.append(digest.hexdigest())
+    return digests
+
+def build_manifest(parts, part_digests, tree, rules=None, tokenizer_name=None, minify=False,
+                   excerpts=None, over_budget=None):
+    """
+    Builds the manifest recording, for each included file, its size, mtime, content hash,
+    rendered block size, token count (if counted), line count if it was excerpted and part,
+    plus the files skipped for being too long. Files left out to fit the total budget are
+    recorded like included ones but without a part, as the next run may select them.
+    Deduplicated files record the size and tokens of their full block, since they are
+    only references while their first copy is included.
+    """
+    files = {}
+    for file_node, _, relative_file_path in iter_tree_files(tree):
+        if file_node['skipped']:
+            files[relative_file_path] = {
+                'size': file_node['size'],
+                'mtime': file_node['mtime'],
+                'skipped': file_node['skipped'],
+            }
+    for i, part in [(None, over_budget or [])] + list(enumerate(parts, 1)):
+        for block in part:
+            files[block['path']] = {
+                'size': block['file_size'],
+                'mtime': block['mtime'],
+                'hash': block['hash'],
+                'block_size': block.get('full_size', block['size']),
+                'part': i,
+            }
+            if 'tokens' in block:
+                files[block['path']]['tokens'] = block.get('full_tokens', block['tokens'])
+            if 'minify_saved' in block:
+                files[block['path']]['minify_saved'] = block['minify_saved']
+            if block.get('excerpt'):
+                files[block['path']]['excerpted'] = block['line_count']
+    return {
+        'version': MANIFEST_VERSION,
+        'root': tree['path'],
+        'rules': (rules or get_default_exclusion_rules())['fingerprint'],
+        'tokenizer': tokenizer_name,
+        'minify': minify,
+        'excerpts': excerpts,
+        'num_parts': len(parts),
+        'parts': [
+            {'files': [block['path'] for block in part], 'digest': digest}
+            for part, digest in zip(parts, part_digests)
+        ],
+        'files': files,
+    }
+
+
+# --- Watch Mode ---
+
+def is_own_output(name):
+    """Returns True for the files this script writes, whose changes must not trigger a rerun."""
+    return (name in (MANIFEST_FILENAME, MANIFEST_FILENAME + '.tmp', INDEX_FILENAME, INDEX_FILENAME + '.tmp')
+            or OUTPUT_FILENAME_REGEX.fullmatch(name) is not None)
+
+def iter_watched_directories(node):
+    """
+    Yields the scanned directories of a subtree, which are the ones whose changes matter.
+    A directory reached through a symlink first is scanned (and watched) under that path.
+    """
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        if current['children'] is None or current['same_as'] is not None:
+            continue
+        yield current
+        stack.extend(child for child in current['children']
+                     if child['is_dir'] and child['excluded'] is None)
+
+def new_change_set():
+    """Creates an empty set of pending tree changes."""
+    return {'rescan': {}, 'recursive': set(), 'files': {}, 'full': False}
+
+def open_inotify_watcher():
+    """
+    Opens an inotify instance through libc. Returns the watcher dict, or None where
+    inotify is not available (not Linux, no libc, or the instance limit is reached).
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(INOTIFY_NONBLOCK | INOTIFY_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        logger.warning("inotify unavailable: %s", os.strerror(ctypes.get_errno()))
+        return None
+    return {'kind': 'inotify', 'libc': libc, 'fd': fd, 'nodes': {}}
+
+def add_inotify_watches(watcher, node):
+    """
+    Watches every scanned directory of a subtree. Returns False if the kernel refuses a
+    watch (usually the fs.inotify.max_user_watches limit), in which case polling is used.
+    """
+    mask = INOTIFY_CONTENT_EVENTS | INOTIFY_LISTING_EVENTS | INOTIFY_ONLYDIR
+    for directory in iter_watched_directories(node):
+        wd = watcher['libc'].inotify_add_watch(watcher['fd'], os.fsencode(directory['path']), mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if os.path.isdir(directory['path']):
+                logger.warning("Could not watch %s: %s", directory['path'], os.strerror(error))
+                return False
+            continue  # Removed since it was scanned; its parent's events cover it
+        watcher['nodes'][wd] = directory
+    return True
+
+def close_watcher(watcher):
+    """Releases the inotify instance of a watcher."""
+    if watcher is not None and watcher['kind'] == 'inotify':
+        os.close(watcher['fd'])
+
+def read_inotify_changes(watcher, changes, timeout):
+    """
+    Waits up to timeout seconds for inotify events and records them in changes.
+    Returns True if any event that matters arrived.
+    """
+    ready, _, _ = select.select([watcher['fd']], [], [], timeout)
+    if not ready:
+        return False
+    try:
+        data = os.read(watcher['fd'], 65536)
+    except BlockingIOError:
+        return False
+
+    relevant = False
+    offset = 0
+    while offset + INOTIFY_EVENT_HEADER.size <= len(data):
+        wd, mask, _, name_len = INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+        offset += INOTIFY_EVENT_HEADER.size
+        name = os.fsdecode(data[offset:offset + name_len].rstrip(b'\0'))
+        offset += name_len
+
+        if mask & INOTIFY_Q_OVERFLOW:
+            changes['full'] = True
+            relevant = True
+            continue
+        directory = watcher['nodes'].get(wd)
+        if mask & INOTIFY_IGNORED:
+            watcher['nodes'].pop(wd, None)
+            continue
+        if directory is None or is_own_output(name):
+            continue
+        if name in IGNORE_FILENAMES:
+            changes['rescan'][directory['rel_path']] = directory
+            changes['recursive'].add(directory['rel_path'])
+            relevant = True
+        elif mask & INOTIFY_LISTING_EVENTS:
+            changes['rescan'][directory['rel_path']] = directory
+            relevant = True
+        elif mask & INOTIFY_CONTENT_EVENTS:
+            for child in directory['children'] or []:
+                if child['name'] == name and child['excluded'] is None and not child['is_dir']:
+                    changes['files'][child['rel_path']] = child
+                    relevant = True
+                    break
+    return relevant
+
+def snapshot_tree(tree):
+    """
+    Records the stat information polling compares against, as (node, recorded, directory)
+    entries: the mtime of every scanned directory (which changes when entries are added,
+    removed or renamed) and the size and mtime of every included file in it.
+    """
+    snapshot = []
+    for directory in iter_watched_directories(tree):
+        snapshot.append((directory, stat_signature(directory), directory))
+        for child in directory['children']:
+            if not child['is_dir'] and child['excluded'] is None and not is_own_output(child['name']):
+                recorded = (child['size'], child['mtime']) if child['size'] is not None else None
+                snapshot.append((child, recorded, directory))
+    return snapshot
+
+def stat_signature(node):
+    """Returns what polling compares for a node: a directory's mtime, a file's (size, mtime)."""
+    try:
+        st = os.stat(node['path'])
+    except OSError:
+        return None
+    return st.st_mtime if node['is_dir'] else (st.st_size, st.st_mtime)
+
+def poll_tree_changes(snapshot, changes):
+    """
+    Stats everything in a snapshot and records what changed in changes.
+    Returns the current signatures of the changed entries (empty if nothing changed),
+    so the caller can tell when a burst of changes has settled.
+    """
+    changed = []
+    for node, recorded, directory in snapshot:
+        current = stat_signature(node)
+        if current == recorded:
+            continue
+        changed.append((node['path'], current))
+        if node['is_dir']:
+            if current is not None:  # A removed directory is dropped by its parent's rescan
+                changes['rescan'][node['rel_path']] = node
+        elif node['name'] in IGNORE_FILENAMES:
+            changes['rescan'][directory['rel_path']] = directory
+            changes['recursive'].add(directory['rel_path'])
+        else:
+            changes['files'][node['rel_path']] = node
+    return changed
+
+def _is_within(rel_path, rel_dir):
+    """Returns True if rel_path is rel_dir or below it ('' is the root)."""
+    return not rel_dir or rel_path == rel_dir or rel_path.startswith(rel_dir + os.sep)
+
+def apply_tree_changes(tree, context, changes):
+    """
+    Updates a scanned tree in place: rescans the directories whose listings changed
+    (outermost first, skipping any inside a directory rescanned recursively) and
+    refreshes the size and mtime of changed files.
+    Returns the directories that were rescanned, so new subdirectories can be watched.
+    """
+    rescanned = []
+    recursive_roots = []
+    for rel_dir in sorted(changes['rescan'], key=lambda rel: (rel.count(os.sep), rel)):
+        if any(_is_within(rel_dir, root) for root in recursive_roots):
+            continue
+        recursive = rel_dir in changes['recursive']
+        node = changes['rescan'][rel_dir]
+        rescan_directory(node, context, recursive)
+        rescanned.append(node)
+        if recursive:
+            recursive_roots.append(rel_dir)
+
+    for node in changes['files'].values():
+        try:
+            st = os.stat(node['path'])
+            node['size'] = st.st_size
+            node['mtime'] = st.st_mtime
+        except OSError:
+            pass  # Removed: the rescan of its directory drops it
+    return rescanned
+
+def watch_and_regenerate(debounce=WATCH_DEBOUNCE_SECONDS, poll_interval=WATCH_POLL_INTERVAL,
+                         use_inotify=True, max_runs=None, *, config=None, report_path=None, **settings):
+    """
+    Generates the parts, then watches the tree and regenerates them whenever files change.
+    The scanned tree, venv verdicts, compiled ignore rules, token counts, rendered blocks
+    and the manifest stay in memory, so a regeneration only re-lists the directories that
+    changed, only reads the files that changed and only rewrites the parts they land in.
+    Changes are collected until none arrive for `debounce` seconds. inotify is used where
+    available; otherwise the tree is stat-polled every `poll_interval` seconds.
+    config and settings are the bundle settings (see new_bundle_config); every run's metrics
+    are written to report_path when given. max_runs stops after that many regenerations
+    (mainly for testing). Runs until interrupted with Ctrl+C.
+    """
+    config = new_bundle_config(config, **settings)
+    state = {}
+    split_concatenated_scripts(config=config, state=state, report_path=report_path)
+    git_mode = config['enumeration'] == 'git'
+
+    watcher = open_inotify_watcher() if use_inotify else None
+    if watcher is not None and not add_inotify_watches(watcher, state['tree']):
+        close_watcher(watcher)
+        watcher = None
+    logger.info("Watching %s for changes (%s); press Ctrl+C to stop",
+                state['tree']['path'], 'inotify' if watcher is not None else f'polling every {poll_interval}s')
+
+    runs = 0
+    snapshot = snapshot_tree(state['tree']) if watcher is None else None
+    try:
+        while max_runs is None or runs < max_runs:
+            # Wait for a first change, then keep collecting until things go quiet
+            changes = new_change_set()
+            if watcher is not None:
+                if not read_inotify_changes(watcher, changes, None):
+                    continue
+                while read_inotify_changes(watcher, changes, debounce):
+                    pass
+            else:
+                time.sleep(poll_interval)
+                changed = poll_tree_changes(snapshot, changes)
+                if not changed:
+                    continue
+                while True:
+                    time.sleep(debounce)
+                    settled = poll_tree_changes(snapshot, changes)
+                    if settled == changed:
+                        break
+                    changed = settled
+
+            start = time.perf_counter()
+            rebuild = changes['full'] or git_mode or 'context' not in state
+            if rebuild:
+                logger.info("Change detected; rebuilding the tree")
+                state.pop('tree', None)
+            else:
+                logger.info("Change detected in %s directories and %s files",
+                            len(changes['rescan']), len(changes['files']))
+                rescanned = apply_tree_changes(state['tree'], state['context'], changes)
+            split_concatenated_scripts(config=config, state=state, report_path=report_path)
+
+            # Watch directories that appeared, or the whole new tree after a rebuild
+            if watcher is not None:
+                for node in [state['tree']] if rebuild else rescanned:
+                    if not add_inotify_watches(watcher, node):
+                        close_watcher(watcher)
+                        watcher = None
+                        logger.info("Falling back to polling every %ss", poll_interval)
+                        break
+            if watcher is None:
+                snapshot = snapshot_tree(state['tree'])
+            runs += 1
+            logger.info("Regenerated in %.2fs; watching for changes", time.perf_counter() - start)
+    except KeyboardInterrupt:
+        logger.info("Stopped watching")
+    finally:
+        close_watcher(watcher)
+
+# --- Library API ---
+
+def default_rule_settings():
+    """
+    Returns the module configuration as the keyword arguments of compile_exclusion_rules,
+    which are also the keys a rule file may set (see load_rule_files).
+    """
+    return {
+        'excluded_files': EXCLUDED_FILES,
+        'file_patterns': EXCLUDED_FILE_PATTERNS,
+        'library_names': LIBRARY_NAME_PATTERNS,
+        'version_patterns': LIBRARY_VERSION_PATTERNS,
+        'library_extensions': LIBRARY_EXTENSIONS,
+        'library_path_indicators': LIBRARY_PATH_INDICATORS,
+        'output_path_indicators': OUTPUT_JSON_PATH_INDICATORS,
+        'output_suffixes': OUTPUT_JSON_SUFFIXES,
+        'timestamp_patterns': OUTPUT_JSON_TIMESTAMP_PATTERNS,
+        'excluded_dirs': EXCLUDED_DIRS,
+        'excluded_paths': EXCLUDED_PATHS,
+        'allowed_extensions': ALLOWED_EXTENSIONS,
+        'allowed_filenames': ALLOWED_FILENAMES,
+        'essential_docs': ESSENTIAL_DOCS,
+    }
+
+def load_rule_files(paths):
+    """
+    Compiles exclusion rules from JSON rule files applied in order over the module configuration.
+    Each file holds an object whose keys are those of default_rule_settings. A list replaces
+    that setting; an object {"add": [...], "remove": [...]} edits the current one, e.g.
+    {"excluded_dirs": {"add": ["build"]}, "allowed_extensions": {"remove": [".md"]}}.
+    Raises ValueError for an unknown key or a malformed value, and OSError if a file cannot be read.
+    """
+    settings = {name: list(values) for name, values in default_rule_settings().items()}
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            try:
+                overrides = json.load(f)
+            except ValueError as e:
+                raise ValueError(f"{path}: not valid JSON ({e})")
+        if not isinstance(overrides, dict):
+            raise ValueError(f"{path}: expected an object of rule settings")
+        for name, value in overrides.items():
+            if name not in settings:
+                raise ValueError(f"{path}: unknown rule setting '{name}'")
+            if isinstance(value, dict) and set(value) <= {'add', 'remove'}:
+                remove = value.get('remove', [])
+                current = [item for item in settings[name] if item not in remove]
+                current.extend(item for item in value.get('add', []) if item not in current)
+                value = current
+            if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+                raise ValueError(f"{path}: '{name}' must be a list of strings or an add/remove object")
+            settings[name] = value
+        logger.debug("Loaded rule file: %s", path)
+    return compile_exclusion_rules(**settings)
+
+def build_tree(root_dir='.', enumeration='walk', verdict_cache=None, use_ignore_files=True, rules=None):
+    """
+    Builds the in-memory tree of root_dir by walking it (scan_directory_tree) or, with
+    enumeration='git', from the git index (scan_git_tree), falling back to the walk
+    outside a git checkout.
+    Returns (tree, context); context is the scan context of a walk, for later rescans,
+    and None for a tree built from the git index.
+    """
+    if enumeration == 'git':
+        tree = scan_git_tree(root_dir, verdict_cache, rules)
+        if tree is not None:
+            return tree, None
+        logger.warning("%s is not a git checkout; walking the directory tree instead",
+                       os.path.abspath(root_dir))
+    context = new_scan_context(root_dir, verdict_cache, use_ignore_files, rules)
+    return scan_directory_tree(root_dir, context=context), context
+
+def iter_candidate_files(files, verdict_cache=None, rules=None, excerpts=None):
+    """
+    Filters (file_node, file_path, relative_file_path) entries as collect_file_contents does
+    without a manifest, yielding (file_node, file_path, relative_file_path, max_lines, excerpt)
+    for each file to read, where max_lines is the line limit to enforce on the read (None for
+    none) and excerpt the excerpt limits in excerpt mode (see get_length_limits).
+    """
+    for file_node, file_path, relative_file_path in files:
+        if file_node['excluded'] is not None:
+            continue
+        if not should_process_file(file_path, file_node['name'], verdict_cache, rules, check_length=False):
+            continue
+        if is_essential_doc(file_path, rules):
+            yield file_node, file_path, relative_file_path, None, None
+            continue
+        limits = get_length_limits(file_node, file_path, excerpts)
+        if limits is None:
+            file_node['skipped'] = 'too long'
+            count_rule_hit('too long')
+            continue
+        yield (file_node, file_path, relative_file_path) + limits
+
+def iter_file_blocks(root_dir='.', rules=None, enumeration='walk', use_ignore_files=True,
+                     tokenizer=None, minify=False, dedupe=False, excerpts=None):
+    """
+    Yields the rendered block of every file under root_dir that would be bundled, in the
+    order collect_file_contents collects them, without writing anything.
+    Files are filtered and read only as the blocks are consumed, so the first block is
+    available as soon as the tree is scanned and only one file's content is held at a time.
+    rules are the compiled exclusion rules (the module configuration by default). With a
+    tokenizer each block gets a 'tokens' count; minify, dedupe and excerpts are as in
+    split_concatenated_scripts.
+    """
+    rules = rules or get_default_exclusion_rules()
+    verdict_cache = {}
+    tree, _ = build_tree(root_dir, enumeration, verdict_cache, use_ignore_files, rules)
+    token_counter = get_token_counter(tokenizer)[1] if tokenizer is not None else None
+
+    def blocks():
+        if tree['excluded'] is not None:
+            return
+        for file_node, file_path, relative_file_path, max_lines, excerpt in iter_candidate_files(
+                iter_tree_files(tree), verdict_cache, rules, excerpts):
+            block = build_file_block(file_path, relative_file_path, True, token_counter, None,
+                                     max_lines, minify, excerpt)
+            if block.get('skipped'):
+                continue
+            block['file_size'] = file_node['size']
+            block['mtime'] = file_node['mtime']
+            yield block
+
+    if dedupe:
+        yield from iter_deduplicated_blocks(blocks(), token_counter)
+    else:
+        yield from blocks()
+
+def iter_part_assignments(root_dir='.', num_parts=3, rules=None, split_by='size', tokenizer='heuristic',
+                          strategy='balanced', tolerance=DEFAULT_LOCALITY_TOLERANCE, enumeration='walk',
+                          use_ignore_files=True, jobs=1, minify=False, dedupe=False, excerpts=None,
+                          budget=None, recency='mtime'):
+    """
+    Yields (part_number, block) for every bundled file under root_dir, part by part, as
+    split_concatenated_scripts would assign them, without writing anything. With a budget
+    only the files select_files_by_priority picks are yielded.
+    Balancing needs every block's size first, so the files are collected without keeping
+    their content; each yielded block is then rendered again from its file, which keeps
+    memory bounded by the largest single file.
+    """
+    rules = rules or get_default_exclusion_rules()
+    count_tokens = split_by == 'tokens'
+    weight = 'tokens' if count_tokens else 'size'
+    verdict_cache = {}
+    tree, _ = build_tree(root_dir, enumeration, verdict_cache, use_ignore_files, rules)
+    file_blocks, _, _ = collect_file_contents(
+        root_dir, tree, verdict_cache, rules, jobs, keep_content=False,
+        tokenizer=tokenizer if count_tokens else None, minify=minify, excerpts=excerpts
+    )
+    if budget is not None:
+        commit_times = git_last_commit_times(root_dir) if recency == 'git' else None
+        file_blocks, _ = select_files_by_priority(file_blocks, budget, weight, commit_times, rules)
+    if dedupe:
+        token_counter = get_token_counter(tokenizer)[1] if count_tokens else None
+        file_blocks = list(iter_deduplicated_blocks(file_blocks, token_counter))
+    parts = distribute_files_across_parts(file_blocks, num_parts, weight, strategy, tolerance)
+    for i, part in enumerate(parts, 1):
+        for block in part:
+            yield i, dict(block, content=get_block_content(block, minify))
+
+# --- Pipeline ---
+
+class _StageStopped(Exception):
+    """Raised inside a stage's callbacks to abandon its work once its consumer has stopped."""
+
+def queue_stage(produce, name, maxsize=PIPELINE_QUEUE_SIZE, batch_size=PIPELINE_BATCH_SIZE, stopped=None):
+    """
+    Starts produce(emit) on its own thread and returns a generator of everything it emits,
+    in order. Items are passed on in batches of batch_size through a queue of at most maxsize
+    batches: the stage runs ahead of its consumer by that much and then waits. Batching keeps
+    the hand-offs between threads, and the switches between them, few.
+    emit returns False once the consumer has stopped (the generator was closed), and produce
+    should then return. Closing a generator that was never read from does nothing, so a
+    consumer that may stop before reading passes its own stopped Event and sets it.
+    An exception raised by produce is re-raised to the consumer after the items emitted
+    before it.
+    """
+    items = queue.Queue(maxsize)
+    stopped = stopped if stopped is not None else threading.Event()
+    batch = []
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=PIPELINE_POLL_SECONDS)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def emit(item):
+        batch.append(item)
+        if len(batch) < batch_size:
+            return not stopped.is_set()
+        full = batch[:]
+        del batch[:]
+        return put((False, full))
+
+    def run():
+        try:
+            produce(emit)
+        except BaseException as e:
+            put((False, batch)) and put((True, e))
+        else:
+            put((False, batch)) and put((True, None))
+
+    def drain():
         try:
-            with open(output_path, 'w', encoding='utf-8') as f:
-                f.write("\n".join(all_content))
-            print(f"[INFO] Successfully created {output_path} with {len(part)} files")
+            while True:
+                finished, item = items.get()
+                if finished:
+                    if item is not None:
+                        raise item
+                    return
+                yield from item
+        finally:
+            stopped.set()
+
+    # The stage records into the metrics of the run that started it
+    context = contextvars.copy_context()
+    threading.Thread(target=context.run, args=(run,), name=f'concatenate-{name}', daemon=True).start()
+    return drain()
+
+def run_pipeline(root_dir, out_dir, part_size, weight='size', token_counter=None, jobs=1,
+                 enumeration='walk', use_ignore_files=True, rules=None, dedupe=False, minify=False,
+                 compression=None, compression_level=None, excerpts=None):
+    """
+    Bundles root_dir into parts of at most part_size (see fill_parts) through overlapping
+    stages, each on its own thread and connected by bounded queues (see queue_stage):
+    walk (a directory's files are passed on as soon as it is listed), filter, read (on
+    `jobs` threads), render and write. Memory stays flat however large the tree is: only
+    the queued items, the tree and the per-file metadata are held.
+    Block contents are written into their part file while the walk is still running, so
+    every byte is written once. The part count, the file index and the directory structure
+    are only known at the end, so a part's header does not give the count and the index and
+    structure follow the last block of the last part (see render_part_trailer) instead of
+    heading the parts as in write_parts_to_files.
+    Phase times in the metrics are the wall times of the overlapping stages.
+    Returns (tree, parts, directory_structure, written_parts), where the blocks in parts no
+    longer carry their content and written_parts is as from write_parts_to_files.
+    """
+    abs_root = os.path.abspath(root_dir)
+    rules = rules or get_default_exclusion_rules()
+    verdict_cache = {}
+    token_cache = {}
+    walked = {}
+    counts = {'considered': 0, 'read': 0}
+    skipped_on_read = []
+
+    def walk(emit):
+        start = time.perf_counter()
+        if enumeration == 'git':
+            tree = scan_git_tree(root_dir, verdict_cache, rules)
+            if tree is not None:
+                walked['tree'] = tree
+                files = iter_tree_files(tree) if tree['excluded'] is None else []
+                for entry in files:
+                    if not emit(entry):
+                        return
+                add_phase_time('walk', start)
+                return
+            logger.warning("%s is not a git checkout; walking the directory tree instead", abs_root)
+
+        # Directories arrive in the order iter_tree_files walks them; only those it would
+        # walk pass their files on. A directory first reached through a symlink is complete
+        # by the time its real location arrives, so that one is walked in one go.
+        walkable = set()
+
+        def on_directory(node):
+            if node['rel_path'] and id(node) not in walkable:
+                return
+            if not node['rel_path'] and node['excluded'] is not None:
+                return  # The root itself is a virtual env or node_modules
+            if node['same_as'] is not None:
+                for entry in iter_tree_files(node):
+                    if not emit(entry):
+                        raise _StageStopped()
+                return
+            for child in node['children']:
+                if not child['is_dir']:
+                    if not emit((child, child['path'], child['rel_path'])):
+                        raise _StageStopped()
+                elif child['excluded'] is None and not child['is_symlink']:
+                    walkable.add(id(child))
+
+        context = new_scan_context(root_dir, verdict_cache, use_ignore_files, rules)
+        context['on_directory'] = on_directory
+        try:
+            walked['tree'] = scan_directory_tree(root_dir, context=context)
+        except _StageStopped:
+            return  # The rest of the pipeline has stopped, so the rest of the tree is not needed
+        add_phase_time('walk', start)
+
+    def filter_files(emit):
+        start = time.perf_counter()
+
+        def counted(files):
+            for entry in files:
+                counts['considered'] += 1
+                yield entry
+
+        files = counted(queue_stage(walk, 'walk'))
+        for candidate in iter_candidate_files(files, verdict_cache, rules, excerpts):
+            if not emit(candidate):
+                return
+        add_phase_time('filter', start)
+
+    def read_files(emit):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for candidate in queue_stage(filter_files, 'filter'):
+                if not emit((candidate, executor.submit(load_file_text, candidate[1], candidate[4]))):
+                    break
+        add_phase_time('read', start)
+
+    def render_blocks(emit):
+        for candidate, loading in queue_stage(read_files, 'read'):
+            file_node, file_path, relative_file_path, max_lines, excerpt = candidate
+            counts['read'] += 1
+            block = render_file_block(file_path, relative_file_path, loading.result(), True,
+                                      token_counter, token_cache, max_lines, minify, excerpt)
+            record_read_metrics([block])
+            if block.get('skipped'):
+                file_node['skipped'] = block['skipped']
+                skipped_on_read.append(block)
+                continue
+            block['file_size'] = file_node['size']
+            block['mtime'] = file_node['mtime']
+            if not emit(block):
+                return
+
+    # Write: parts are cut as in fill_parts, and each block is written straight into its part
+    parts = []
+    part_sizes = []
+    written_parts = {}
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    current = {'file': None}
+
+    def fail_part(e):
+        logger.error("Critical error writing output file %s: %s", current['path'], e)
+        try:
+            current['file'].close()
+        except Exception:
+            pass
+        current['file'] = None
+
+    def write(text):
+        data = encode_part_text(text)
+        if current['file'] is not None:
+            start = time.perf_counter()
+            try:
+                current['file'].write(data)
+            except Exception as e:
+                fail_part(e)
+            current['seconds'] += time.perf_counter() - start
+        current['offset'] += len(data)
+        current['line'] += text.count('\n')
+
+    def finish_part():
+        """Closes the part being written and records it for the sidecar index."""
+        if current['file'] is None:
+            return  # None open yet, or it failed
+        try:
+            current['file'].close()
+            written_size = os.path.getsize(current['path'])
+        except Exception as e:
+            fail_part(e)
+            return
+        current['file'] = None
+        add_metric('bytes_written', written_size)
+        if compression is not None:
+            report_compression(current['number'], current['offset'], written_size, current['seconds'])
+        written_parts[current['number']] = {
+            'file': current['name'],
+            'compression': compression,
+            'size': written_size,
+            'files': current['entries'],
+        }
+        logger.info("Successfully created %s with %s files", current['path'], len(parts[-1]))
+
+    def start_part():
+        finish_part()
+        parts.append([])
+        part_sizes.append(0)
+        number = len(parts)
+        name = part_filename(number, compression)
+        current.update(number=number, name=name, path=os.path.join(out_dir, name), entries=[],
+                       offset=0, line=1, seconds=0.0)
+        logger.debug("Writing part %s to: %s", number, current['path'])
+        try:
+            current['file'] = open_part_writer(current['path'], compression, compression_level)
         except Exception as e:
-            print(f"[ERROR] Critical error writing output file {output_path}: {e}")
+            logger.error("Critical error writing output file %s: %s", current['path'], e)
+        write(render_part_header(number, None, timestamp, abs_root))
+
+    writer_stopped = threading.Event()
+    blocks = queue_stage(render_blocks, 'render', stopped=writer_stopped)
+    if dedupe:
+        blocks = iter_deduplicated_blocks(blocks, token_counter)
+    try:
+        with timed_phase('write'):
+            start_part()
+        for block in blocks:
+            with timed_phase('write'):
+                if parts[-1] and part_sizes[-1] + block[weight] > part_size:
+                    start_part()
+                write("\n")
+                content = block['content']
+                entry = {
+                    'path': block['path'],
+                    'offset': current['offset'],
+                    'first_line': current['line'],
+                    'hash': block['hash'],
+                }
+                write(content)
+                entry['length'] = current['offset'] - entry['offset']
+                entry['last_line'] = current['line'] - (1 if content.endswith('\n') else 0)
+                if block.get('duplicate_of'):
+                    entry['duplicate_of'] = block['duplicate_of']
+                current['entries'].append(entry)
+                block['content'] = None
+                parts[-1].append(block)
+                part_sizes[-1] += block[weight]
+        tree = walked['tree']
+        print_part_sizes(parts, part_sizes, weight)
 
+        # The index and the structure are only known now, so they end the last part
+        with timed_phase('structure'):
+            directory_structure = generate_directory_structure(abs_root, tree)
+        with timed_phase('write'):
+            write(render_part_trailer(directory_structure, build_file_index(parts, weight == 'tokens')))
+            finish_part()
+    finally:
+        writer_stopped.set()
+        blocks.close()
+        if current['file'] is not None:
+            current['file'].close()
+
+    # Counted here, as the filter stage counts its own rule hits at the same time
+    for block in skipped_on_read:
+        count_rule_hit(block['skipped'])
+    included = sum(len(part) for part in parts)
+    if minify:
+        report_minify_savings([block for part in parts for block in part])
+    if excerpts is not None:
+        report_excerpts([block for part in parts for block in part])
+    if dedupe:
+        duplicates = [block for part in parts for block in part if block.get('duplicate_of')]
+        bytes_saved = sum(block['full_size'] - block['size'] for block in duplicates)
+        logger.info("Replaced %s duplicate files with references (%s bytes saved)",
+                    len(duplicates), bytes_saved)
+        metrics = _active_metrics.get()
+        if metrics is not None:
+            metrics['files']['duplicates'] = len(duplicates)
+            metrics['bytes_deduplicated'] = bytes_saved
+    metrics = _active_metrics.get()
+    if metrics is not None:
+        metrics['files'].update(
+            considered=counts['considered'],
+            included=included,
+            skipped=counts['considered'] - included,
+            read=counts['read'],
+        )
+    logger.info("Successfully processed %s files", included)
+    logger.info("Skipped %s files (excluded types/names)", counts['considered'] - included)
+    return tree, parts, directory_structure, written_parts
 
 # --- Main Function ---
-def split_concatenated_scripts(num_parts=3, root_dir='.'):
+def new_bundle_config(config=None, **settings):
+    """
+    Returns the settings of a bundling run (see split_concatenated_scripts) as a dict:
+    a copy of config, or of the defaults, with the given settings applied.
+    Raises TypeError for a setting that does not exist.
+    """
+    bundle_config = {
+        'num_parts': 3,
+        'root_dir': '.',
+        'output_dir': None,
+        'jobs': 1,
+        'stream': False,
+        'incremental': False,
+        'split_by': 'size',
+        'token_budget': None,
+        'tokenizer': 'heuristic',
+        'strategy': 'balanced',
+        'tolerance': DEFAULT_LOCALITY_TOLERANCE,
+        'part_size': None,
+        'pipeline': False,
+        'enumeration': 'walk',
+        'use_ignore_files': True,
+        'rules': None,
+        'dedupe': False,
+        'minify': False,
+        'excerpts': None,
+        'budget': None,
+        'recency': 'mtime',
+        'compression': None,
+        'compression_level': None,
+    } if config is None else dict(config)
+    for name, value in settings.items():
+        if name not in bundle_config:
+            raise TypeError(f"unknown bundle setting '{name}'")
+        bundle_config[name] = value
+    return bundle_config
+
+def split_concatenated_scripts(num_parts=None, root_dir=None, *, config=None, state=None, report_path=None,
+                               metrics_callback=None, **settings):
     """
     Collects file contents, splits them into multiple parts with similar sizes,
     and writes each part to a separate file.
+    In stream mode only block sizes are kept in memory and each file is rendered again
+    while its part is written, so peak memory is bounded by the largest single file.
+    A manifest is written next to the parts; in incremental mode the previous manifest
+    is used to skip reading unchanged files and to rewrite only the parts that changed.
+    With split_by='tokens' parts are balanced by LLM tokens instead of characters, and
+    with a token_budget the number of parts is chosen so that no part exceeds it.
+    strategy='locality' keeps directory subtrees together in path order (see locality_parts).
+    With a part_size parts are instead filled in path order up to that many characters
+    (tokens with split_by='tokens') of file content each (see fill_parts). Only that mode
+    needs no global knowledge of the files, so only it can run as a pipeline: with pipeline
+    the walk, filtering, reading, rendering and writing overlap (see run_pipeline). Other
+    modes, incremental runs and watch mode fall back to the sequential flow.
+    With enumeration='git' only the files tracked by git are considered (see scan_git_tree);
+    otherwise the walk honours .gitignore/.ignore files unless use_ignore_files is False.
+    With dedupe, a file identical to one collected earlier is written as a short reference
+    to that file (see deduplicate_blocks).
+    With minify, JS, CSS, JSON and HTML files are compacted (see minify_block_content)
+    and the bytes saved per file type are reported.
+    With excerpts (a dict of per-extension limit overrides, empty for the defaults; see
+    get_excerpt_limits) files over the size or line limits are cut to their first and last
+    lines around a marker with the number of lines left out, instead of being skipped.
+    With a budget, the total characters (tokens with split_by='tokens') of file content
+    are capped: files are ranked by priority and the best set that fits is bundled (see
+    select_files_by_priority); the rest are listed in the file index. recency ('mtime' or
+    'git') is where a file's last change, which raises its priority, is taken from.
+    With compression ('gzip', 'bz2' or 'lzma') the parts are written compressed, with the
+    format's suffix added to their names (see open_part_writer and iter_part_text).
+    A sidecar index records where each file's block is in the parts (see lookup_block).
+    rules are the compiled exclusion rules (see compile_exclusion_rules and load_rule_files).
+    The parts, manifest and index are written to output_dir, which defaults to root_dir.
+    A state dict keeps the tree, caches, rendered blocks and manifest warm between calls
+    (see watch_and_regenerate); after the first call every run is incremental.
+    The settings are taken from config (see new_bundle_config), with num_parts, root_dir and
+    any given as keyword arguments applied over it.
+    Returns the run's metrics (see new_metrics), which are also written as JSON to
+    report_path and passed to metrics_callback when those are given.
     """
-    # 1. Collect all file contents
-    file_blocks, processed_count, skipped_count = collect_file_contents(root_dir)
+    if num_parts is not None:
+        settings['num_parts'] = num_parts
+    if root_dir is not None:
+        settings['root_dir'] = root_dir
+    config = new_bundle_config(config, **settings)
+    metrics = new_metrics()
+    start = time.perf_counter()
+    with collecting_metrics(metrics):
+        _split_concatenated_scripts(state=state, **config)
+    metrics['total_seconds'] = time.perf_counter() - start
+
+    if report_path is not None:
+        write_metrics_report(report_path, metrics)
+    if metrics_callback is not None:
+        metrics_callback(metrics)
+    return metrics
+
+def _split_concatenated_scripts(num_parts, root_dir, jobs, stream, incremental, split_by, token_budget,
+                                tokenizer, strategy, tolerance, enumeration, use_ignore_files, dedupe,
+                                minify, compression, compression_level, rules, output_dir, part_size,
+                                pipeline, excerpts, budget, recency, state):
+    """Runs one split_concatenated_scripts call, recording into the active metrics."""
+    abs_root = os.path.abspath(root_dir)
+    out_dir = os.path.abspath(output_dir) if output_dir is not None else abs_root
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_path = os.path.join(out_dir, MANIFEST_FILENAME)
+    if state is not None and 'manifest' in state:
+        manifest = state['manifest']
+    else:
+        manifest = load_manifest(manifest_path) if incremental else None
+    if pipeline and (part_size is None or budget is not None or manifest is not None or state is not None):
+        logger.info("The pipeline needs --part-size without --budget and a full, one-off run; "
+                    "running sequentially")
+        pipeline = False
+    if state is None:
+        state = {}
+
+    count_tokens = split_by == 'tokens' or token_budget is not None
+    weight = 'tokens' if count_tokens else 'size'
+    tokenizer_name, token_counter = get_token_counter(tokenizer) if count_tokens else (None, None)
+
+    rules = rules or get_default_exclusion_rules()
+    over_budget = []
+    if pipeline:
+        # 1-4. Walk, filter, read, render and write as overlapping stages
+        tree, parts, directory_structure, written_parts = run_pipeline(
+            root_dir, out_dir, part_size, weight, token_counter, jobs, enumeration, use_ignore_files,
+            rules, dedupe, minify, compression, compression_level, excerpts
+        )
+        count_tree_exclusions(tree)
+        processed_count = sum(len(part) for part in parts)
+        num_parts = len(parts)
+    else:
+        # 1. Scan the directory tree once; both collection and the structure listing use it.
+        #    Directory venv/node_modules verdicts are cached for the whole run.
+        verdict_cache = state.setdefault('verdict_cache', {})
+        tree = state.get('tree')
+        if tree is None:
+            with timed_phase('walk'):
+                tree, context = build_tree(root_dir, enumeration, verdict_cache, use_ignore_files, rules)
+            if context is not None:
+                state['context'] = context
+        count_tree_exclusions(tree)
+
+        # 2. Collect all file contents
+        file_blocks, processed_count, skipped_count = collect_file_contents(
+            root_dir, tree, verdict_cache, rules, jobs=jobs, keep_content=not stream, manifest=manifest,
+            tokenizer=tokenizer if count_tokens else None,
+            token_cache=state.setdefault('token_cache', {}), block_cache=state.setdefault('block_cache', {}),
+            minify=minify, excerpts=excerpts
+        )
+        if minify:
+            report_minify_savings(file_blocks)
+        if budget is not None:
+            # Selected before deduplication, so no reference points to a file left out
+            with timed_phase('select'):
+                commit_times = git_last_commit_times(root_dir) if recency == 'git' else None
+                if recency == 'git' and commit_times is None:
+                    logger.warning("%s is not a git checkout; ranking recency by mtime instead", abs_root)
+                file_blocks, over_budget = select_files_by_priority(file_blocks, budget, weight, commit_times, rules)
+            processed_count = len(file_blocks)
+            metrics = _active_metrics.get()
+            if metrics is not None:
+                metrics['files']['included'] = processed_count
+        if dedupe:
+            file_blocks, duplicate_count, bytes_saved = deduplicate_blocks(file_blocks, token_counter)
+            logger.info("Replaced %s duplicate files with references (%s bytes saved)",
+                        duplicate_count, bytes_saved)
+            metrics = _active_metrics.get()
+            if metrics is not None:
+                metrics['files']['duplicates'] = duplicate_count
+                metrics['bytes_deduplicated'] = bytes_saved
+        with timed_phase('structure'):
+            directory_structure = generate_directory_structure(abs_root, tree)
     
-    # 2. Distribute files across parts
-    parts = distribute_files_across_parts(file_blocks, num_parts)
+        # 3. Distribute files across parts, keeping previous assignments when incremental.
+        #    Locality and part size splits are already stable across small changes and must
+        #    stay in path order, so they are always recomputed.
+        sticky = manifest is not None and strategy != 'locality' and part_size is None
+        parts = None
+        distribute_start = time.perf_counter()
+        if part_size is not None:
+            parts = fill_parts(file_blocks, part_size, weight)
+        elif token_budget is not None:
+            # Every part repeats the header and lists its own files in its index, so each block
+            # is charged for its index line; part 1 also has the structure and the list of
+            # files left out for the total budget
+            for block in file_blocks:
+                block['budget_tokens'] = block['tokens'] + token_counter(file_index_line(block, True) + '\n')
+            overhead, first_part_overhead = measure_part_overhead(
+                abs_root, directory_structure, token_counter, over_budget
+            )
+            if sticky:
+                parts = assign_parts_incrementally(
+                    file_blocks, manifest, manifest.get('num_parts'), 'budget_tokens',
+                    capacity=token_budget - overhead - first_part_overhead
+                )
+            if parts is None:
+                parts = distribute_files_by_budget(
+                    file_blocks, token_budget, 'budget_tokens', overhead, first_part_overhead,
+                    strategy, tolerance
+                )
+        else:
+            if sticky:
+                parts = assign_parts_incrementally(file_blocks, manifest, num_parts, weight)
+            if parts is None:
+                parts = distribute_files_across_parts(file_blocks, num_parts, weight, strategy, tolerance)
+        num_parts = len(parts)
+        add_phase_time('distribute', distribute_start)
     
-    # 3. Write each part to a file
-    write_parts_to_files(parts, root_dir)
+    # 4. Write each part whose contents changed to a file
+    #    Parts missing from the sidecar index are rewritten as well, to record their offsets.
+    own_index = token_budget is not None
+    if pipeline:
+        # Pipeline parts are laid out differently (see run_pipeline), so an incremental run
+        # after this one must not take them for its own unchanged parts
+        part_digests = [None] * num_parts
+    else:
+        part_digests = compute_part_digests(parts, directory_structure, count_tokens, over_budget, own_index)
+    previous_digests = [part.get('digest') for part in manifest['parts']] if manifest else []
+    index_path = os.path.join(out_dir, INDEX_FILENAME)
+    index = state['index'] if 'index' in state else load_part_index(index_path)
+    indexed_parts = index['parts'] if index else []
+    if pipeline:
+        part_numbers = set(range(1, num_parts + 1))
+    else:
+        part_numbers = {
+            i for i, digest in enumerate(part_digests, 1)
+            if i > len(previous_digests) or previous_digests[i - 1] != digest
+            or not os.path.exists(os.path.join(out_dir, part_filename(i, compression)))
+            or i > len(indexed_parts) or indexed_parts[i - 1] is None
+        }
+        written_parts = {}
+    if part_numbers and not pipeline:
+        with timed_phase('write'):
+            written_parts = write_parts_to_files(
+                parts, root_dir, tree, part_numbers, directory_structure, count_tokens,
+                minify, compression, compression_level, out_dir, over_budget, own_index
+            )
+    remove_stale_parts(out_dir, num_parts, compression)
+    new_index = update_part_index(index, written_parts, part_numbers, num_parts)
+    if new_index != index:
+        save_part_index(index_path, new_index)
+    state['index'] = new_index
+    if len(part_numbers) < num_parts:
+        logger.info("%s of %s parts unchanged; not rewritten", num_parts - len(part_numbers), num_parts)
+
+    # 5. Record what was written for the next incremental run
+    new_manifest = build_manifest(parts, part_digests, tree, rules, tokenizer_name, minify, excerpts,
+                                  over_budget)
+    if new_manifest != manifest:
+        save_manifest(manifest_path, new_manifest)
+    state['tree'] = tree
+    state['manifest'] = new_manifest
     
-    print(f"[INFO] Successfully split {processed_count} files into {num_parts} parts")
-    print(f"[INFO] Files created: {', '.join([OUTPUT_FILENAME_TEMPLATE.format(i+1) for i in range(num_parts)])}")
+    logger.info("Successfully split %s files into %s parts", processed_count, num_parts)
+    logger.info("Files created: %s", ', '.join([part_filename(i+1, compression) for i in range(num_parts)]))
+
+
+# --- Multiple Roots ---
+
+def expand_roots(patterns):
+    """
+    Returns the absolute root directories named by a list of paths and glob patterns
+    ('**' matches nested directories), in order and without repeats.
+    Raises ValueError for a plain path that is not a directory or a pattern that matches none.
+    """
+    roots = {}
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = [path for path in sorted(glob.glob(pattern, recursive=True)) if os.path.isdir(path)]
+            if not matches:
+                raise ValueError(f"no directories match {pattern}")
+        elif os.path.isdir(pattern):
+            matches = [pattern]
+        else:
+            raise ValueError(f"{pattern} is not a directory")
+        for path in matches:
+            roots.setdefault(os.path.abspath(path), None)
+    return list(roots)
+
+def root_output_dirs(roots, output_dir=None):
+    """
+    Returns the output directory of each root: the root itself, or with output_dir a
+    subdirectory of it named after the root's path below the roots' common parent.
+    """
+    if output_dir is None:
+        return list(roots)
+    base = os.path.commonpath(roots) if len(roots) > 1 else os.path.dirname(roots[0])
+    if base in roots:
+        base = os.path.dirname(base)  # One root contains the others
+    return [os.path.join(output_dir, os.path.relpath(root, base)) for root in roots]
+
+def _init_root_worker(log_level):
+    """Configures logging in a worker process that did not inherit it (spawn start method)."""
+    if log_level is not None:
+        configure_logging(log_level)
+
+def _split_root(root_dir, output_dir, config):
+    """Bundles one root in a worker process. Returns (metrics, error message)."""
+    try:
+        return split_concatenated_scripts(config=config, root_dir=root_dir, output_dir=output_dir), None
+    except Exception as e:
+        logger.error("Failed to bundle %s: %s", root_dir, e)
+        return None, f"{type(e).__name__}: {e}"
+
+def aggregate_metrics(results, seconds, processes):
+    """
+    Combines the metrics of several roots, given as (root, output_dir, metrics, error) tuples,
+    into one report: the per-root metrics, their summed counters and the overall throughput
+    over the wall time of the whole run.
+    """
+    report = {
+        'roots': [],
+        'processes': processes,
+        'total_seconds': seconds,
+        'phases': {phase: 0.0 for phase in METRIC_PHASES},
+        'bytes_read': 0,
+        'bytes_written': 0,
+        'files': {},
+        'failed': 0,
+    }
+    for root, output_dir, metrics, error in results:
+        report['roots'].append({'root': root, 'output_dir': output_dir, 'metrics': metrics, 'error': error})
+        if metrics is None:
+            report['failed'] += 1
+            continue
+        for phase, phase_seconds in metrics['phases'].items():
+            report['phases'][phase] = report['phases'].get(phase, 0.0) + phase_seconds
+        report['bytes_read'] += metrics['bytes_read']
+        report['bytes_written'] += metrics['bytes_written']
+        for name, count in metrics['files'].items():
+            report['files'][name] = report['files'].get(name, 0) + count
+    report['files_per_second'] = report['files'].get('included', 0) / seconds if seconds else 0.0
+    report['bytes_read_per_second'] = report['bytes_read'] / seconds if seconds else 0.0
+    return report
+
+def split_many_roots(roots, processes=None, output_dir=None, report_path=None, log_level=None, config=None,
+                     **settings):
+    """
+    Bundles each of several root directories into its own parts, on a pool of processes
+    (one per CPU by default) so the roots are walked, read and written in parallel.
+    Each root's parts, manifest and index go to its output directory (see root_output_dirs).
+    config and settings are the bundle settings for every root (see new_bundle_config),
+    whose root_dir and output_dir are replaced by each root's; with processes=1 the roots
+    are bundled one after another in this process. log_level configures logging in
+    worker processes that do not inherit it.
+    Returns the aggregate report (see aggregate_metrics), which is also written as JSON
+    to report_path when given. A root that fails is recorded with its error and does not
+    stop the others.
+    """
+    config = new_bundle_config(config, **settings)
+    roots = [os.path.abspath(root) for root in roots]
+    output_dirs = root_output_dirs(roots, output_dir)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, len(roots)))
+    logger.info("Bundling %s roots with %s process(es)", len(roots), processes)
+
+    start = time.perf_counter()
+    if processes == 1:
+        outcomes = [_split_root(root, out, config) for root, out in zip(roots, output_dirs)]
+    else:
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_root_worker,
+                                 initargs=(log_level,)) as executor:
+            futures = [executor.submit(_split_root, root, out, config) for root, out in zip(roots, output_dirs)]
+            outcomes = []
+            for root, future in zip(roots, futures):
+                try:
+                    outcomes.append(future.result())
+                except Exception as e:  # The worker itself died
+                    logger.error("Failed to bundle %s: %s", root, e)
+                    outcomes.append((None, f"{type(e).__name__}: {e}"))
+    seconds = time.perf_counter() - start
+
+    report = aggregate_metrics(
+        [(root, out, metrics, error) for root, out, (metrics, error) in zip(roots, output_dirs, outcomes)],
+        seconds, processes
+    )
+    logger.info("Bundled %s of %s roots in %.2fs: %s files, %.0f files/s",
+                len(roots) - report['failed'], len(roots), seconds, report['files'].get('included', 0),
+                report['files_per_second'])
+    if report_path is not None:
+        write_metrics_report(report_path, report)
+    return report
+
+
+def parse_args(argv=None):
+    """Parses command line options and compiles the rule files they name."""
+    parser = argparse.ArgumentParser(
+        description="Concatenate project source files into multiple text parts."
+    )
+    parser.add_argument(
+        '--parts', type=int, default=3, dest='num_parts', metavar='N',
+        help="Number of parts to split the files into (default: 3; ignored with --token-budget)"
+    )
+    roots = parser.add_mutually_exclusive_group()
+    roots.add_argument(
+        '--root', default='.', dest='root_dir', metavar='DIR',
+        help="Directory whose files are bundled (default: the current directory)"
+    )
+    roots.add_argument(
+        '--roots', nargs='+', default=None, metavar='DIR_OR_GLOB',
+        help="Bundle several roots, given as directories or glob patterns, each into its own "
+             "parts, on a pool of processes"
+    )
+    parser.add_argument(
+        '--processes', type=int, default=None, metavar='N',
+        help="With --roots: number of worker processes (default: one per CPU)"
+    )
+    parser.add_argument(
+        '--output-dir', default=None, metavar='DIR',
+        help="Directory the parts, manifest and index are written to and read from "
+             "(default: the root directory). With --roots each root gets a subdirectory of it"
+    )
+    parser.add_argument(
+        '--rules', action='append', default=[], dest='rule_files', metavar='FILE',
+        help="JSON rule file overriding the built-in exclusion lists; may be repeated, "
+             "later files apply on top of earlier ones (see load_rule_files)"
+    )
+    parser.add_argument(
+        '--jobs', type=int, default=1,
+        help="Number of threads used to read files (default: 1, sequential)"
+    )
+    parser.add_argument(
+        '--stream', action='store_true',
+        help="Keep only block sizes in memory and re-read each file while writing its part"
+    )
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help="Reuse the manifest of the previous run: only re-read changed files and "
+             "only rewrite parts whose contents changed"
+    )
+    parser.add_argument(
+        '--split-by', choices=['size', 'tokens'], default='size',
+        help="Balance parts by characters (default) or by estimated LLM tokens"
+    )
+    parser.add_argument(
+        '--token-budget', type=int, default=None,
+        help="Maximum tokens per part; the number of parts is chosen to fit, and each part's "
+             "file index lists only its own files (implies --split-by tokens)"
+    )
+    parser.add_argument(
+        '--part-size', type=int, default=None, metavar='N',
+        help="Fill parts in path order with up to N characters (tokens with --split-by tokens) "
+             "of file content each, instead of a fixed number of parts"
+    )
+    parser.add_argument(
+        '--pipeline', action='store_true',
+        help="With --part-size: walk, filter, read, render and write as overlapping stages "
+             "with bounded queues, so writing starts while the tree is still being walked. "
+             "The file index and directory structure then end the last part"
+    )
+    parser.add_argument(
+        '--budget', type=int, default=None, metavar='N',
+        help="Total characters (tokens with --split-by tokens) of file content to bundle; files "
+             "are ranked by priority (essential docs, type, recency, depth) and the best set that "
+             "fits is kept. The rest are listed in the file index"
+    )
+    parser.add_argument(
+        '--recency', choices=RECENCY_SOURCES, default='mtime',
+        help="With --budget: rank recently changed files higher by their mtime (default) or "
+             "by their last git commit"
+    )
+    parser.add_argument(
+        '--strategy', choices=DISTRIBUTION_STRATEGIES, default='balanced',
+        help="'balanced' packs largest files first; 'locality' keeps directory subtrees "
+             "contiguous and in path order"
+    )
+    parser.add_argument(
+        '--tolerance', type=float, default=DEFAULT_LOCALITY_TOLERANCE,
+        help="Locality mode: fraction of the target part size a cut may move to land on "
+             f"a directory boundary (default: {DEFAULT_LOCALITY_TOLERANCE})"
+    )
+    parser.add_argument(
+        '--enumerate', choices=ENUMERATION_MODES, default='walk', dest='enumeration',
+        help="How files are found: walk the filesystem (default), or list the files tracked "
+             "in the git index so untracked trees are never visited"
+    )
+    parser.add_argument(
+        '--no-ignore', action='store_false', dest='use_ignore_files',
+        help="Do not honour .gitignore/.ignore files when walking the filesystem"
+    )
+    parser.add_argument(
+        '--watch', action='store_true',
+        help="Keep running and regenerate the parts whenever files change"
+    )
+    parser.add_argument(
+        '--debounce', type=float, default=WATCH_DEBOUNCE_SECONDS,
+        help=f"Watch mode: seconds without changes before regenerating (default: {WATCH_DEBOUNCE_SECONDS})"
+    )
+    parser.add_argument(
+        '--poll', type=float, default=None, metavar='SECONDS',
+        help="Watch mode: stat-poll the tree at this interval instead of using inotify"
+    )
+    parser.add_argument(
+        '--tokenizer', choices=['auto'] + list(TOKENIZERS), default='heuristic',
+        help="Token counter: the built-in heuristic, tiktoken (an optional dependency: "
+             "pip install tiktoken), or auto"
+    )
+    parser.add_argument(
+        '--dedupe', action='store_true',
+        help="Write files whose content is identical to an earlier file as a short reference to it"
+    )
+    parser.add_argument(
+        '--minify', action='store_true',
+        help="Strip comments and collapse whitespace in JS, CSS and HTML files and write JSON "
+             "compactly; string literals and Python files are never changed"
+    )
+    parser.add_argument(
+        '--excerpt', action='store_true',
+        help=f"Keep files over the size or line limits as their first and last lines "
+             f"(default: {EXCERPT_HEAD_LINES} and {EXCERPT_TAIL_LINES}) around a marker, instead of skipping them"
+    )
+    parser.add_argument(
+        '--excerpt-limit', action='append', default=[], dest='excerpt_limits', metavar='EXT:KEY=N,...',
+        help="Excerpt limits for one extension, e.g. '.py:max_lines=5000,tail_lines=100'; keys are "
+             "max_lines, max_size_mb, head_lines and tail_lines. May be repeated; implies --excerpt"
+    )
+    parser.add_argument(
+        '--compress', choices=list(COMPRESSION_FORMATS), default=None, dest='compression',
+        help="Write the parts through a streaming compressor (adds .gz, .bz2 or .xz to their names)"
+    )
+    parser.add_argument(
+        '--compress-level', type=int, default=None, dest='compression_level',
+        help="Compression level: 0-9 for gzip and lzma, 1-9 for bz2 (default: "
+             + ", ".join(f"{name} {level}" for name, (_, level, _) in COMPRESSION_FORMATS.items()) + ")"
+    )
+    parser.add_argument(
+        '--read', default=None, metavar='PART',
+        help="Print an output part, plain or compressed, to stdout and exit"
+    )
+    parser.add_argument(
+        '--extract', default=None, metavar='FILE',
+        help="Print the block of one file from the existing parts, using the sidecar index, and exit"
+    )
+    parser.add_argument(
+        '--report', default=None, metavar='PATH',
+        help="Write a JSON report of per-phase timings, bytes read and written, and "
+             "exclusion rule hits to PATH"
+    )
+    parser.add_argument(
+        '--log-level', choices=list(LOG_LEVELS), default='info',
+        help="Most detailed messages to print; 'debug' lists every file (default: info)"
+    )
+    args = parser.parse_args(argv)
+    if args.num_parts < 1:
+        parser.error("--parts must be at least 1")
+    if not os.path.isdir(args.root_dir):
+        parser.error(f"--root {args.root_dir} is not a directory")
+    if args.roots is not None:
+        try:
+            args.roots = expand_roots(args.roots)
+        except ValueError as e:
+            parser.error(f"--roots: {e}")
+        if args.watch or args.read is not None or args.extract is not None:
+            parser.error("--roots cannot be combined with --watch, --read or --extract")
+    if args.processes is not None and args.processes < 1:
+        parser.error("--processes must be at least 1")
+    try:
+        args.rules = load_rule_files(args.rule_files) if args.rule_files else None
+    except (OSError, ValueError) as e:
+        parser.error(f"--rules: {e}")
+    try:
+        args.excerpts = parse_excerpt_limits(args.excerpt_limits) if args.excerpt or args.excerpt_limits else None
+    except ValueError as e:
+        parser.error(f"--excerpt-limit: {e}")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.debounce < 0 or (args.poll is not None and args.poll <= 0):
+        parser.error("--debounce must not be negative and --poll must be positive")
+    if not 0 <= args.tolerance < 1:
+        parser.error("--tolerance must be between 0 and 1")
+    if args.token_budget is not None and args.token_budget < 1:
+        parser.error("--token-budget must be at least 1")
+    if args.budget is not None and args.budget < 1:
+        parser.error("--budget must be at least 1")
+    if args.part_size is not None and (args.part_size < 1 or args.token_budget is not None):
+        parser.error("--part-size must be at least 1 and cannot be combined with --token-budget")
+    if args.compression == 'bz2' and bz2 is None or args.compression == 'lzma' and lzma is None:
+        parser.error(f"--compress {args.compression} is not supported by this Python build")
+    if args.compression_level is not None:
+        lowest = 1 if args.compression == 'bz2' else 0
+        if args.compression is None or not lowest <= args.compression_level <= 9:
+            parser.error(f"--compress-level must be between {lowest} and 9 and needs --compress")
+    if args.tokenizer == 'tiktoken' and tiktoken is None:
+        parser.error("--tokenizer tiktoken requires the tiktoken package to be installed")
+    return args
+
+
+def main(argv=None):
+    """Runs the command line; returns the process exit status."""
+    args = parse_args(argv)
+    configure_logging(args.log_level)
+    config = new_bundle_config(
+        num_parts=args.num_parts, root_dir=args.root_dir, jobs=args.jobs, stream=args.stream,
+        incremental=args.incremental, split_by=args.split_by, token_budget=args.token_budget,
+        tokenizer=args.tokenizer, strategy=args.strategy, tolerance=args.tolerance,
+        enumeration=args.enumeration, use_ignore_files=args.use_ignore_files, dedupe=args.dedupe,
+        minify=args.minify, compression=args.compression, compression_level=args.compression_level,
+        rules=args.rules, output_dir=args.output_dir, part_size=args.part_size, pipeline=args.pipeline,
+        excerpts=args.excerpts, budget=args.budget, recency=args.recency
+    )
+    if args.roots is not None:
+        report = split_many_roots(args.roots, args.processes, args.output_dir, args.report, args.log_level,
+                                  config)
+        return 1 if report['failed'] else 0
+    if args.read is not None:
+        for chunk in iter_part_text(args.read):
+            sys.stdout.write(chunk)
+    elif args.extract is not None:
+        try:
+            bundle = open_bundle(args.output_dir or args.root_dir)
+        except OSError as e:
+            logger.error("Could not open the parts: %s", e)
+            return 1
+        try:
+            sys.stdout.write(lookup_block(bundle, args.extract))
+        except KeyError:
+            logger.error("%s is not in the index", args.extract)
+            return 1
+        except (OSError, ValueError) as e:
+            # A part that is missing, changed since it was indexed, or not valid UTF-8
+            logger.error("Could not extract %s: %s", args.extract, e)
+            return 1
+        finally:
+            close_bundle(bundle)
+    else:
+        # Settings that only fail once the files are known, such as a token budget
+        # too small for the part header and directory structure, raise ValueError
+        try:
+            if args.watch:
+                watch_and_regenerate(
+                    args.debounce, args.poll or WATCH_POLL_INTERVAL, args.poll is None,
+                    config=config, report_path=args.report
+                )
+            else:
+                split_concatenated_scripts(config=config, report_path=args.report)
+        except ValueError as e:
+            logger.error("%s", e)
+            return 1
+    return 0
 
 
 # --- Main Execution ---
 if __name__ == '__main__':
-    split_concatenated_scripts(num_parts=3, root_dir='.') 
\ No newline at end of file
+    sys.exit(main())
@@ -0,0 +1,44 @@
+import os
+import sys
+
+import pytest
+
+# concatenate_scripts is a single module at the repository root rather than an installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import concatenate_scripts  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def restore_logging():
+    """main() points the module's logger at the current stdout, which pytest swaps per test."""
+    logger = concatenate_scripts.logger
+    saved = logger.handlers[:], logger.level, logger.propagate
+    yield
+    logger.handlers, logger.level, logger.propagate = saved
+
+
+@pytest.fixture
+def project(tmp_path):
+    """A small source tree of 30 Python files of varying size in three packages."""
+    root = tmp_path / 'proj'
+    for i in range(30):
+        path = root / f'pkg{i % 3}' / f'mod{i}.py'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(f'def f{i}():\n    return "%s"\n' % ('x' * (150 + 10 * (i % 9))))
+    return root
+
+
+def part_names(out):
+    """Names of the part files in out, in part number order."""
+    paths = out.glob('concatenated_scripts_part*')
+    return [path.name for path in sorted(paths, key=lambda path: int(path.name.split('part')[1].split('.')[0]))]
+
+
+def read_blocks(out):
+    """The blocks of the parts in out, by path, as the sidecar index finds them."""
+    bundle = concatenate_scripts.open_bundle(str(out))
+    try:
+        return {path: concatenate_scripts.lookup_block(bundle, path) for path in bundle['files']}
+    finally:
+        concatenate_scripts.close_bundle(bundle)
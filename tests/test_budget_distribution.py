@@ -0,0 +1,90 @@
+import re
+
+import pytest
+
+import concatenate_scripts as cs
+
+
+def make_blocks(sizes):
+    return [{'path': f'src/d{i % 7}/f{i}.py', 'tokens': size, 'size': size * 4} for i, size in enumerate(sizes)]
+
+
+def part_tokens(part):
+    return sum(block['tokens'] for block in part)
+
+
+@pytest.mark.parametrize('strategy', ['balanced', 'locality'])
+def test_parts_fit_the_budget(strategy):
+    blocks = make_blocks([(i * 37) % 500 + 1 for i in range(400)])
+    budget, overhead, first_overhead = 5000, 100, 1500
+    parts = cs.distribute_files_by_budget(blocks, budget, 'tokens', overhead, first_overhead, strategy)
+    assert sorted(b['path'] for part in parts for b in part) == sorted(b['path'] for b in blocks)
+    assert part_tokens(parts[0]) <= budget - overhead - first_overhead
+    assert all(part_tokens(part) <= budget - overhead for part in parts[1:])
+
+
+def test_balanced_uses_close_to_the_minimum_number_of_parts():
+    blocks = make_blocks([100] * 1000)
+    parts = cs.distribute_files_by_budget(blocks, 10_100, 'tokens', overhead=100, first_part_overhead=5000)
+    # 100,000 tokens plus 5,000 for the structure, 10,000 per part
+    assert len(parts) == 11
+    assert part_tokens(parts[0]) <= 5000
+
+
+def test_oversized_blocks_get_their_own_parts():
+    blocks = make_blocks([100] * 2000 + [50_000, 60_000])
+    parts = cs.distribute_files_by_budget(blocks, 10_000, 'tokens')
+    oversized = [part for part in parts if part_tokens(part) > 10_000]
+    assert sorted(part_tokens(part) for part in oversized) == [50_000, 60_000]
+    assert all(len(part) == 1 for part in oversized)
+    # The remaining 200,000 tokens still fill whole parts rather than one part per file
+    assert len(parts) - len(oversized) == 20
+
+
+def test_only_oversized_blocks():
+    parts = cs.distribute_files_by_budget(make_blocks([500, 700]), 100, 'tokens')
+    assert sorted(part_tokens(part) for part in parts) == [500, 700]
+
+
+def test_no_blocks():
+    assert cs.distribute_files_by_budget([], 100, 'tokens') == [[]]
+
+
+def test_budget_smaller_than_the_overhead():
+    with pytest.raises(ValueError, match='leaves no room'):
+        cs.distribute_files_by_budget(make_blocks([10]), 100, 'tokens', overhead=60, first_part_overhead=40)
+
+
+def test_file_index_of_one_part():
+    parts = [make_blocks([1, 2]), make_blocks([3]), []]
+    index = cs.build_file_index(parts, True, listed_part=2)
+    assert '## Part 2 (1 files, ~3 tokens):' in index
+    assert '## Part 1' not in index
+    assert '## Other parts: 2 (each lists its own files)' in index
+    assert index.count('  - ') == 1
+
+
+def test_token_budget_parts_list_only_their_own_files(project, tmp_path):
+    out = tmp_path / 'out'
+    assert cs.main(['--root', str(project), '--output-dir', str(out), '--token-budget', '2000']) == 0
+    parts = sorted(out.glob('concatenated_scripts_part*'))
+    assert len(parts) > 2
+    _, counter = cs.get_token_counter('heuristic')
+    listed = []
+    for path in parts:
+        text = path.read_text(encoding='utf-8')
+        index = text[text.index('# File Index'):]
+        index = index[:index.index('=' * 80)]
+        files = re.findall(r'^  - (\S+)', index, re.MULTILINE)
+        assert files == re.findall(r'^# File: (\S+)$', text, re.MULTILINE)[::2]
+        listed += files
+        header = text[:text.index('# File: ')] if files else text
+        tokens = int(re.search(r'~(\d+) tokens\)', index).group(1))
+        assert counter(header) + tokens <= 2000
+    assert len(listed) == 30
+
+
+def test_too_small_token_budget_exits_with_an_error(project, tmp_path, capsys):
+    out = tmp_path / 'out'
+    assert cs.main(['--root', str(project), '--output-dir', str(out), '--token-budget', '50']) == 1
+    assert '[ERROR] Budget of 50 tokens leaves no room for files' in capsys.readouterr().out
@@ -0,0 +1,70 @@
+import json
+
+import pytest
+
+import concatenate_scripts as cs
+from conftest import part_names
+
+
+def test_settings_apply_over_a_copy_of_the_config():
+    config = cs.new_bundle_config(num_parts=5, minify=True)
+    derived = cs.new_bundle_config(config, minify=False)
+    assert config['num_parts'] == derived['num_parts'] == 5
+    assert config['minify'] and not derived['minify']
+    assert cs.new_bundle_config()['num_parts'] == 3
+
+
+def test_unknown_setting_is_rejected():
+    with pytest.raises(TypeError, match='num_part'):
+        cs.new_bundle_config(num_part=2)
+    with pytest.raises(TypeError):
+        cs.split_concatenated_scripts(config=cs.new_bundle_config(), num_part=2)
+
+
+def test_config_and_keyword_settings_write_the_same_parts(project, tmp_path):
+    config = cs.new_bundle_config(root_dir=str(project), output_dir=str(tmp_path / 'config'), num_parts=2)
+    cs.split_concatenated_scripts(config=config)
+    cs.split_concatenated_scripts(root_dir=str(project), output_dir=str(tmp_path / 'keywords'), num_parts=2)
+    names = part_names(tmp_path / 'config')
+    assert names == part_names(tmp_path / 'keywords') == ['concatenated_scripts_part1.txt',
+                                                          'concatenated_scripts_part2.txt']
+
+
+def test_keyword_settings_override_the_config(project, tmp_path):
+    config = cs.new_bundle_config(root_dir=str(project), output_dir=str(tmp_path / 'out'), num_parts=2)
+    cs.split_concatenated_scripts(config=config, num_parts=4, compression='gzip')
+    assert part_names(tmp_path / 'out') == [f'concatenated_scripts_part{i}.txt.gz' for i in range(1, 5)]
+    assert config['num_parts'] == 2
+
+
+def test_many_roots_share_the_config(project, tmp_path):
+    other = tmp_path / 'other'
+    other.mkdir()
+    (other / 'main.py').write_text('print(1)\n')
+    out = tmp_path / 'out'
+    config = cs.new_bundle_config(root_dir='ignored', output_dir='ignored', num_parts=1)
+    report = cs.split_many_roots([str(project), str(other)], processes=1, output_dir=str(out), config=config)
+    assert report['failed'] == 0
+    assert report['files']['included'] == 31
+    assert part_names(out / 'proj') == part_names(out / 'other') == ['concatenated_scripts_part1.txt']
+
+
+def test_watch_takes_the_config(project, tmp_path):
+    report_path = tmp_path / 'report.json'
+    config = cs.new_bundle_config(root_dir=str(project), output_dir=str(tmp_path / 'out'), num_parts=2)
+    cs.watch_and_regenerate(0.1, 0.1, False, 0, config=config, report_path=str(report_path))
+    assert part_names(tmp_path / 'out') == ['concatenated_scripts_part1.txt', 'concatenated_scripts_part2.txt']
+    assert json.loads(report_path.read_text())['files']['included'] == 30
+
+
+def test_positional_call_form_still_works(project, monkeypatch):
+    monkeypatch.chdir(project)
+    metrics = cs.split_concatenated_scripts(2, '.')
+    assert metrics['files']['included'] == 30
+    assert part_names(project) == ['concatenated_scripts_part1.txt', 'concatenated_scripts_part2.txt']
+
+
+def test_positional_settings_override_the_config(project, tmp_path):
+    config = cs.new_bundle_config(root_dir='missing', output_dir=str(tmp_path / 'out'), num_parts=5)
+    cs.split_concatenated_scripts(2, str(project), config=config)
+    assert part_names(tmp_path / 'out') == ['concatenated_scripts_part1.txt', 'concatenated_scripts_part2.txt']
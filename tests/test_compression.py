@@ -0,0 +1,66 @@
+import bz2
+import gzip
+import lzma
+import re
+
+import pytest
+
+import concatenate_scripts as cs
+from conftest import read_blocks
+
+GENERATED_LINE = re.compile(r'^# Generated: .*$', re.MULTILINE)
+DECOMPRESS = {'gzip': gzip.decompress, 'bz2': bz2.decompress, 'lzma': lzma.decompress}
+
+
+def parts(out):
+    return sorted(path.name for path in out.iterdir() if cs.OUTPUT_FILENAME_REGEX.fullmatch(path.name))
+
+
+def without_timestamp(text):
+    return GENERATED_LINE.sub('', text)
+
+
+@pytest.fixture
+def plain(project, tmp_path):
+    out = tmp_path / 'plain'
+    cs.split_concatenated_scripts(3, str(project), output_dir=str(out))
+    return out
+
+
+@pytest.mark.parametrize('compression', list(cs.COMPRESSION_FORMATS))
+def test_parts_decompress_to_the_plain_text(project, tmp_path, plain, compression):
+    out = tmp_path / compression
+    cs.split_concatenated_scripts(3, str(project), output_dir=str(out), compression=compression)
+    suffix = cs.COMPRESSION_FORMATS[compression][0]
+    assert parts(out) == [name + suffix for name in parts(plain)]
+    for name in parts(plain):
+        data = (out / (name + suffix)).read_bytes()
+        assert data.startswith(cs.COMPRESSION_FORMATS[compression][2])
+        assert cs.detect_compression(str(out / (name + suffix))) == compression
+        assert without_timestamp(DECOMPRESS[compression](data).decode('utf-8')) == \
+            without_timestamp((plain / name).read_text(encoding='utf-8'))
+
+
+@pytest.mark.parametrize('compression', list(cs.COMPRESSION_FORMATS))
+def test_blocks_and_chunks_read_back(project, tmp_path, plain, compression):
+    out = tmp_path / compression
+    cs.split_concatenated_scripts(3, str(project), output_dir=str(out), compression=compression)
+    assert read_blocks(out) == read_blocks(plain)
+    name = parts(out)[0]
+    chunks = list(cs.iter_part_text(str(out / name), chunk_size=100))
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    assert ''.join(chunks) == DECOMPRESS[compression]((out / name).read_bytes()).decode('utf-8')
+
+
+def test_compressed_parts_are_smaller(project, tmp_path, plain):
+    metrics = cs.split_concatenated_scripts(3, str(project), output_dir=str(tmp_path / 'gz'), compression='gzip')
+    assert metrics['bytes_written'] < sum((plain / name).stat().st_size for name in parts(plain)) / 2
+
+
+def test_switching_format_removes_the_old_parts(project, tmp_path):
+    out = tmp_path / 'out'
+    cs.split_concatenated_scripts(3, str(project), output_dir=str(out), compression='bz2')
+    cs.split_concatenated_scripts(3, str(project), output_dir=str(out), compression='gzip')
+    assert parts(out) == [f'concatenated_scripts_part{i}.txt.gz' for i in (1, 2, 3)]
+    cs.split_concatenated_scripts(3, str(project), output_dir=str(out))
+    assert parts(out) == [f'concatenated_scripts_part{i}.txt' for i in (1, 2, 3)]
@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+import concatenate_scripts as cs
+from conftest import part_names, read_blocks
+
+BIG = 'def g():\n    return %r\n' % ('z' * 2000)
+SMALL = 'A = 1\n'
+
+
+@pytest.fixture
+def copies(tmp_path):
+    """Three copies of a large file and two of a small one."""
+    root = tmp_path / 'proj'
+    for rel, text in [('a/one.py', BIG), ('b/one.py', BIG), ('b/two.py', BIG), ('a/s.py', SMALL), ('b/s.py', SMALL)]:
+        path = root / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text)
+    return root
+
+
+def reference(original):
+    return f'[DUPLICATE: identical to {original}; its content is not repeated]'
+
+
+def bundle_text(out):
+    return ''.join((out / name).read_text(encoding='utf-8') for name in part_names(out))
+
+
+def test_copies_become_references_to_the_first(copies, tmp_path):
+    metrics = cs.split_concatenated_scripts(2, str(copies), output_dir=str(tmp_path / 'out'), dedupe=True)
+    blocks = read_blocks(tmp_path / 'out')
+    assert sorted(blocks) == ['a/one.py', 'a/s.py', 'b/one.py', 'b/s.py', 'b/two.py']
+    assert 'zzzz' in blocks['a/one.py']
+    for path in ('b/one.py', 'b/two.py'):
+        assert reference('a/one.py') in blocks[path]
+        assert 'zzzz' not in blocks[path]
+    # The reference would be longer than the small file, so both copies are kept whole
+    assert 'A = 1' in blocks['a/s.py'] and 'A = 1' in blocks['b/s.py']
+    assert metrics['files']['duplicates'] == 2
+    assert metrics['bytes_deduplicated'] > len(BIG)
+
+
+def test_index_names_the_original(copies, tmp_path):
+    cs.split_concatenated_scripts(2, str(copies), output_dir=str(tmp_path / 'out'), dedupe=True)
+    text = bundle_text(tmp_path / 'out')
+    assert '  - b/one.py (same as a/one.py)\n' in text
+    assert '  - b/two.py (same as a/one.py)\n' in text
+    assert '  - a/one.py\n' in text
+
+
+def test_dedupe_shrinks_the_bundle(copies, tmp_path):
+    plain = cs.split_concatenated_scripts(2, str(copies), output_dir=str(tmp_path / 'plain'))
+    deduped = cs.split_concatenated_scripts(2, str(copies), output_dir=str(tmp_path / 'out'), dedupe=True)
+    assert plain['files']['duplicates'] == 0
+    assert deduped['bytes_written'] < plain['bytes_written'] - len(BIG)
+
+
+def test_stream_gives_the_same_references(copies, tmp_path):
+    cs.split_concatenated_scripts(2, str(copies), output_dir=str(tmp_path / 'full'), dedupe=True)
+    cs.split_concatenated_scripts(2, str(copies), output_dir=str(tmp_path / 'stream'), dedupe=True, stream=True)
+    assert read_blocks(tmp_path / 'stream') == read_blocks(tmp_path / 'full')
+
+
+def test_incremental_run_picks_a_new_original(copies, tmp_path):
+    out = tmp_path / 'out'
+    cs.split_concatenated_scripts(2, str(copies), output_dir=str(out), dedupe=True, incremental=True)
+    changed = copies / 'a' / 'one.py'
+    changed.write_text('CHANGED = True\n' + BIG)
+    stat = changed.stat()
+    os.utime(changed, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    metrics = cs.split_concatenated_scripts(2, str(copies), output_dir=str(out), dedupe=True, incremental=True)
+    assert metrics['files']['read'] == 1
+    blocks = read_blocks(out)
+    # b/one.py is now the first copy, so its cached full block is written again
+    assert 'zzzz' in blocks['b/one.py']
+    assert reference('b/one.py') in blocks['b/two.py']
+    assert 'CHANGED = True' in blocks['a/one.py']
@@ -0,0 +1,81 @@
+import random
+import time
+
+import pytest
+
+import concatenate_scripts as cs
+
+
+def random_blocks(count, seed=1):
+    rng = random.Random(seed)
+    return [{'path': f'src/d{rng.randrange(20)}/sub{rng.randrange(3)}/f{i}.py', 'size': rng.randrange(1, 5000)}
+            for i in range(count)]
+
+
+def reference_balance(file_blocks, num_parts):
+    """The original greedy loop: largest first into the first smallest part."""
+    parts = [[] for _ in range(num_parts)]
+    part_sizes = [0] * num_parts
+    for block in sorted(file_blocks, key=lambda block: block['size'], reverse=True):
+        i = part_sizes.index(min(part_sizes))
+        parts[i].append(block)
+        part_sizes[i] += block['size']
+    return parts, part_sizes
+
+
+# --- Balanced ---
+
+@pytest.mark.parametrize('num_parts', [1, 3, 17])
+def test_heap_balance_matches_the_greedy_loop(num_parts):
+    blocks = random_blocks(500)
+    parts, part_sizes = cs.balance_parts(list(blocks), num_parts)
+    expected_parts, expected_sizes = reference_balance(blocks, num_parts)
+    assert part_sizes == expected_sizes
+    assert [[block['path'] for block in part] for part in parts] == \
+        [[block['path'] for block in part] for part in expected_parts]
+
+
+def test_balanced_parts_differ_by_at_most_the_largest_block():
+    blocks = random_blocks(2000)
+    _, part_sizes = cs.balance_parts(list(blocks), 7)
+    assert max(part_sizes) - min(part_sizes) <= max(block['size'] for block in blocks)
+    assert sum(part_sizes) == sum(block['size'] for block in blocks)
+
+
+def test_hundreds_of_parts_stay_fast():
+    blocks = random_blocks(50000)
+    start = time.perf_counter()
+    parts, _ = cs.balance_parts(blocks, 500)
+    assert time.perf_counter() - start < 5
+    assert sum(len(part) for part in parts) == 50000
+
+
+# --- Locality ---
+
+def test_locality_parts_are_contiguous_in_path_order():
+    blocks = random_blocks(600)
+    parts, part_sizes = cs.locality_parts(list(blocks), 5, tolerance=0.2)
+    flattened = [block['path'] for part in parts for block in part]
+    assert flattened == [block['path'] for block in sorted(blocks, key=cs._path_key)]
+    target = sum(block['size'] for block in blocks) / 5
+    # Each part is within the tolerance window around its share, give or take one file
+    largest = max(block['size'] for block in blocks)
+    assert all(abs(size - target) <= 0.2 * target * 2 + largest for size in part_sizes)
+
+
+def test_locality_cuts_at_a_directory_boundary_within_tolerance():
+    # Two directories of 12 and 8 equal files: the ideal halfway cut falls inside 'a',
+    # and the boundary between 'a' and 'b' is within 25% of it
+    blocks = [{'path': f'a/f{i:02d}.py', 'size': 100} for i in range(12)]
+    blocks += [{'path': f'b/f{i:02d}.py', 'size': 100} for i in range(8)]
+    parts, part_sizes = cs.locality_parts(list(blocks), 2, tolerance=0.25)
+    assert {block['path'].split('/')[0] for block in parts[0]} == {'a'}
+    assert {block['path'].split('/')[0] for block in parts[1]} == {'b'}
+    assert part_sizes == [1200, 800]
+
+
+def test_locality_without_slack_cuts_at_the_ideal_position():
+    blocks = [{'path': f'a/f{i:02d}.py', 'size': 100} for i in range(12)]
+    blocks += [{'path': f'b/f{i:02d}.py', 'size': 100} for i in range(8)]
+    _, part_sizes = cs.locality_parts(list(blocks), 2, tolerance=0)
+    assert part_sizes == [1000, 1000]
@@ -0,0 +1,62 @@
+import codecs
+
+import pytest
+
+import concatenate_scripts as cs
+
+
+@pytest.mark.parametrize('data', [
+    b'a\x00b',
+    b'a\x00',
+    b'\x00a',
+    b'MZ\x90\x00\x03\x00\x00\x00',
+])
+def test_short_binaries_are_not_utf16(data):
+    assert cs.sniff_utf16(data, complete=True) is None
+    assert cs.sniff_encoding(data, complete=True) is None
+
+
+def test_odd_length_file_is_not_utf16():
+    data = 'print("hello world")\n'.encode('utf-16-le') + b'x'
+    assert cs.sniff_utf16(data, complete=True) is None
+
+
+def test_odd_length_prefix_may_still_be_utf16():
+    # A prefix cut short of the whole file can end half way through a code unit
+    data = 'print("hello world")\n'.encode('utf-16-le') + b'x'
+    assert cs.sniff_utf16(data) == 'utf-16-le'
+
+
+@pytest.mark.parametrize('encoding', ['utf-16-le', 'utf-16-be'])
+def test_bomless_utf16_text(encoding):
+    data = 'def main():\n    return 42\n'.encode(encoding)
+    assert cs.sniff_utf16(data, complete=True) == encoding
+    assert cs.sniff_encoding(data, complete=True) == encoding
+
+
+def test_sparse_nuls_are_binary():
+    # Every fourth byte a NUL: too few for the alternating pattern of UTF-16 text
+    data = b'abc\x00' * 16
+    assert cs.sniff_utf16(data, complete=True) is None
+
+
+def test_ascii_range_control_bytes_are_binary():
+    # No NULs and every byte below 0x80, but mostly control bytes
+    data = bytes(range(1, 32)) * 8 + b'IDAT'
+    assert cs.sniff_encoding(data, complete=True) is None
+
+
+def test_text_with_a_few_control_bytes_is_utf8():
+    assert cs.sniff_encoding(b'\x1b[1mbold\x1b[0m and a form feed\x0c\n' * 4, complete=True) == 'utf-8'
+
+
+def test_bom_wins_over_sniffing():
+    assert cs.sniff_encoding(codecs.BOM_UTF16_LE + 'a'.encode('utf-16-le'), complete=True) == 'utf-16'
+    assert cs.sniff_encoding(codecs.BOM_UTF8 + b'x', complete=True) == 'utf-8-sig'
+
+
+def test_read_file_text_skips_short_binary(tmp_path):
+    path = tmp_path / 'blob.bin'
+    path.write_bytes(b'a\x00b')
+    text, line_count, encoding, _ = cs.read_file_text(str(path))
+    assert encoding is None
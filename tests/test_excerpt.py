@@ -0,0 +1,137 @@
+import codecs
+import random
+import re
+
+import pytest
+
+import concatenate_scripts as cs
+
+MARKER = re.compile(r'\[EXCERPT: (\d+) bytes elided, about (\d+) of (\d+) lines\]\n')
+
+ENCODINGS = [
+    ('utf-8', b''),
+    ('utf-16-le', codecs.BOM_UTF16_LE),
+    ('utf-16-be', codecs.BOM_UTF16_BE),
+    ('utf-16-le', b''),
+    ('utf-32-le', codecs.BOM_UTF32_LE),
+]
+
+
+def write_lines(path, lines, encoding='utf-8', bom=b''):
+    text = ''.join(lines)
+    path.write_bytes(bom + text.encode(encoding))
+    return text
+
+
+def split_excerpt(text):
+    match = MARKER.search(text)
+    assert match, text[:200]
+    return text[:match.start()], text[match.end():], match
+
+
+@pytest.mark.parametrize('encoding, bom', ENCODINGS)
+def test_keeps_whole_first_and_last_lines(tmp_path, encoding, bom):
+    rng = random.Random(7)
+    lines = [f"line {i:04d} {'é' * rng.randrange(40)}\n" for i in range(3000)]
+    path = tmp_path / 'big.txt'
+    write_lines(path, lines, encoding, bom)
+
+    text, line_count, sniffed, bytes_read, _ = cs.read_file_excerpt(str(path), 20, 5, 64 * 1024)
+    assert sniffed is not None
+    head, tail, match = split_excerpt(text)
+    assert head == ''.join(lines[:20])
+    assert tail == ''.join(lines[-5:])
+    assert int(match.group(1)) == path.stat().st_size - len(bom) - len((head + tail).encode(encoding))
+    assert bytes_read < path.stat().st_size
+    # Lines are about as long at the ends as in the middle, so the estimate is close
+    assert line_count == pytest.approx(3000, rel=0.1)
+
+
+@pytest.mark.parametrize('encoding, bom', ENCODINGS)
+def test_random_cuts_stay_on_line_boundaries(tmp_path, encoding, bom):
+    rng = random.Random(11)
+    path = tmp_path / 'f.txt'
+    for _ in range(60):
+        lines = [''.join(rng.choice('ab é中') for _ in range(rng.randrange(30))) + '\n'
+                 for _ in range(rng.randrange(1, 80))]
+        if rng.random() < 0.3:
+            lines[-1] = lines[-1].rstrip('\n')
+        full = write_lines(path, lines, encoding, bom)
+        head_lines, tail_lines = rng.randrange(6), rng.randrange(6)
+        max_bytes = rng.randrange(8, 400)
+
+        text, _, _, _, _ = cs.read_file_excerpt(str(path), head_lines, tail_lines, max_bytes)
+        match = MARKER.search(text)
+        if match is None:
+            assert text == full
+            continue
+        head, tail = text[:match.start()], text[match.end():]
+        # A cut inside a long line may drop a partly read character
+        assert full.startswith(head.rstrip('\n')[:-1])
+        assert full.endswith(tail[1:])
+        assert head.count('\n') <= head_lines + 1
+        assert tail.count('\n') <= tail_lines
+
+
+def test_middle_is_not_read(tmp_path):
+    path = tmp_path / 'data.csv'
+    lines = [f'{i},value\n' for i in range(50_000)]
+    write_lines(path, lines)
+    first = cs.read_file_excerpt(str(path), 10, 10, 4096)
+
+    # Same size and ends, different middle: the excerpt and its hash are the same
+    data = bytearray(path.read_bytes())
+    middle = len(data) // 2
+    data[middle:middle + 5] = b'XXXXX'
+    path.write_bytes(bytes(data))
+    second = cs.read_file_excerpt(str(path), 10, 10, 4096)
+    assert second == first
+
+    # A different size changes the hash
+    path.write_bytes(bytes(data) + b'1,more\n')
+    third = cs.read_file_excerpt(str(path), 10, 9, 4096)
+    assert third[4] != first[4]
+
+
+def test_long_lines_are_cut_to_the_byte_limit(tmp_path):
+    path = tmp_path / 'min.js'
+    write_lines(path, ['x' * 100_000])
+    text, line_count, _, bytes_read, _ = cs.read_file_excerpt(str(path), 5, 5, 1000)
+    head, tail, match = split_excerpt(text)
+    assert head == 'x' * 500 + '\n'
+    assert tail == 'x' * 500
+    assert int(match.group(1)) == 99_000
+    assert bytes_read == 1000
+
+
+def test_binary_file(tmp_path):
+    path = tmp_path / 'blob.bin'
+    path.write_bytes(b'\x00\x01\x02\x03' * 10_000)
+    assert cs.read_file_excerpt(str(path), 5, 5, 1000) == (None, 0, None, cs.SNIFF_BYTES, None)
+
+
+def test_small_file_is_returned_whole(tmp_path):
+    path = tmp_path / 'small.py'
+    full = write_lines(path, ['a\n', 'b\n', 'c'])
+    text, line_count, _, bytes_read, _ = cs.read_file_excerpt(str(path), 5, 5, 1000)
+    assert (text, line_count, bytes_read) == (full, 3, len(full))
+
+
+def test_excerpt_text_of_read_text():
+    text = ''.join(f'{i}\n' for i in range(10))
+    assert cs.excerpt_text(text, 10, 2, 1) == '0\n1\n[EXCERPT: 7 of 10 lines elided]\n9\n'
+    assert cs.excerpt_text(text, 10, 5, 5) == text
+
+
+def test_files_differing_only_in_the_middle_are_not_deduplicated(tmp_path):
+    root, out = tmp_path / 'proj', tmp_path / 'out'
+    root.mkdir()
+    lines = [f'line {i:06d}\n' for i in range(20000)]
+    write_lines(root / 'a.py', lines)
+    lines[10000] = 'changed\n'.ljust(len(lines[10000]))
+    write_lines(root / 'b.py', lines)
+    limits = {'.py': {'max_size_mb': 0.01, 'head_lines': 5, 'tail_lines': 5}}
+    cs.split_concatenated_scripts(1, str(root), output_dir=str(out), dedupe=True, excerpts=limits)
+    text = (out / 'concatenated_scripts_part1.txt').read_text(encoding='utf-8')
+    assert '[DUPLICATE' not in text
+    assert len(MARKER.findall(text)) == 2
@@ -0,0 +1,64 @@
+import fnmatch
+import os
+import random
+import re
+
+import pytest
+
+import concatenate_scripts as cs
+
+STEMS = ['app', 'test_app', 'debug_log', 'pipeline_run', 'graph_view', 'jquery', 'react-dom',
+         'lib_v1.2', 'core-2.10.3', 'data_20240101', 'run_1700000000000', 'notes', 'create_nodes']
+SUFFIXES = ['.py', '.js', '.min.js', '.bundle.css', '.map', '.json', '_results.json', '_output.json',
+            '_data.json', '.log', '_pipeline.log', '.parquet', '.csv', '.bak', '~', '.py,cover', '.md']
+DIRS = ['', 'src', 'vendor', 'src/static', 'output', 'reports', 'docs', 'pkg/modules']
+
+
+def reference_verdict(file_path, filename):
+    """The per-file loops the compiled rules replaced, over the same configuration."""
+    name = filename.lower()
+    if filename in cs.EXCLUDED_FILES:
+        return 'excluded file'
+    if any(fnmatch.fnmatch(name, pattern.lower()) for pattern in cs.EXCLUDED_FILE_PATTERNS):
+        return 'excluded pattern'
+    parts = file_path.lower().split(os.sep)
+    if (any(lib in name for lib in cs.LIBRARY_NAME_PATTERNS)
+            or any(re.search(pattern, name) for pattern in cs.LIBRARY_VERSION_PATTERNS)
+            or any(name.endswith(ext) for ext in cs.LIBRARY_EXTENSIONS)
+            or any(part in parts for part in cs.LIBRARY_PATH_INDICATORS)):
+        return 'library'
+    if name.endswith('.json') and (
+            any(part in parts for part in cs.OUTPUT_JSON_PATH_INDICATORS)
+            or any(name.endswith(suffix) for suffix in cs.OUTPUT_JSON_SUFFIXES)
+            or any(re.search(pattern, name) for pattern in cs.OUTPUT_JSON_TIMESTAMP_PATTERNS)):
+        return 'output json'
+    return None
+
+
+def test_compiled_rules_agree_with_the_per_file_loops():
+    rng = random.Random(3)
+    rules = cs.get_default_exclusion_rules()
+    names = [stem + suffix for stem in STEMS for suffix in SUFFIXES] + list(cs.EXCLUDED_FILES)[:20]
+    for filename in names:
+        file_path = os.path.join(os.sep, 'repo', *rng.choice(DIRS).split('/'), filename)
+        matched = cs.match_exclusion_rule(file_path, filename, rules)
+        category = matched[0] if matched is not None else None
+        assert category == reference_verdict(file_path, filename), file_path
+
+
+@pytest.mark.parametrize('filename, rule', [
+    ('test_app.py', 'test_*.py'),
+    ('yarn-error.log.1', 'yarn-error.log*'),
+    ('nodes.py,cover', '*.py,cover'),
+    ('App.PYC', '*.pyc'),
+])
+def test_the_matching_pattern_is_reported(filename, rule):
+    assert cs.match_excluded_pattern_rule(filename) == rule
+
+
+def test_custom_lists_are_compiled_into_the_rules():
+    rules = cs.compile_exclusion_rules(file_patterns=['*.gen.py', 'scratch_*'], library_names=['left-pad'])
+    assert cs.match_exclusion_rule('/repo/a.gen.py', 'a.gen.py', rules) == ('excluded pattern', '*.gen.py')
+    assert cs.match_exclusion_rule('/repo/scratch_1.py', 'scratch_1.py', rules) == ('excluded pattern', 'scratch_*')
+    assert cs.match_exclusion_rule('/repo/left-pad.js', 'left-pad.js', rules) == ('library', 'left-pad')
+    assert cs.match_exclusion_rule('/repo/test_app.py', 'test_app.py', rules) is None
@@ -0,0 +1,46 @@
+import builtins
+import io
+
+import pytest
+
+import concatenate_scripts as cs
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'one',
+    b'one\n',
+    b'one\ntwo',
+    b'a\r\nb\r\nc',
+    b'a\rb\rc\r',
+    b'a\r\n\r\nb\n\rc',
+    b'\n\n\n',
+])
+def test_count_lines_matches_text_mode_iteration(data):
+    expected = len(io.StringIO(data.decode(), newline=None).readlines())
+    assert cs.count_lines(data) == expected
+
+
+def test_each_file_is_opened_once(project, monkeypatch):
+    opened = []
+
+    def counting_open(file, *args, **kwargs):
+        opened.append(str(file))
+        return builtins.open(file, *args, **kwargs)
+
+    monkeypatch.setattr(cs, 'open', counting_open, raising=False)
+    file_blocks, processed, _ = cs.collect_file_contents(str(project))
+    assert processed == 30
+    bundled = sorted(str(project / block['path']) for block in file_blocks)
+    # Other opens are the git lookup for the root's exclude file
+    assert sorted(path for path in opened if path.endswith('.py')) == bundled
+
+
+def test_line_limit_is_decided_from_the_content_read(tmp_path):
+    (tmp_path / 'at_limit.py').write_text('x = 1\n' * cs.MAX_FILE_LINES)
+    (tmp_path / 'over_limit.py').write_text('x = 1\n' * (cs.MAX_FILE_LINES + 1))
+    (tmp_path / 'over_limit_crlf.py').write_bytes(b'x = 1\r\n' * (cs.MAX_FILE_LINES + 1))
+    file_blocks, processed, skipped = cs.collect_file_contents(str(tmp_path))
+    assert [block['path'] for block in file_blocks] == ['at_limit.py']
+    assert file_blocks[0]['content'].count('x = 1\n') == cs.MAX_FILE_LINES
+    assert '\r' not in file_blocks[0]['content']
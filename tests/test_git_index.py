@@ -0,0 +1,171 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+import concatenate_scripts as cs
+
+pytestmark = pytest.mark.skipif(shutil.which('git') is None, reason='git is not installed')
+
+GIT_ENV = dict(os.environ, GIT_CONFIG_GLOBAL=os.devnull, GIT_CONFIG_NOSYSTEM='1')
+
+# Long shared prefixes, so version 4 actually compresses the paths
+FILES = {
+    'README.md': '# demo\n',
+    'run.sh': '#!/bin/sh\necho hi\n',
+    'src/app/main.py': 'print(1)\n',
+    'src/app/models/user.py': 'class User: pass\n',
+    'src/app/models/user_profile.py': 'class Profile: pass\n',
+    'src/app/models/user_settings.py': 'class Settings: pass\n',
+    'src/lib/util.py': 'x = 2\n',
+    'unicode/café.txt': 'café\n',
+}
+
+
+def git(root, *args):
+    return subprocess.run(['git', *args], cwd=root, check=True, capture_output=True, env=GIT_ENV).stdout
+
+
+def make_repo(root, object_format=None):
+    init = ['init', '-q'] + ([f'--object-format={object_format}'] if object_format else [])
+    git(root, *init)
+    for rel_path, text in FILES.items():
+        path = root / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text, encoding='utf-8')
+    os.chmod(root / 'run.sh', 0o755)
+    git(root, 'add', '.')
+    return root
+
+
+def index_path(root):
+    return str(root / '.git' / 'index')
+
+
+def index_version(root):
+    with open(index_path(root), 'rb') as f:
+        return int.from_bytes(f.read(8)[4:], 'big')
+
+
+def ls_files_stage(root):
+    """(path, mode) for each stage-0 entry, as git itself lists them."""
+    entries = []
+    for record in git(root, 'ls-files', '--stage', '-z').split(b'\0'):
+        if record:
+            info, _, path = record.partition(b'\t')
+            mode, _, stage = info.decode().split(' ')
+            if stage == '0':
+                entries.append((path.decode('utf-8'), int(mode, 8)))
+    return entries
+
+
+@pytest.mark.parametrize('version', [2, 3, 4])
+def test_parse_index_versions(tmp_path, version):
+    root = make_repo(tmp_path)
+    if version == 3:
+        # git only keeps version 3 while an entry has extended flags
+        git(root, 'update-index', '--skip-worktree', 'README.md')
+    git(root, 'update-index', '--index-version', str(version))
+    assert index_version(root) == version
+
+    entries = cs.parse_git_index(index_path(root))
+    assert [(path, mode) for path, mode, _, _ in entries] == ls_files_stage(root)
+    for path, mode, size, mtime in entries:
+        st = os.stat(root / path)
+        assert size == st.st_size
+        assert mtime == pytest.approx(st.st_mtime, abs=1e-6)
+    modes = {path: mode for path, mode, _, _ in entries}
+    assert modes['run.sh'] == 0o100755
+    assert modes['README.md'] == 0o100644
+
+
+@pytest.mark.parametrize('version', [3, 4])
+def test_extended_flags(tmp_path, version):
+    root = make_repo(tmp_path)
+    (root / 'src' / 'app' / 'later.py').write_text('y = 3\n')
+    # Intent-to-add and skip-worktree are stored in the extended flags word
+    git(root, 'add', '--intent-to-add', 'src/app/later.py')
+    git(root, 'update-index', '--skip-worktree', 'src/lib/util.py')
+    git(root, 'update-index', '--index-version', str(version))
+    assert index_version(root) == version
+
+    entries = cs.parse_git_index(index_path(root))
+    paths = [path for path, _, _, _ in entries]
+    assert paths == [path for path, _ in ls_files_stage(root)]
+    assert 'src/app/later.py' in paths
+    assert 'src/lib/util.py' in paths
+
+
+@pytest.mark.parametrize('version', [2, 4])
+def test_unmerged_entries_are_skipped(tmp_path, version):
+    root = make_repo(tmp_path)
+    blob = git(root, 'hash-object', '-w', 'README.md').decode().strip()
+    git(root, 'update-index', '--index-version', str(version))
+    # Replace a path with three conflict stages
+    git(root, 'update-index', '--force-remove', 'src/lib/util.py')
+    info = ''.join(f'100644 {blob} {stage}\tsrc/lib/util.py\n' for stage in (1, 2, 3))
+    subprocess.run(['git', 'update-index', '--index-info'], cwd=root, check=True,
+                   input=info.encode(), env=GIT_ENV)
+
+    paths = [path for path, _, _, _ in cs.parse_git_index(index_path(root))]
+    assert 'src/lib/util.py' not in paths
+    assert paths == [path for path, _ in ls_files_stage(root)]
+
+
+def test_sha256_repository(tmp_path):
+    try:
+        root = make_repo(tmp_path, object_format='sha256')
+    except subprocess.CalledProcessError:
+        pytest.skip('git does not support SHA-256 repositories')
+    git_dir = cs.find_git_dir(str(root))
+    assert cs.git_hash_size(git_dir) == 32
+    entries = cs.parse_git_index(index_path(root), hash_size=32)
+    assert [(path, mode) for path, mode, _, _ in entries] == ls_files_stage(root)
+
+
+def test_rejects_files_that_are_not_indexes(tmp_path):
+    path = tmp_path / 'index'
+    path.write_bytes(b'not an index at all')
+    with pytest.raises(ValueError):
+        cs.parse_git_index(str(path))
+
+
+def test_split_index_falls_back_to_ls_files(tmp_path):
+    root = make_repo(tmp_path)
+    git(root, 'update-index', '--split-index')
+    with pytest.raises(ValueError):
+        cs.parse_git_index(index_path(root))
+
+    entries = cs.list_git_files(str(root))
+    assert [(path, mode) for path, mode, _, _ in entries] == ls_files_stage(root)
+    # git ls-files has no cached stat information
+    assert all(size is None and mtime is None for _, _, size, mtime in entries)
+
+
+def test_subdirectory_uses_ls_files(tmp_path):
+    root = make_repo(tmp_path)
+    entries = cs.list_git_files(str(root / 'src' / 'app'))
+    assert [path for path, _, _, _ in entries] == [
+        'main.py', 'models/user.py', 'models/user_profile.py', 'models/user_settings.py',
+    ]
+
+
+def test_unreadable_index_lists_nothing(tmp_path):
+    root = make_repo(tmp_path)
+    with open(index_path(root), 'r+b') as f:
+        f.seek(4)
+        f.write((99).to_bytes(4, 'big'))
+    with pytest.raises(ValueError):
+        cs.parse_git_index(index_path(root))
+    # git cannot read the damaged index either
+    assert cs.list_git_files(str(root)) is None
+
+
+def test_fresh_repository_has_no_files(tmp_path):
+    git(tmp_path, 'init', '-q')
+    assert cs.list_git_files(str(tmp_path)) == []
+
+
+def test_outside_a_checkout(tmp_path):
+    assert cs.list_git_files(str(tmp_path)) is None
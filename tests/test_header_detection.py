@@ -0,0 +1,64 @@
+import re
+
+import pytest
+
+import concatenate_scripts as cs
+
+
+def reference_check(content, relative_path):
+    """The original whole-file detection, for content whose headers all sit near the top."""
+    clean_content = content
+    for regex in cs.HEADER_STRIP_REGEXES:
+        clean_content = regex.sub('', clean_content)
+    first_block = '\n'.join(content.split('\n')[:10])
+    return re.search(re.escape(relative_path), first_block) is not None, clean_content
+
+
+BODY = 'def f():\n    return 1\n' * 400
+
+
+@pytest.mark.parametrize('content', [
+    '# File: pkg/mod.py\n\n' + BODY,
+    '// File: pkg/mod.py\n' + BODY,
+    '/*\nFile: pkg/mod.py\n*/\n' + BODY,
+    '<!-- File: pkg/mod.py -->\n' + BODY,
+    '-- File: pkg/mod.py\n' + BODY,
+    '#' * 80 + '\n# File: pkg/mod.py\n' + '#' * 80 + '\n\n' + BODY,
+    '# File: other.py\n# File: pkg/mod.py\n' + BODY,
+    BODY,
+])
+def test_matches_the_whole_file_scan_for_headers_at_the_top(content):
+    assert cs.check_for_existing_header(content, 'pkg/mod.py') == reference_check(content, 'pkg/mod.py')
+
+
+def test_header_like_line_past_the_prefix_is_kept():
+    content = BODY + '# File: notes.py\n' + 'x = 1\n'
+    assert len(BODY) > cs.HEADER_SCAN_CHARS
+    has_header, clean_content = cs.check_for_existing_header(content, 'pkg/mod.py')
+    assert not has_header
+    assert clean_content == content
+
+
+def test_header_ending_at_the_limit_is_stripped_with_its_blank_lines():
+    padding = 'x' * (cs.HEADER_SCAN_CHARS - 10)
+    content = f'# File: {padding}\n\n\n' + BODY
+    assert cs.check_for_existing_header(content, 'pkg/mod.py')[1] == BODY
+
+
+def test_path_is_detected_only_in_the_first_lines():
+    top = '\n' * (cs.HEADER_SCAN_LINES - 1) + 'pkg/mod.py\n' + BODY
+    deep = '\n' * cs.HEADER_SCAN_LINES + 'pkg/mod.py\n' + BODY
+    assert cs.check_for_existing_header(top, 'pkg/mod.py')[0]
+    assert not cs.check_for_existing_header(deep, 'pkg/mod.py')[0]
+
+
+@pytest.mark.parametrize('content', ['', 'one', 'one\n', 'a\nb\nc', '\n' * 30 + 'tail'])
+def test_leading_lines_matches_split(content):
+    assert cs.leading_lines(content) == '\n'.join(content.split('\n')[:cs.HEADER_SCAN_LINES])
+
+
+def test_prepend_never_stacks_headers():
+    header = cs.create_file_header('pkg/mod.py', 'pkg/mod.py')
+    result = cs.prepend_header_if_needed('# File: old/name.py\n\n' + BODY, header, 'pkg/mod.py')
+    assert result == f'{header}\n\n{BODY}'
+    assert cs.prepend_header_if_needed(result, header, 'pkg/mod.py').count('File:') <= 1
@@ -0,0 +1,110 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+import concatenate_scripts as cs
+
+pytestmark = pytest.mark.skipif(shutil.which('git') is None, reason='git is not installed')
+
+
+def make_tree(root, files, ignores):
+    for rel_path in files:
+        path = root / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text('x = 1\n')
+    for rel_dir, lines in ignores.items():
+        (root / rel_dir).mkdir(parents=True, exist_ok=True)
+        (root / rel_dir / '.gitignore').write_text('\n'.join(lines) + '\n')
+
+
+def git_included(root):
+    """The untracked files git does not ignore, as '/'-separated paths."""
+    env = dict(os.environ, GIT_CONFIG_GLOBAL=os.devnull, GIT_CONFIG_NOSYSTEM='1')
+    subprocess.run(['git', 'init', '-q', str(root)], check=True, env=env)
+    result = subprocess.run(['git', 'ls-files', '--others', '--exclude-standard'],
+                            cwd=root, check=True, capture_output=True, text=True, env=env)
+    return {line for line in result.stdout.splitlines() if not line.endswith('.gitignore')}
+
+
+def scanned_included(root):
+    # No directory exclusions, so only the ignore files decide
+    rules = cs.compile_exclusion_rules(excluded_dirs=['.git'], excluded_paths=[])
+    tree = cs.scan_directory_tree(str(root), rules=rules)
+    return {rel_path.replace(os.sep, '/')
+            for node, _, rel_path in cs.iter_tree_files(tree)
+            if node['excluded'] is None and node['name'] != '.gitignore'}
+
+
+def assert_matches_git(tmp_path, files, ignores):
+    make_tree(tmp_path, files, ignores)
+    expected = git_included(tmp_path)
+    assert scanned_included(tmp_path) == expected
+    return expected
+
+
+def test_negation_reincludes_a_file(tmp_path):
+    included = assert_matches_git(tmp_path, [
+        'a.log', 'keep.log', 'src/b.log', 'src/keep.log', 'src/main.py',
+    ], {'': ['*.log', '!keep.log']})
+    assert included == {'keep.log', 'src/keep.log', 'src/main.py'}
+
+
+def test_later_rule_wins(tmp_path):
+    assert_matches_git(tmp_path, ['one.txt', 'two.txt', 'three.txt'],
+                       {'': ['!one.txt', '*.txt', '!two.txt']})
+
+
+def test_anchored_patterns(tmp_path):
+    included = assert_matches_git(tmp_path, [
+        'notes.txt', 'src/notes.txt', 'src/gen/out.py', 'gen/out.py', 'lib/docs/x.py', 'docs/x.py',
+    ], {'': ['/notes.txt', 'src/gen', 'lib/docs/'], 'src': ['/gen/']})
+    assert 'src/notes.txt' in included
+    assert 'docs/x.py' in included
+
+
+def test_nested_ignore_file_is_relative_to_its_directory(tmp_path):
+    assert_matches_git(tmp_path, [
+        'pkg/build.py', 'pkg/sub/build.py', 'build.py', 'pkg/sub/keep.py',
+    ], {'pkg': ['/build.py', 'sub/*.py', '!sub/keep.py']})
+
+
+def test_double_star(tmp_path):
+    assert_matches_git(tmp_path, [
+        'a/tmp/x.py', 'a/b/tmp/y.py', 'tmp/z.py', 'a/b/c.py', 'logs/a/b/c.txt', 'logs/d.py',
+    ], {'': ['**/tmp/', 'logs/**/*.txt']})
+
+
+def test_directory_only_patterns(tmp_path):
+    included = assert_matches_git(tmp_path, ['cache/data.py', 'src/cache', 'src/main.py'],
+                                  {'': ['cache/']})
+    assert 'src/cache' in included
+
+
+def test_negation_cannot_reinclude_under_an_ignored_directory(tmp_path):
+    # git does not descend into an excluded directory, so '!' rules below it have no effect
+    included = assert_matches_git(tmp_path, [
+        'vendor/lib.py', 'vendor/keep.py', 'vendor/deep/keep.py', 'app.py',
+    ], {'': ['vendor/', '!vendor/keep.py', '!keep.py'], 'vendor': ['!*.py']})
+    assert included == {'app.py'}
+
+
+def test_negated_directory_contents_need_the_directory_unignored(tmp_path):
+    assert_matches_git(tmp_path, [
+        'out/a.py', 'out/keep/b.py', 'out/keep/c.txt',
+    ], {'': ['out/*', '!out/keep/', 'out/keep/*.txt']})
+
+
+def test_character_classes_and_escapes(tmp_path):
+    assert_matches_git(tmp_path, [
+        'a1.py', 'b2.py', 'c3.py', '#hash.py', 'q?.py', 'space .py',
+    ], {'': ['[ab][0-9].py', r'\#hash.py', r'q\?.py', r'space\ .py']})
+
+
+def test_match_ignore_rules_returns_the_deciding_rule():
+    level = cs.compile_ignore_rules(['*.log', '!keep.log', 'build/'])
+    assert cs.match_ignore_rules([level], 'x.log', False)['pattern'] == '*.log'
+    assert cs.match_ignore_rules([level], 'keep.log', False)['negate']
+    assert cs.match_ignore_rules([level], 'build', True)['pattern'] == 'build/'
+    assert cs.match_ignore_rules([level], 'build', False) is None
@@ -0,0 +1,61 @@
+import os
+
+import concatenate_scripts as cs
+from conftest import part_names, read_blocks
+
+
+def part_times(out):
+    return {name: os.stat(out / name).st_mtime_ns for name in part_names(out)}
+
+
+def run(project, out, **options):
+    return cs.split_concatenated_scripts(3, str(project), output_dir=str(out), incremental=True, **options)
+
+
+def test_noop_rerun_reads_and_writes_nothing(project, tmp_path):
+    out = tmp_path / 'out'
+    first = run(project, out)
+    assert first['files']['read'] == 30
+    times = part_times(out)
+    blocks = read_blocks(out)
+    second = run(project, out)
+    assert second['files']['read'] == 0
+    assert second['files']['reused'] == 30
+    assert second['bytes_written'] == 0
+    assert part_times(out) == times
+    assert read_blocks(out) == blocks
+
+
+def test_changed_file_rewrites_only_its_part(project, tmp_path):
+    out = tmp_path / 'out'
+    run(project, out)
+    times = part_times(out)
+    # Same size, so the directory structure in part 1 stays the same
+    changed = project / 'pkg1' / 'mod4.py'
+    changed.write_text(changed.read_text().replace('x', 'y'))
+    stat = changed.stat()
+    os.utime(changed, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    metrics = run(project, out)
+    assert metrics['files']['read'] == 1
+    assert 'yyyy' in read_blocks(out)['pkg1/mod4.py']
+    part = next(name for name in part_names(out) if 'yyyy' in (out / name).read_text(encoding='utf-8'))
+    new_times = part_times(out)
+    assert [name for name in times if new_times[name] != times[name]] == [part]
+
+
+def test_added_and_removed_files_match_a_fresh_run(project, tmp_path):
+    out = tmp_path / 'out'
+    run(project, out)
+    (project / 'pkg0' / 'mod0.py').unlink()
+    (project / 'pkg2' / 'new.py').write_text('NEW = True\n')
+    metrics = run(project, out)
+    assert metrics['files']['read'] == 1
+    cs.split_concatenated_scripts(3, str(project), output_dir=str(tmp_path / 'fresh'))
+    assert read_blocks(out) == read_blocks(tmp_path / 'fresh')
+
+
+def test_changed_settings_invalidate_the_manifest(project, tmp_path):
+    out = tmp_path / 'out'
+    run(project, out)
+    metrics = run(project, out, minify=True)
+    assert metrics['files']['read'] == 30
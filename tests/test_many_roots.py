@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+import concatenate_scripts as cs
+from conftest import part_names, read_blocks
+
+
+@pytest.fixture
+def roots(project):
+    """The project's three packages as separate roots."""
+    return [project / f'pkg{i}' for i in range(3)]
+
+
+def test_each_root_gets_its_own_parts(roots, tmp_path):
+    report = cs.split_many_roots([str(root) for root in roots], processes=2, output_dir=str(tmp_path / 'out'),
+                                 num_parts=2)
+    assert report['processes'] == 2
+    assert report['failed'] == 0
+    for root, entry in zip(roots, report['roots']):
+        out = tmp_path / 'out' / root.name
+        assert entry['output_dir'] == str(out)
+        assert part_names(out) == ['concatenated_scripts_part1.txt', 'concatenated_scripts_part2.txt']
+        assert sorted(read_blocks(out)) == sorted(path.name for path in root.iterdir())
+        assert entry['metrics']['files']['included'] == 10
+
+
+def test_pool_matches_bundling_one_by_one(roots, tmp_path):
+    paths = [str(root) for root in roots]
+    pooled = cs.split_many_roots(paths, processes=3, output_dir=str(tmp_path / 'pool'))
+    serial = cs.split_many_roots(paths, processes=1, output_dir=str(tmp_path / 'serial'))
+    for root in roots:
+        assert read_blocks(tmp_path / 'pool' / root.name) == read_blocks(tmp_path / 'serial' / root.name)
+    assert pooled['files'] == serial['files']
+    assert pooled['bytes_written'] == serial['bytes_written']
+
+
+def test_counts_are_summed_over_the_roots(roots, tmp_path):
+    report = cs.split_many_roots([str(root) for root in roots], processes=2, output_dir=str(tmp_path / 'out'),
+                                 report_path=str(tmp_path / 'report.json'))
+    assert report['files']['included'] == 30
+    assert report['bytes_written'] == sum(entry['metrics']['bytes_written'] for entry in report['roots'])
+    assert report['bytes_read'] == sum(entry['metrics']['bytes_read'] for entry in report['roots'])
+    assert json.loads((tmp_path / 'report.json').read_text())['files'] == report['files']
+
+
+def test_failing_root_does_not_stop_the_others(roots, tmp_path):
+    # A file where pkg1's output directory would go makes that root fail
+    (tmp_path / 'out').mkdir()
+    (tmp_path / 'out' / 'pkg1').write_text('in the way')
+    report = cs.split_many_roots([str(root) for root in roots], processes=2, output_dir=str(tmp_path / 'out'))
+    assert report['failed'] == 1
+    failed = report['roots'][1]
+    assert failed['root'] == str(roots[1])
+    assert failed['metrics'] is None and failed['error']
+    assert report['files']['included'] == 20
+    assert len(read_blocks(tmp_path / 'out' / 'pkg0')) == 10
+    assert len(read_blocks(tmp_path / 'out' / 'pkg2')) == 10
@@ -0,0 +1,192 @@
+import json
+import shutil
+import subprocess
+
+import pytest
+
+import concatenate_scripts as cs
+
+
+# --- JavaScript ---
+
+def test_js_strips_comments_and_indentation():
+    source = 'function f() {\n    // comment\n    return  1;   /* block */\n}\n\n\n'
+    assert cs.minify_js(source) == 'function f() {\nreturn 1;\n}'
+
+
+def test_js_keeps_line_breaks_for_semicolon_insertion():
+    assert cs.minify_js('let a = 1\nlet b = a\n(b)') == 'let a = 1\nlet b = a\n(b)'
+
+
+def test_js_block_comment_still_separates_tokens():
+    assert cs.minify_js('return/* x */value') == 'return value'
+    assert cs.minify_js('a/*\n*/b') == 'a\nb'
+
+
+@pytest.mark.parametrize('literal', [
+    '"a  //  not a comment"',
+    "'single  /* not */ quoted'",
+    r'"escaped \" quote  // still string"',
+])
+def test_js_string_literals_are_unchanged(literal):
+    assert cs.minify_js(f'x  =  {literal};  // tail') == f'x = {literal};'
+
+
+def test_js_template_literals_are_unchanged():
+    source = 'let t = `a   ${ {b: 1}.b  }  /* no */\n    // kept`;'
+    assert cs.minify_js(source) == source
+
+
+def test_js_nested_templates():
+    source = 'let t = `outer ${ `inner  ${ x  }  ` }   done`;  // gone'
+    assert cs.minify_js(source) == 'let t = `outer ${ `inner  ${ x  }  ` }   done`;'
+
+
+def test_js_template_substitution_with_strings_and_braces():
+    source = 'f(`${ "}" + \'`\' + {a: `}`}.a }   end`)'
+    assert cs.minify_js(source) == source
+
+
+@pytest.mark.parametrize('literal', [
+    r'/\/+  \/\/[/]x/g',
+    r'/[/*]  \d+/',
+    r'/a\/\/b/i',
+])
+def test_js_regex_literals_are_unchanged(literal):
+    assert cs.minify_js(f'let r = s.replace({literal},  "")') == f'let r = s.replace({literal}, "")'
+
+
+def test_js_regex_after_keyword():
+    assert cs.minify_js('return   /  a  /.test(s)') == 'return /  a  /.test(s)'
+
+
+def test_js_division_is_not_a_regex():
+    assert cs.minify_js('let d = x  /  2  /  y;') == 'let d = x / 2 / y;'
+    assert cs.minify_js('let d = (a) / b // half\n') == 'let d = (a) / b'
+
+
+def test_jsx_keeps_comments():
+    source = 'const el = <a href="//example.com">//  text</a>;'
+    assert cs.minify_jsx(source) == source
+
+
+@pytest.mark.skipif(shutil.which('node') is None, reason='node is not installed')
+def test_js_minified_program_behaves_the_same():
+    source = '''
+    // Exercises every kind of literal the minifier must leave alone
+    const s = "a  //  b";  /* c */
+    const t = `x  ${ {k: "}"}.k }  ${ `n  ${ 1 + 1 }` }  y`;
+    const r = "a//b///c".replace(/\\/+/g,   "-");
+    const d = 10  /  2  /  5;
+    function f(v) {
+        return   /^  \\d+$/.test(v)
+    }
+    let asi = 1
+    const out = [s, t, r, d, f("  12"), asi]
+    console.log(JSON.stringify(out))
+    '''
+    def run(code):
+        return subprocess.run(['node', '-e', code], check=True, capture_output=True, text=True).stdout
+    assert run(cs.minify_js(source)) == run(source)
+
+
+# --- CSS ---
+
+def test_css_collapses_whitespace_and_comments():
+    source = 'a  ,  b > c {\n    color : red ;   /* note */\n    margin: 0  auto;\n}\n'
+    assert cs.minify_css(source) == 'a,b>c{color : red;margin: 0 auto;}'
+
+
+def test_css_keeps_descendant_pseudo_class_space():
+    assert cs.minify_css('a  :hover { x: y }') == 'a :hover{x: y}'
+    assert cs.minify_css('a:hover { x: y }') == 'a:hover{x: y}'
+
+
+def test_css_strings_are_unchanged():
+    source = 'p::before { content: "  }  /* not a comment */ ;" ; }'
+    assert cs.minify_css(source) == 'p::before{content: "  }  /* not a comment */ ;";}'
+
+
+# --- JSON ---
+
+def test_json_removes_whitespace_only():
+    source = '{\n  "b": 1,\n  "a": [1.50, 2e3, true],\n  "c": "x  y"\n}\n'
+    assert cs.minify_json(source) == '{"b":1,"a":[1.50,2e3,true],"c":"x  y"}'
+
+
+def test_json_key_order_and_duplicates_are_preserved():
+    source = '{"z": 1, "a": {"y": 2, "b": 3}, "z": 4}'
+    minified = cs.minify_json(source)
+    assert minified == '{"z":1,"a":{"y":2,"b":3},"z":4}'
+    keys = json.loads(minified, object_pairs_hook=lambda items: [(key, value) for key, value in items])
+    assert keys == [('z', 1), ('a', [('y', 2), ('b', 3)]), ('z', 4)]
+
+
+def test_json_escaped_quotes_in_strings():
+    source = '{ "k\\"ey" : "va  \\"  lue" }'
+    assert cs.minify_json(source) == '{"k\\"ey":"va  \\"  lue"}'
+    assert json.loads(cs.minify_json(source)) == json.loads(source)
+
+
+def test_json_with_comments_is_left_alone():
+    source = '{\n  // tsconfig style\n  "a": 1\n}\n'
+    assert cs.minify_json(source) == source
+
+
+# --- HTML ---
+
+def test_html_collapses_whitespace_and_drops_comments():
+    source = '<div>\n  <p>a   b</p>  <!-- gone -->\n</div>\n'
+    assert cs.minify_html(source) == '<div>\n<p>a b</p>\n</div>'
+
+
+def test_html_keeps_conditional_comments():
+    source = '<!--[if IE]><p>old</p><![endif]-->'
+    assert cs.minify_html(source) == source
+
+
+@pytest.mark.parametrize('element', [
+    '<pre>  keep\n   this   </pre>',
+    '<textarea name="t">  a\n\n  b </textarea>',
+    '<script>if (a  <  b) {\n    x();  // c\n}</script>',
+    '<style>\n  p  >  a { color: red }\n</style>',
+    '<PRE class="x">  upper   case </PRE>',
+])
+def test_html_verbatim_elements(element):
+    assert cs.minify_html(f'<body>\n   {element}\n   </body>') == f'<body>\n{element}\n</body>'
+
+
+def test_html_attribute_values_are_unchanged():
+    source = '<a title="a  >  b"   href=\'x  y\'>link   text</a>'
+    assert cs.minify_html(source) == '<a title="a  >  b"   href=\'x  y\'>link text</a>'
+
+
+# --- Dispatch ---
+
+def test_minify_block_content_keeps_the_header():
+    header = '// File: app.js'
+    content = f'{header}\n\nlet  a = 1;   // x\n'
+    minified, saved = cs.minify_block_content(content, header, 'app.js')
+    assert minified == f'{header}\n\nlet a = 1;'
+    assert saved == len(content) - len(minified)
+
+
+def test_minify_block_content_leaves_python_alone():
+    content = 'def f():\n    return  1  # keep\n'
+    assert cs.minify_block_content(content, None, 'mod.py') == (content, 0)
+
+
+@pytest.mark.parametrize('source', [
+    'const el = <p>See https://example.com for docs</p>;\nfoo();',
+    'const App = () => (\n  <div className="app">\n    <a href="//cdn">x</a>\n  </div>\n);',
+    'function F() {\n  return <>// not a comment</>;\n}',
+])
+def test_minify_block_content_keeps_jsx_text_in_js_files(source):
+    minified, _ = cs.minify_block_content(source, None, 'Component.js')
+    assert minified == cs.minify_jsx(source)
+    assert '//' in minified
+
+
+def test_minify_block_content_strips_comments_in_plain_js_files():
+    source = 'if (a < b) {\n  run();  // why\n}'
+    assert cs.minify_block_content(source, None, 'util.js')[0] == 'if (a < b) {\nrun();\n}'
@@ -0,0 +1,44 @@
+import random
+import re
+import time
+
+import concatenate_scripts as cs
+from conftest import part_names
+
+GENERATED_LINE = re.compile(r'^# Generated: .*$', re.MULTILINE)
+
+
+def read_parts(out):
+    return [GENERATED_LINE.sub('', (out / name).read_text(encoding='utf-8')) for name in part_names(out)]
+
+
+def slow_reads(monkeypatch):
+    """Makes file reads finish in a random order, so a pool returns them out of order."""
+    rng = random.Random(7)
+    load_file_text = cs.load_file_text
+
+    def load(file_path, excerpt=None):
+        time.sleep(rng.random() / 500)
+        return load_file_text(file_path, excerpt)
+
+    monkeypatch.setattr(cs, 'load_file_text', load)
+
+
+def test_blocks_match_the_sequential_read(project, monkeypatch):
+    (project / 'blob.py').write_bytes(bytes(range(256)) * 4)
+    (project / 'long.py').write_text('x = 1\n' * (cs.MAX_FILE_LINES + 1))
+    sequential, processed, skipped = cs.collect_file_contents(str(project))
+    slow_reads(monkeypatch)
+    parallel, parallel_processed, parallel_skipped = cs.collect_file_contents(str(project), jobs=8)
+    assert (parallel_processed, parallel_skipped) == (processed, skipped)
+    assert [(block['path'], block['content']) for block in parallel] == \
+        [(block['path'], block['content']) for block in sequential]
+    assert not any(block['path'] in ('blob.py', 'long.py') for block in parallel)
+    assert all(block['read_time'] > 0 for block in parallel)
+
+
+def test_parts_are_byte_for_byte_the_same(project, tmp_path, monkeypatch):
+    cs.split_concatenated_scripts(3, str(project), output_dir=str(tmp_path / 'serial'))
+    slow_reads(monkeypatch)
+    cs.split_concatenated_scripts(3, str(project), output_dir=str(tmp_path / 'jobs'), jobs=8)
+    assert read_parts(tmp_path / 'jobs') == read_parts(tmp_path / 'serial')
@@ -0,0 +1,124 @@
+import json
+import os
+
+import pytest
+
+import concatenate_scripts as cs
+
+FILES = {
+    'a.py': 'print(1)\n',
+    'pkg/b.py': 'def f():\n    return 2\n',
+    'pkg/c.js': 'export const c = 3;\n',
+}
+
+
+@pytest.fixture
+def bundle_dirs(tmp_path):
+    root = tmp_path / 'proj'
+    for rel_path, text in FILES.items():
+        path = root / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text)
+    out = tmp_path / 'out'
+    cs.split_concatenated_scripts(num_parts=2, root_dir=str(root), output_dir=str(out))
+    return root, out
+
+
+def part_paths(out):
+    return sorted(out.glob('concatenated_scripts_part*'))
+
+
+def test_lookup_block_matches_the_part_contents(bundle_dirs):
+    _, out = bundle_dirs
+    index = cs.load_part_index(str(out / cs.INDEX_FILENAME))
+    bundle = cs.open_bundle(str(out))
+    try:
+        for part in index['parts']:
+            text = (out / part['file']).read_bytes()
+            for entry in part['files']:
+                block = cs.lookup_block(bundle, entry['path'])
+                assert block.encode('utf-8') == text[entry['offset']:entry['offset'] + entry['length']]
+                assert f"# File: {entry['path']}" in block
+        assert FILES['pkg/b.py'] in cs.lookup_block(bundle, 'pkg/b.py')
+    finally:
+        cs.close_bundle(bundle)
+
+
+def test_lookup_block_unknown_path(bundle_dirs):
+    _, out = bundle_dirs
+    bundle = cs.open_bundle(str(out))
+    try:
+        with pytest.raises(KeyError):
+            cs.lookup_block(bundle, 'missing.py')
+    finally:
+        cs.close_bundle(bundle)
+
+
+def test_lookup_block_rejects_a_stale_part(bundle_dirs):
+    _, out = bundle_dirs
+    bundle = cs.open_bundle(str(out))
+    try:
+        for path in part_paths(out):
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write('edited by hand\n')
+        with pytest.raises(ValueError, match='changed since it was indexed'):
+            cs.lookup_block(bundle, 'a.py')
+    finally:
+        cs.close_bundle(bundle)
+
+
+def test_save_and_load_part_index(tmp_path):
+    path = str(tmp_path / cs.INDEX_FILENAME)
+    index = {'version': cs.INDEX_VERSION, 'parts': [None, {'file': 'p2', 'files': []}]}
+    cs.save_part_index(path, index)
+    assert cs.load_part_index(path) == index
+    assert not os.path.exists(path + '.tmp')
+
+
+def test_load_part_index_ignores_bad_files(tmp_path):
+    path = tmp_path / cs.INDEX_FILENAME
+    assert cs.load_part_index(str(path)) is None
+    path.write_text('{not json')
+    assert cs.load_part_index(str(path)) is None
+    path.write_text(json.dumps({'version': cs.INDEX_VERSION + 1, 'parts': []}))
+    assert cs.load_part_index(str(path)) is None
+
+
+def test_update_part_index_keeps_parts_that_were_not_rewritten():
+    old = {'version': cs.INDEX_VERSION, 'parts': [{'file': 'p1'}, {'file': 'p2'}, {'file': 'p3'}]}
+    updated = cs.update_part_index(old, {2: {'file': 'new2'}}, {2}, 2)
+    assert updated['parts'] == [{'file': 'p1'}, {'file': 'new2'}]
+    assert cs.update_part_index(None, {}, {1}, 1)['parts'] == [None]
+
+
+def test_main_extract(bundle_dirs, capsys):
+    _, out = bundle_dirs
+    assert cs.main(['--output-dir', str(out), '--extract', 'pkg/b.py']) == 0
+    assert FILES['pkg/b.py'] in capsys.readouterr().out
+
+
+def test_main_extract_unknown_path(bundle_dirs, capsys):
+    _, out = bundle_dirs
+    assert cs.main(['--output-dir', str(out), '--extract', 'missing.py']) == 1
+    assert 'missing.py is not in the index' in capsys.readouterr().out
+
+
+def test_main_extract_stale_part(bundle_dirs, capsys):
+    _, out = bundle_dirs
+    for path in part_paths(out):
+        path.write_text('rewritten by hand\n')
+    assert cs.main(['--output-dir', str(out), '--extract', 'a.py']) == 1
+    assert 'changed since it was indexed' in capsys.readouterr().out
+
+
+def test_main_extract_missing_part(bundle_dirs, capsys):
+    _, out = bundle_dirs
+    for path in part_paths(out):
+        path.unlink()
+    assert cs.main(['--output-dir', str(out), '--extract', 'a.py']) == 1
+    assert 'Could not extract a.py' in capsys.readouterr().out
+
+
+def test_main_extract_without_index(tmp_path, capsys):
+    assert cs.main(['--output-dir', str(tmp_path), '--extract', 'a.py']) == 1
+    assert 'No usable index' in capsys.readouterr().out
@@ -0,0 +1,97 @@
+import json
+import threading
+import time
+
+import pytest
+
+import concatenate_scripts as cs
+from conftest import part_names, read_blocks
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+def test_pipeline_writes_the_same_blocks(project, tmp_path, compression):
+    sequential, pipelined = tmp_path / 'seq', tmp_path / 'pipe'
+    options = dict(root_dir=str(project), part_size=600, compression=compression)
+    cs.split_concatenated_scripts(output_dir=str(sequential), **options)
+    cs.split_concatenated_scripts(output_dir=str(pipelined), pipeline=True, jobs=3, **options)
+    assert part_names(pipelined) == part_names(sequential)
+    assert read_blocks(pipelined) == read_blocks(sequential)
+
+
+def test_pipeline_parts_end_with_the_index(project, tmp_path):
+    out = tmp_path / 'out'
+    cs.split_concatenated_scripts(root_dir=str(project), output_dir=str(out), part_size=600, pipeline=True)
+    names = part_names(out)
+    assert len(names) > 2
+    texts = [''.join(cs.iter_part_text(str(out / name))) for name in names]
+    for number, text in enumerate(texts, 1):
+        assert text.startswith(f'# Concatenated Project Code - Part {number}\n')
+    assert all('# File Index' not in text for text in texts[:-1])
+    trailer = texts[-1][texts[-1].index('# File Index'):]
+    assert f'## Part {len(names)} (' in trailer
+    assert 'pkg0' in trailer[trailer.index('=' * 80):]  # The directory structure comes last
+
+    # A later incremental run does not mistake the pipeline's parts for its own
+    manifest = json.loads((out / cs.MANIFEST_FILENAME).read_text())
+    assert all(part['digest'] is None for part in manifest['parts'])
+    cs.split_concatenated_scripts(root_dir=str(project), output_dir=str(out), part_size=600, incremental=True)
+    text = (out / names[0]).read_text()
+    assert text.startswith(f'# Concatenated Project Code - Part 1 of {len(names)}\n')
+
+
+@pytest.mark.parametrize('options', [
+    {'num_parts': 2},
+    {'part_size': 2000},
+    {'part_size': 2000, 'pipeline': True},
+    {'token_budget': 1500},
+])
+def test_stale_parts_are_removed(project, tmp_path, options):
+    out = tmp_path / 'out'
+    cs.split_concatenated_scripts(root_dir=str(project), output_dir=str(out), num_parts=8)
+    (out / 'concatenated_scripts_part1.txt.gz').write_bytes(b'left over from a compressed run')
+    assert len(part_names(out)) == 9
+    cs.split_concatenated_scripts(root_dir=str(project), output_dir=str(out), **options)
+    index = json.loads((out / cs.INDEX_FILENAME).read_text())
+    assert part_names(out) == [part['file'] for part in index['parts']]
+    assert len(read_blocks(out)) == 30
+
+
+def test_remove_stale_parts_keeps_other_files(tmp_path):
+    for name in ['concatenated_scripts_part1.txt', 'concatenated_scripts_part2.txt',
+                 'concatenated_scripts_part2.txt.gz', 'concatenated_scripts_part3.txt.xz',
+                 'concatenated_scripts_part_notes.txt', 'notes.txt']:
+        (tmp_path / name).write_text('x')
+    cs.remove_stale_parts(str(tmp_path), 2)
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        'concatenated_scripts_part1.txt', 'concatenated_scripts_part2.txt',
+        'concatenated_scripts_part_notes.txt', 'notes.txt',
+    ]
+
+
+def test_walk_stops_when_the_writer_fails(tmp_path, monkeypatch):
+    root = tmp_path / 'big'
+    for d in range(200):
+        directory = root / f'd{d:03d}'
+        directory.mkdir(parents=True)
+        for f in range(10):
+            (directory / f'm{f}.py').write_text('x = 1\n')
+    scanned = []
+    scan_directory = cs._scan_directory
+
+    def counting_scan(node, *args, **kwargs):
+        scanned.append(node['rel_path'])
+        return scan_directory(node, *args, **kwargs)
+
+    def failing_encode(text):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(cs, '_scan_directory', counting_scan)
+    monkeypatch.setattr(cs, 'encode_part_text', failing_encode)
+    with pytest.raises(OSError, match='disk full'):
+        cs.run_pipeline(str(root), str(tmp_path / 'out'), 600)
+    # Every stage thread ends, and the walk stops well short of the 201 directories
+    deadline = time.monotonic() + 5
+    while any(thread.name.startswith('concatenate-') for thread in threading.enumerate()):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert len(scanned) < 150
@@ -0,0 +1,91 @@
+import itertools
+import os
+import random
+
+import concatenate_scripts as cs
+from conftest import part_names, read_blocks
+
+DAY = 86400
+
+
+def block(path, size, mtime=0):
+    return {'path': path, 'size': size, 'mtime': mtime}
+
+
+def best_total(blocks, budget):
+    """The best total score within the budget, by trying every subset."""
+    best = 0.0
+    for count in range(len(blocks) + 1):
+        for subset in itertools.combinations(blocks, count):
+            if sum(b['size'] for b in subset) <= budget:
+                best = max(best, sum(b['priority'] for b in subset))
+    return best
+
+
+def test_selection_fits_and_keeps_collection_order():
+    rng = random.Random(3)
+    blocks = [block(f'd{i % 4}/f{i}.py', rng.randrange(50, 500), rng.randrange(100 * DAY)) for i in range(200)]
+    selected, over_budget = cs.select_files_by_priority(blocks, 5000)
+    assert sum(b['size'] for b in selected) <= 5000
+    assert over_budget
+    assert sorted(selected + over_budget, key=blocks.index) == blocks
+    assert [b['path'] for b in selected] == [b['path'] for b in blocks if b in selected]
+
+
+def test_greedy_is_at_least_half_the_best_total():
+    rng = random.Random(5)
+    for _ in range(30):
+        blocks = [block(f'f{i}{rng.choice([".py", ".md", ".json"])}', rng.randrange(1, 100), rng.randrange(60 * DAY))
+                  for i in range(10)]
+        budget = rng.randrange(50, 300)
+        selected, _ = cs.select_files_by_priority(blocks, budget)
+        assert sum(b['priority'] for b in selected) >= best_total(blocks, budget) / 2
+
+
+def test_essential_docs_and_recent_files_come_first():
+    blocks = [block('notes.py', 100, 0), block('README.md', 100, 0), block('old.py', 100, 0),
+              block('new.py', 100, 90 * DAY)]
+    selected, over_budget = cs.select_files_by_priority(blocks, 200)
+    assert [b['path'] for b in selected] == ['README.md', 'new.py']
+    assert blocks[1]['priority'] > blocks[3]['priority'] > blocks[0]['priority']
+
+
+def test_commit_times_override_mtimes():
+    blocks = [block('a.py', 100, 90 * DAY), block('b.py', 100, 0)]
+    selected, _ = cs.select_files_by_priority(blocks, 100, commit_times={'b.py': 100 * DAY})
+    assert [b['path'] for b in selected] == ['b.py']
+
+
+def test_deep_files_lose_to_shallow_ones():
+    blocks = [block(os.path.join('a', 'b', 'c', 'deep.py'), 100), block('top.py', 100)]
+    selected, _ = cs.select_files_by_priority(blocks, 100)
+    assert [b['path'] for b in selected] == ['top.py']
+
+
+def test_single_large_file_wins_when_it_scores_more():
+    # Small files have the better ratio, but the one large essential doc is worth more than they are
+    blocks = [block('a.json', 10), block('README.md', 1000)]
+    selected, over_budget = cs.select_files_by_priority(blocks, 1000)
+    assert [b['path'] for b in selected] == ['README.md']
+    assert [b['path'] for b in over_budget] == ['a.json']
+
+
+def test_everything_is_kept_when_it_fits():
+    blocks = [block('a.py', 10), block('b.py', 20)]
+    assert cs.select_files_by_priority(blocks, 30) == (blocks, [])
+
+
+def test_bundle_lists_what_was_left_out(project, tmp_path):
+    (project / 'README.md').write_text('# Project\n')
+    out = tmp_path / 'out'
+    metrics = cs.split_concatenated_scripts(2, str(project), output_dir=str(out), budget=2000)
+    blocks = read_blocks(out)
+    assert 'README.md' in blocks
+    assert 0 < len(blocks) < 31
+    assert sum((project / path).stat().st_size for path in blocks) <= 2000
+    assert metrics['files']['over_budget'] == 31 - len(blocks)
+    assert metrics['files']['included'] == len(blocks)
+    first = (out / part_names(out)[0]).read_text(encoding='utf-8')
+    assert f"## Excluded for budget ({31 - len(blocks)} files):" in first
+    left_out = {line.split(' (')[0][4:] for line in first.splitlines() if line.endswith(' characters)')}
+    assert left_out == {f'pkg{i % 3}/mod{i}.py' for i in range(30)} - set(blocks)
@@ -0,0 +1,44 @@
+import tracemalloc
+
+import concatenate_scripts as cs
+from conftest import read_blocks
+
+
+def make_large_tree(root, files=40, lines=800):
+    for i in range(files):
+        path = root / f'pkg{i % 4}' / f'mod{i}.py'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(f'# {i:05d} {"y" * 60}\n' * lines)
+    return sum(path.stat().st_size for path in root.rglob('*.py'))
+
+
+def peak_memory(**options):
+    tracemalloc.start()
+    try:
+        cs.split_concatenated_scripts(3, **options)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_stream_writes_the_same_parts(project, tmp_path):
+    cs.split_concatenated_scripts(3, str(project), output_dir=str(tmp_path / 'full'))
+    cs.split_concatenated_scripts(3, str(project), output_dir=str(tmp_path / 'stream'), stream=True)
+    assert read_blocks(tmp_path / 'stream') == read_blocks(tmp_path / 'full')
+
+
+def test_stream_collects_sizes_without_content(project):
+    full, _, _ = cs.collect_file_contents(str(project))
+    sizes, _, _ = cs.collect_file_contents(str(project), keep_content=False)
+    assert all(block['content'] is None for block in sizes)
+    assert [(block['path'], block['size']) for block in sizes] == \
+        [(block['path'], len(block['content'])) for block in full]
+
+
+def test_stream_memory_does_not_grow_with_the_tree(tmp_path):
+    total = make_large_tree(tmp_path / 'proj')
+    root = str(tmp_path / 'proj')
+    full = peak_memory(root_dir=root, output_dir=str(tmp_path / 'full'))
+    stream = peak_memory(root_dir=root, output_dir=str(tmp_path / 'stream'), stream=True)
+    assert full > total
+    assert stream < total / 3
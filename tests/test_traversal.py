@@ -0,0 +1,88 @@
+import os
+
+import pytest
+
+import concatenate_scripts as cs
+from conftest import read_blocks
+
+
+def add_node_modules(root):
+    package = root / 'node_modules' / 'left-pad' / 'lib'
+    package.mkdir(parents=True)
+    (package / 'index.js').write_text('module.exports = 1;\n')
+
+
+# --- Single scandir traversal ---
+
+def test_each_directory_is_listed_once(project, tmp_path, monkeypatch):
+    add_node_modules(project)
+    listed = []
+    scandir = os.scandir
+
+    def counting_scandir(path='.'):
+        listed.append(os.path.relpath(path, project))
+        return scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', counting_scandir)
+    cs.split_concatenated_scripts(2, str(project), output_dir=str(tmp_path / 'out'))
+    # node_modules is recognised from its entry without being listed
+    assert sorted(listed) == ['.', 'pkg0', 'pkg1', 'pkg2']
+
+
+def test_structure_and_collection_share_the_tree(project, tmp_path):
+    add_node_modules(project)
+    out = tmp_path / 'out'
+    cs.split_concatenated_scripts(1, str(project), output_dir=str(out))
+    text = (out / 'concatenated_scripts_part1.txt').read_text(encoding='utf-8')
+    structure = text[text.index('# Directory Structure'):]
+    blocks = read_blocks(out)
+    assert len(blocks) == 30
+    for path in blocks:
+        size = cs.format_file_size((project / path).stat().st_size)
+        assert f'{os.path.basename(path)} ({size}, .py)' in structure
+    assert 'node_modules (venv/node_modules)' in structure
+    assert 'index.js' not in structure
+    assert not any(path.startswith('node_modules') for path in blocks)
+
+
+# --- Directory verdict cache ---
+
+def test_venv_probes_grow_with_directories_not_files(tmp_path, monkeypatch):
+    root = tmp_path / 'proj'
+    venv = root / 'env'
+    (venv / 'lib').mkdir(parents=True)
+    (venv / 'pyvenv.cfg').write_text('home = /usr/bin\n')
+    (venv / 'lib' / 'site.py').write_text('x = 1\n')
+    for d in range(3):
+        for f in range(50):
+            path = root / f'pkg{d}' / f'mod{f}.py'
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(f'x = {f}\n')
+    probes = []
+    exists = os.path.exists
+
+    def counting_exists(path):
+        probes.append(path)
+        return exists(path)
+
+    monkeypatch.setattr(os.path, 'exists', counting_exists)
+    verdict_cache = {}
+    tree = cs.scan_directory_tree(str(root), verdict_cache)
+    file_blocks, processed, _ = cs.collect_file_contents(str(root), tree, verdict_cache)
+    assert processed == 150
+    assert not any(block['path'].startswith('env') for block in file_blocks)
+    venv_probes = [path for path in probes if any(path.endswith(marker) for marker in cs.VENV_MARKERS)]
+    # The root, env and three packages, each probed for the markers at most once
+    assert len(venv_probes) <= 5 * len(cs.VENV_MARKERS)
+
+
+def test_directory_inside_a_flagged_directory_inherits_its_verdict(tmp_path, monkeypatch):
+    venv = tmp_path / 'env'
+    (venv / 'lib' / 'deep').mkdir(parents=True)
+    (venv / 'pyvenv.cfg').write_text('')
+    cache = {}
+    assert cs.is_venv_or_node_modules(str(venv), cache)
+    monkeypatch.setattr(cs, 'has_venv_markers', lambda path: pytest.fail(f'probed {path}'))
+    assert cs.is_venv_or_node_modules(str(venv / 'lib'), cache)
+    assert cs.is_venv_or_node_modules(str(venv / 'lib' / 'deep'), cache)
+    assert cs.is_file_in_venv_or_node_modules(str(venv / 'lib' / 'deep' / 'mod.py'), cache)
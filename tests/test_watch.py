@@ -0,0 +1,111 @@
+import logging
+import os
+import threading
+
+import pytest
+
+import concatenate_scripts as cs
+from conftest import part_names, read_blocks
+
+
+class WatchStarted(logging.Handler):
+    """Sets an event once watch_and_regenerate has added its inotify watches."""
+
+    def __init__(self, started):
+        super().__init__()
+        self.started = started
+
+    def emit(self, record):
+        if record.getMessage().startswith('Watching'):
+            self.started.set()
+
+
+def part_times(out):
+    return {name: os.stat(out / name).st_mtime_ns for name in part_names(out)}
+
+
+def touch(path, text):
+    """Writes text and moves the mtime forward, so coarse timestamps still see a change."""
+    stat = path.stat()
+    path.write_text(text)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+def watch_once(project, out, change, use_inotify, monkeypatch):
+    """Runs one regeneration of watch mode around change() and returns the part times before it."""
+    started = threading.Event()
+    handler = WatchStarted(started)
+    if not use_inotify:
+        # Polling only sees changes made after its snapshot, which follows the log line
+        handler = logging.NullHandler()
+        snapshot_tree = cs.snapshot_tree
+
+        def snapshot(tree):
+            result = snapshot_tree(tree)
+            started.set()
+            return result
+
+        monkeypatch.setattr(cs, 'snapshot_tree', snapshot)
+    cs.logger.addHandler(handler)
+    cs.logger.setLevel(logging.INFO)
+    thread = threading.Thread(target=cs.watch_and_regenerate, args=(0.05, 0.05, use_inotify, 1),
+                              kwargs={'num_parts': 3, 'root_dir': str(project), 'output_dir': str(out)},
+                              daemon=True)
+    try:
+        thread.start()
+        assert started.wait(10)
+        times = part_times(out)
+        change()
+        thread.join(10)
+        assert not thread.is_alive()
+    finally:
+        cs.logger.removeHandler(handler)
+    return times
+
+
+@pytest.fixture(params=[False, True], ids=['polling', 'inotify'])
+def use_inotify(request):
+    if request.param:
+        watcher = cs.open_inotify_watcher()
+        if watcher is None:
+            pytest.skip('inotify is not available')
+        cs.close_watcher(watcher)
+    return request.param
+
+
+def test_changed_file_is_regenerated_into_its_part_only(project, tmp_path, use_inotify, monkeypatch):
+    out = tmp_path / 'out'
+    changed = project / 'pkg1' / 'mod4.py'
+    times = watch_once(project, out, lambda: touch(changed, changed.read_text().replace('x', 'y')),
+                       use_inotify, monkeypatch)
+    assert 'yyyy' in read_blocks(out)['pkg1/mod4.py']
+    part = next(name for name in part_names(out) if 'yyyy' in (out / name).read_text(encoding='utf-8'))
+    new_times = part_times(out)
+    assert [name for name in times if new_times[name] != times[name]] == [part]
+
+
+def test_new_directory_is_picked_up(project, tmp_path, use_inotify, monkeypatch):
+    out = tmp_path / 'out'
+
+    def add_package():
+        (project / 'pkg3').mkdir()
+        (project / 'pkg3' / 'fresh.py').write_text('FRESH = True\n')
+
+    watch_once(project, out, add_package, use_inotify, monkeypatch)
+    blocks = read_blocks(out)
+    assert 'FRESH = True' in blocks['pkg3/fresh.py']
+    cs.split_concatenated_scripts(3, str(project), output_dir=str(tmp_path / 'fresh'))
+    assert blocks == read_blocks(tmp_path / 'fresh')
+
+
+def test_poll_reports_file_and_directory_changes(project):
+    tree = cs.scan_directory_tree(str(project))
+    snapshot = cs.snapshot_tree(tree)
+    changes = cs.new_change_set()
+    assert cs.poll_tree_changes(snapshot, changes) == []
+    touch(project / 'pkg0' / 'mod0.py', 'A = 1\n')
+    (project / 'pkg2' / 'new.py').write_text('B = 2\n')
+    os.utime(project / 'pkg2', ns=(0, 10 ** 9))
+    assert cs.poll_tree_changes(snapshot, changes)
+    assert set(changes['files']) == {os.path.join('pkg0', 'mod0.py')}
+    assert set(changes['rescan']) == {'pkg2'}